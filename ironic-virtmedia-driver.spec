@@ -41,6 +41,9 @@ cd src && python setup.py install --root %{buildroot} --no-compile --install-pur
 
 %files
 %{_python_site_packages_path}/ironic_virtmedia_driver*
+%{_bindir}/virtmedia-share-gc
+%{_bindir}/virtmedia-image-server
+%{_bindir}/virtmedia-share-migrate
 
 %pre
 
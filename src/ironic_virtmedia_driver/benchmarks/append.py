@@ -0,0 +1,99 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compares the in-memory floppy appender with the tar.gz plus dd path.
+
+Usage: python -m ironic_virtmedia_driver.benchmarks.append [--iso-mb N]
+    [--iterations N] [--fsync] [--dir DIR] [--output FILE]
+"""
+
+import argparse
+import os
+import tarfile
+
+from ironic_lib import utils as ironic_utils
+
+from ironic_virtmedia_driver.benchmarks import common
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver import vfat_image
+from ironic_virtmedia_driver import virtmedia
+
+PARAMS = b'BOOTIF=52:54:00:12:34:56\nos_net_config={"network_config": []}'
+
+
+def _legacy_append(root, iso_filename, floppy_filename):
+    """The tar.gz file plus dd implementation the appender replaced."""
+    iso_path = os.path.join(root, iso_filename)
+    floppy_path = os.path.join(root, floppy_filename)
+    tar_path = floppy_path + '.tar.gz'
+    tar = tarfile.open(tar_path, 'w:gz')
+    tar.add(floppy_path, arcname=floppy_filename)
+    tar.close()
+    ironic_utils.dd(tar_path, iso_path, 'bs=64k', 'conv=notrunc,sync',
+                    'oflag=append')
+    os.remove(tar_path)
+    if CONF.virtmedia_fsync_share_files:
+        share_utils.sync_file(iso_path)
+
+
+def _new_append(root, iso_filename, floppy_filename):
+    virtmedia._append_floppy_to_cd(iso_filename, floppy_filename)
+    if CONF.virtmedia_fsync_share_files:
+        share_utils.sync_file(os.path.join(root, iso_filename))
+
+
+def run(iso_size, iterations, base_dir=None):
+    results = {'iso_size': iso_size, 'iterations': iterations,
+               'fsync': CONF.virtmedia_fsync_share_files}
+    with common.share_root(base_dir) as root:
+        base_iso = os.path.join(root, 'base.iso')
+        common.make_iso(base_iso, iso_size)
+        with open(os.path.join(root, 'image-bench.img'), 'wb') as floppy:
+            floppy.write(vfat_image.create_vfat_image(
+                [('parameters.txt', PARAMS)]))
+
+        for name, append in (('dd', _legacy_append), ('inline', _new_append)):
+            samples = []
+            appended = None
+            for _ in range(iterations):
+                iso_filename = 'deploy-bench-%s.iso' % name
+                iso_path = os.path.join(root, iso_filename)
+                common.make_iso(iso_path, iso_size)
+                with common.timed(samples):
+                    append(root, iso_filename, 'image-bench.img')
+                appended = os.path.getsize(iso_path) - iso_size
+                os.remove(iso_path)
+            results[name] = common.summarize(samples)
+            results[name]['bytes_appended'] = appended
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iso-mb', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--fsync', action='store_true')
+    parser.add_argument('--dir', help='directory to run in, e.g. a tmpfs')
+    parser.add_argument('--output', help='JSON output file')
+    args = parser.parse_args()
+
+    CONF.set_override('virtmedia_fsync_share_files', args.fsync)
+    common.write_results(run(args.iso_mb * 1024 * 1024, args.iterations,
+                             args.dir), args.output)
+
+
+if __name__ == '__main__':
+    main()
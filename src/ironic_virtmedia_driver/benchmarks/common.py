@@ -0,0 +1,138 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Helpers shared by the benchmark scripts."""
+
+import contextlib
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from ironic_virtmedia_driver.conf import CONF
+
+
+def percentile(samples, pct):
+    """Returns the pct percentile of samples, nearest-rank method."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(samples):
+    """Returns count, mean and p50/p95/p99 of a list of durations."""
+    if not samples:
+        return {'count': 0}
+    return {'count': len(samples),
+            'mean': sum(samples) / len(samples),
+            'p50': percentile(samples, 50),
+            'p95': percentile(samples, 95),
+            'p99': percentile(samples, 99),
+            'max': max(samples)}
+
+
+@contextlib.contextmanager
+def timed(samples):
+    """Appends the wall time of the with block to samples."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        samples.append(time.time() - start)
+
+
+@contextlib.contextmanager
+def share_root(base_dir=None):
+    """Points remote_image_share_root to a scratch directory."""
+    root = tempfile.mkdtemp(prefix='virtmedia-bench-', dir=base_dir)
+    CONF.set_override('remote_image_share_root', root + '/')
+    try:
+        yield root + '/'
+    finally:
+        CONF.clear_override('remote_image_share_root')
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _both_endian(value, fmt='I'):
+    return struct.pack('<' + fmt, value) + struct.pack('>' + fmt, value)
+
+
+def _iso9660_metadata(size):
+    """Returns sectors 16 to 20 of an ISO9660 file system of size bytes.
+
+    They are a primary volume descriptor, the terminator, the L and M
+    path tables and an empty root directory.
+    """
+    sector = 2048
+
+    def _root_record(name):
+        return (struct.pack('BB', 34, 0) + _both_endian(20) +
+                _both_endian(sector) + b'\0' * 7 +
+                struct.pack('BBB', 2, 0, 0) + _both_endian(1, 'H') +
+                struct.pack('B', 1) + name)
+
+    pvd = bytearray(sector)
+    pvd[0:7] = b'\x01CD001\x01'
+    pvd[8:72] = b' ' * 64
+    pvd[40:48] = b'BENCHISO'
+    pvd[80:88] = _both_endian(-(-size // sector))
+    pvd[120:124] = _both_endian(1, 'H')
+    pvd[124:128] = _both_endian(1, 'H')
+    pvd[128:132] = _both_endian(sector, 'H')
+    pvd[132:140] = _both_endian(10)
+    pvd[140:144] = struct.pack('<I', 18)
+    pvd[148:152] = struct.pack('>I', 19)
+    pvd[156:190] = _root_record(b'\0')
+    pvd[881] = 1
+    terminator = b'\xffCD001\x01'.ljust(sector, b'\0')
+    l_table = struct.pack('<BBIH', 1, 0, 20, 1) + b'\0\0'
+    m_table = struct.pack('>BBIH', 1, 0, 20, 1) + b'\0\0'
+    root = _root_record(b'\0') + _root_record(b'\1')
+    return b''.join([bytes(pvd), terminator, l_table.ljust(sector, b'\0'),
+                     m_table.ljust(sector, b'\0'), root.ljust(sector, b'\0')])
+
+
+def make_iso(path, size, dense=False):
+    """Creates a stand-in ISO of the given size.
+
+    It holds an empty ISO9660 file system, random data otherwise.
+
+    :param dense: whether to write all of it, it is sparse after 1 MiB
+        otherwise.
+    """
+    block = os.urandom(min(size, 1024 * 1024))
+    with open(path, 'wb') as iso_file:
+        iso_file.write(block)
+        if dense:
+            while iso_file.tell() < size:
+                iso_file.write(block[:size - iso_file.tell()])
+        iso_file.truncate(size)
+        iso_file.seek(16 * 2048)
+        iso_file.write(_iso9660_metadata(size))
+
+
+def write_results(results, output=None):
+    """Writes results as JSON to output, or stdout when not given."""
+    if output:
+        with open(output, 'w') as out_file:
+            json.dump(results, out_file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
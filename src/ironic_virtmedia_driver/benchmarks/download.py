@@ -0,0 +1,194 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmarks the download of HTTP deploy ISOs into the image cache.
+
+image_cache.fetch downloads an ISO from a local image_server stand-in of
+a remote image store, whose connections are each capped to a rate and
+answer after a latency, like WAN links. It runs for every ISO size and
+number of download connections; the server can also be made to ignore
+range requests, to measure the single stream fallback.
+
+The wall time, the throughput and the range fallbacks are reported per
+download, and each cache entry is checked against the served ISO.
+
+Usage: python -m ironic_virtmedia_driver.benchmarks.download
+    [--iso-mb N,...] [--connections N,...] [--rate-mb MIB_PER_S]
+    [--latency MS] [--no-ranges] [--iterations N] [--dir DIR]
+    [--output FILE]
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import time
+
+from ironic_virtmedia_driver.benchmarks import common
+from ironic_virtmedia_driver.benchmarks import fakes
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver import image_server
+
+BASE_ISO = 'bench-remote.iso'
+
+_SEND_SIZE = 64 * 1024
+
+
+class ThrottledRequestHandler(image_server.ImageRequestHandler):
+    """Sends the files at a capped rate per connection, after a delay."""
+
+    rate = None
+    latency = 0.0
+    ranges = True
+
+    def _requested_range(self, etag, last_modified, size):
+        if not self.ranges:
+            return None
+        return image_server.ImageRequestHandler._requested_range(
+            self, etag, last_modified, size)
+
+    def _send_file(self, image_file, offset, count):
+        time.sleep(self.latency)
+        start = time.time()
+        sent = 0
+        while sent < count:
+            try:
+                sent += self.connection.sendfile(
+                    image_file, offset + sent, min(_SEND_SIZE, count - sent))
+            except (IOError, OSError):
+                # The client closed the connection, as image_cache does
+                # after the headers when it downloads in ranges.
+                break
+            if self.rate:
+                ahead = float(sent) / self.rate - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return sent
+
+
+def _serve(root, rate, latency, ranges, queue):
+    server = image_server.create_server(root, '127.0.0.1', 0)
+    server.max_connections_per_client = 0
+    server.RequestHandlerClass = type(
+        'Handler', (ThrottledRequestHandler,),
+        {'rate': rate, 'latency': latency, 'ranges': ranges})
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _start_server(root, rate, latency, ranges):
+    """Serves root from a child process, returns it and its port."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve, args=(root, rate, latency, ranges, queue))
+    process.daemon = True
+    process.start()
+    return process, queue.get(timeout=30)
+
+
+def _sha256(path):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _clear_cache():
+    cache_root = image_cache._cache_root()
+    if os.path.isdir(cache_root):
+        for name in os.listdir(cache_root):
+            os.remove(os.path.join(cache_root, name))
+
+
+def run(iso_sizes, connection_counts, rate, latency, ranges, iterations,
+        base_dir=None):
+    results = {'rate_mib_per_s': rate and float(rate) / (1024 * 1024),
+               'latency_ms': latency * 1000, 'ranges': ranges,
+               'iterations': iterations, 'sizes': {}}
+    with common.share_root(base_dir) as root:
+        server, port = _start_server(root, rate, latency, ranges)
+        try:
+            fetches = 0
+            for iso_size in iso_sizes:
+                iso_path = os.path.join(root, BASE_ISO)
+                common.make_iso(iso_path, iso_size, dense=True)
+                expected = _sha256(iso_path)
+                size_results = results['sizes'][str(iso_size)] = {}
+                for connections in connection_counts:
+                    CONF.set_override(
+                        'virtmedia_deploy_iso_download_connections',
+                        connections)
+                    samples = []
+                    mismatches = 0
+                    metrics = fakes.MetricsCollector()
+                    with metrics.installed():
+                        for _ in range(iterations):
+                            fetches += 1
+                            # A new href each time, so that it is not a
+                            # cache hit.
+                            href = 'http://127.0.0.1:%d%s%s?bench=%d' % (
+                                port, CONF.virtmedia_image_server_prefix,
+                                BASE_ISO, fetches)
+                            with common.timed(samples):
+                                entry_path = image_cache.fetch(None, href)
+                            if _sha256(entry_path) != expected:
+                                mismatches += 1
+                            _clear_cache()
+                    result = common.summarize(samples)
+                    result['mib_per_s'] = (
+                        float(iso_size) * len(samples) /
+                        (1024 * 1024) / sum(samples))
+                    result['range_fallbacks'] = metrics.counters.get(
+                        'VirtmediaImageCache.range_fallbacks', 0)
+                    result['mismatches'] = mismatches
+                    size_results[str(connections)] = result
+        finally:
+            CONF.clear_override('virtmedia_deploy_iso_download_connections')
+            server.terminate()
+    return results
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iso-mb', type=_int_list, default=[64, 256])
+    parser.add_argument('--connections', type=_int_list,
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--rate-mb', type=float, default=10.0,
+                        help='rate of each connection in MiB/s, 0 for no '
+                             'cap')
+    parser.add_argument('--latency', type=float, default=50.0,
+                        help='delay before each response body, in ms')
+    parser.add_argument('--no-ranges', action='store_true',
+                        help='serve the whole file to range requests')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--dir', help='directory to run in')
+    parser.add_argument('--output', help='JSON output file')
+    args = parser.parse_args()
+
+    common.write_results(run([size * 1024 * 1024 for size in args.iso_mb],
+                             args.connections,
+                             int(args.rate_mb * 1024 * 1024),
+                             args.latency / 1000.0, not args.no_ranges,
+                             args.iterations, args.dir), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process fake BMC transports for the benchmarks.
+
+The fakes replace the IPMI and Redfish transports the vendor classes use,
+answering like the real BMCs after a delay drawn from a latency profile,
+and the other ironic services the boot interface relies on.
+"""
+
+import collections
+import contextlib
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ironic_lib import metrics
+
+# The benchmarks scale the sleeps of the code under test, not the BMCs'.
+_real_sleep = time.sleep
+
+
+class LatencyProfile(object):
+    """A distribution of BMC response times.
+
+    Profiles are written as 'constant:<ms>', 'uniform:<low ms>,<high ms>'
+    or 'lognormal:<median ms>,<sigma>'.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _sep, params = spec.partition(':')
+        values = [float(value) for value in params.split(',') if value]
+        if kind == 'constant' and len(values) == 1:
+            self._sample = lambda: values[0]
+        elif kind == 'uniform' and len(values) == 2:
+            self._sample = lambda: random.uniform(values[0], values[1])
+        elif kind == 'lognormal' and len(values) == 2:
+            import math
+            mu = math.log(values[0])
+            self._sample = lambda: random.lognormvariate(mu, values[1])
+        else:
+            raise ValueError('Invalid latency profile %r' % spec)
+
+    def sample(self):
+        """Returns a response time in seconds."""
+        return self._sample() / 1000.0
+
+    def wait(self):
+        _real_sleep(self.sample())
+
+
+class RequestLog(object):
+    """Counts the requests of the fake BMCs, per BMC and per kind."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.per_bmc = collections.Counter()
+        self.per_kind = collections.Counter()
+
+    def record(self, bmc, kind):
+        with self._lock:
+            self.per_bmc[bmc] += 1
+            self.per_kind[kind] += 1
+
+    def reset(self):
+        with self._lock:
+            self.per_bmc.clear()
+            self.per_kind.clear()
+
+
+class FakeIpmiBMC(object):
+    """Answers the IPMI commands of BMCs managed over Redfish.
+
+    These only use IPMI for the boot options, every command succeeds with
+    an empty answer. The Nokia BMCs are simulated by
+    nokia_bmc.NokiaBMCSimulator.
+    """
+
+    def __init__(self, address, latency, log):
+        self.address = address
+        self.latency = latency
+        self.log = log
+
+    def send_raw(self, raw_bytes):
+        self.log.record(self.address, 'ipmi')
+        self.latency.wait()
+        return '', ''
+
+    def execute(self, command):
+        self.log.record(self.address, 'ipmi')
+        self.latency.wait()
+        return '', ''
+
+
+class FakeResponse(object):
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.dict = body or {}
+        self.text = json.dumps(self.dict)
+        self.headers = headers or {}
+
+
+def _error(status, message_id):
+    return FakeResponse(status, {'error': {'@Message.ExtendedInfo': [
+        {'MessageId': 'Base.1.0.%s' % message_id}]}})
+
+
+class FakeRedfishBMC(object):
+    """The virtual media resources of an iDRAC or iLO.
+
+    :param kind: 'idrac', 'ilo4' (HP gen9) or 'ilo5' (HP gen10).
+    """
+
+    def __init__(self, address, kind, latency, log):
+        self.address = address
+        self.kind = kind
+        self.latency = latency
+        self.log = log
+        self._lock = threading.Lock()
+        self._sessions = 0
+        self.resources = {}
+        if kind == 'idrac':
+            self._build_idrac()
+        else:
+            self._build_ilo('Hpe' if kind == 'ilo5' else 'Hp')
+
+    def _add(self, path, body):
+        body['@odata.id'] = path
+        self.resources[path] = body
+
+    def _add_root(self, body):
+        sessions = {'@odata.id': '/redfish/v1/SessionService/Sessions'}
+        body.update({
+            'RedfishVersion': '1.0.2',
+            'Links': {'Sessions': sessions},
+            'SessionService': {'@odata.id': '/redfish/v1/SessionService'},
+            'Managers': {'@odata.id': '/redfish/v1/Managers'}})
+        self._add('/redfish/v1', body)
+
+    def _build_idrac(self):
+        manager = '/redfish/v1/Managers/iDRAC.Embedded.1'
+        self._add_root({})
+        self._add(manager, {
+            'VirtualMedia': {'@odata.id': manager + '/VirtualMedia'}})
+        members = []
+        for name, media_types in (('RemovableDisk', ['USBStick']),
+                                  ('CD', ['CD', 'DVD'])):
+            path = '%s/VirtualMedia/%s' % (manager, name)
+            members.append({'@odata.id': path})
+            self._add(path, {
+                'MediaTypes': media_types, 'Inserted': False, 'Image': None,
+                'ConnectedVia': 'NotConnected',
+                'Actions': {
+                    '#VirtualMedia.InsertMedia': {
+                        'target': path + '/Actions/VirtualMedia.InsertMedia'},
+                    '#VirtualMedia.EjectMedia': {
+                        'target': path + '/Actions/VirtualMedia.EjectMedia'}}})
+        self._add(manager + '/VirtualMedia', {'Members': members})
+
+    def _build_ilo(self, oem):
+        manager = '/redfish/v1/Managers/1'
+        self._add_root({'Oem': {oem: {'Manager': [{
+            'ManagerType': 'iLO 5' if oem == 'Hpe' else 'iLO 4'}]}}})
+        self._add('/redfish/v1/resourcedirectory', {'Instances': [
+            {'@odata.id': manager + '/',
+             '@odata.type': '#Manager.v1_1_0.Manager'},
+            {'@odata.id': '/redfish/v1/Systems/1/',
+             '@odata.type': '#ComputerSystem.v1_1_0.ComputerSystem'}]})
+        self._add(manager, {
+            'VirtualMedia': {'@odata.id': manager + '/VirtualMedia/'}})
+        members = []
+        for index, media_types in ((1, ['Floppy', 'USBStick']),
+                                   (2, ['CD', 'DVD'])):
+            path = '%s/VirtualMedia/%d' % (manager, index)
+            members.append({'@odata.id': path + '/'})
+            eject = '%s/Actions/Oem/%s/%siLOVirtualMedia.EjectVirtualMedia' % (
+                path, oem, oem)
+            self._add(path, {
+                'MediaTypes': media_types, 'Inserted': False, 'Image': None,
+                'Oem': {oem: {'Actions': {
+                    '#%siLOVirtualMedia.EjectVirtualMedia' % oem: {
+                        'target': eject + '/'}}}}})
+        self._add(manager + '/VirtualMedia', {'Members': members})
+
+    @staticmethod
+    def _normalize(path):
+        return re.sub('/+', '/', path).rstrip('/') or '/'
+
+    def _eject(self, media):
+        if not media['Inserted']:
+            return _error(400, 'ActionNotSupported')
+        media.update(Inserted=False, Image=None)
+        if 'ConnectedVia' in media:
+            media['ConnectedVia'] = 'NotConnected'
+        return FakeResponse(204 if self.kind == 'idrac' else 200)
+
+    def handle(self, method, path, body=None):
+        """Handles a Redfish request.
+
+        :returns: a FakeResponse.
+        """
+        self.log.record(self.address, 'redfish')
+        self.latency.wait()
+        path = self._normalize(path.split('?', 1)[0])
+        with self._lock:
+            if path == '/redfish/v1/SessionService/Sessions':
+                if method == 'POST':
+                    self._sessions += 1
+                    session = str(self._sessions)
+                    return FakeResponse(201, {'Id': session}, {
+                        'X-Auth-Token': 'token-%s' % session,
+                        'Location': '/redfish/v1/SessionService/'
+                                    'Sessions/%s' % session})
+            elif path.startswith('/redfish/v1/SessionService/Sessions/'):
+                if method == 'DELETE':
+                    return FakeResponse(204)
+            elif method == 'GET' and path in self.resources:
+                return FakeResponse(200, json.loads(json.dumps(
+                    self.resources[path])))
+            elif method == 'PATCH' and path in self.resources:
+                media = self.resources[path]
+                if (body or {}).get('Image'):
+                    media.update(Inserted=True, Image=body['Image'])
+                    return FakeResponse(200)
+                return self._eject(media)
+            elif method == 'POST':
+                media_path, _sep, action = path.partition('/Actions/')
+                media = self.resources.get(media_path)
+                if media is None:
+                    return _error(404, 'ResourceMissingAtURI')
+                if action.endswith('InsertMedia'):
+                    if media['Inserted']:
+                        return _error(500, 'VirtualMediaAlreadyAttached')
+                    media.update(Inserted=True, Image=body.get('Image'),
+                                 ConnectedVia='URI')
+                    return FakeResponse(204)
+                if action.endswith('EjectMedia') or action.endswith(
+                        'EjectVirtualMedia'):
+                    return self._eject(media)
+            return _error(404, 'ResourceMissingAtURI')
+
+
+class FakeRedfishClient(object):
+    """In-process stand-in of the python-redfish-library client."""
+
+    def __init__(self, bmc, base_url):
+        self._bmc = bmc
+        self._base_url = base_url
+        self._session = None
+
+    def get_base_url(self):
+        return self._base_url
+
+    def login(self, auth=None):
+        response = self._bmc.handle('POST',
+                                    '/redfish/v1/SessionService/Sessions')
+        self._session = response.dict['Id']
+
+    def logout(self):
+        if self._session:
+            self._bmc.handle('DELETE', '/redfish/v1/SessionService/'
+                             'Sessions/%s' % self._session)
+            self._session = None
+
+    def get(self, path, args=None, headers=None):
+        return self._bmc.handle('GET', path)
+
+    def post(self, path, args=None, body=None, headers=None):
+        return self._bmc.handle('POST', path, body)
+
+    def patch(self, path, args=None, body=None, headers=None):
+        return self._bmc.handle('PATCH', path, body)
+
+
+class FakeTypepath(object):
+    """Stand-in of redfish.ris.tpdefs.Typesandpathdefines.
+
+    The real one asks the iLO for its generation over HTTP.
+    """
+
+    def __init__(self, bmc_registry):
+        self._registry = bmc_registry
+        self.defs = None
+
+    def getgen(self, url=None, **kwargs):
+        bmc = self._registry[url.split('://', 1)[-1]]
+        gen10 = bmc.kind == 'ilo5'
+        self.defs = mock.Mock(isgen9=not gen10, isgen10=gen10,
+                              oemhp='Hpe' if gen10 else 'Hp',
+                              oempath='/Oem/Hpe' if gen10 else '/Oem/Hp')
+
+
+class MetricsCollector(object):
+    """Collects the timers and counters sent through ironic_lib metrics.
+
+    Timers are collected in seconds, with the module part of their prefix
+    removed, e.g. VirtualMediaBoot.prepare_node_iso.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = collections.defaultdict(list)
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def _short_name(name):
+        parts = name.split('.')
+        for index, part in enumerate(parts):
+            if part[:1].isupper() or part in ('nokia', 'dell', 'hp'):
+                return '.'.join(parts[index:])
+        return name
+
+    def _timer(self, logger, name, value):
+        with self._lock:
+            self.timers[self._short_name(name)].append(value / 1000.0)
+
+    def _counter(self, logger, name, value, sample_rate=None):
+        with self._lock:
+            self.counters[self._short_name(name)] += value
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    @contextlib.contextmanager
+    def installed(self):
+        collector = self
+
+        def _timer(logger, name, value):
+            collector._timer(logger, name, value)
+
+        def _counter(logger, name, value, sample_rate=None):
+            collector._counter(logger, name, value, sample_rate)
+
+        with mock.patch.object(metrics.NoopMetricLogger, '_timer', _timer), \
+                mock.patch.object(metrics.NoopMetricLogger, '_counter',
+                                  _counter):
+            yield self
@@ -0,0 +1,385 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Runs VirtualMediaAndIpmiBoot against a fleet of fake nodes.
+
+Every node goes through prepare_ramdisk, prepare_instance and
+clean_up_ramdisk, the nodes of a vendor all at once, against in-process
+fake BMCs answering after a delay drawn from --latency. The Nokia BMCs
+are simulated by nokia_bmc, with the delays of --bmc-timings and the
+failures of --faults. The sleeps of the vendor code and the BMC delays
+are multiplied by --time-scale.
+
+Usage: python -m ironic_virtmedia_driver.benchmarks.fleet [--nodes N]
+    [--vendors V,...] [--latency PROFILE] [--time-scale F]
+    [--concurrency N] [--bmc-timings NAME=S,...] [--faults NAME=P,...]
+    [--seed N] [--iso-mb N] [--dir DIR] [--output FILE]
+"""
+
+import argparse
+import collections
+import importlib
+import os
+import resource
+import subprocess
+import threading
+import time
+
+import futurist
+from futurist import waiters
+
+from ironic.common import states
+from ironic.conductor import utils as manager_utils
+from ironic.drivers.modules import deploy_utils
+from ironic.drivers.modules import ipmitool
+
+from ironic_virtmedia_driver.benchmarks import common
+from ironic_virtmedia_driver.benchmarks import fakes
+from ironic_virtmedia_driver.benchmarks import nokia_bmc
+from ironic_virtmedia_driver import virtmedia_ipmi_boot
+
+mock = fakes.mock
+
+# Name: (vendor, product_family, BMC kind)
+FLEETS = {
+    'nokia-hw17': ('nokia', 'HW17', 'nokia'),
+    'nokia-rm18': ('nokia', 'RM18', 'nokia'),
+    'nokia-or18': ('nokia', 'OR18', 'nokia'),
+    'nokia-oe19': ('nokia', 'OE19', 'nokia'),
+    'dell': ('dell', 'DELL', 'idrac'),
+    'hp-gen9': ('hp', 'HP', 'ilo4'),
+    'hp-gen10': ('hp', 'HP', 'ilo5'),
+}
+
+OPERATIONS = ('prepare_ramdisk', 'prepare_instance', 'clean_up_ramdisk')
+
+BASE_ISO = 'bench-deploy.iso'
+
+
+class FakeNode(object):
+    def __init__(self, index, vendor, product_family):
+        self.uuid = '00000000-0000-4000-8000-%012d' % index
+        self.name = 'bench-node-%d' % index
+        self.address = '10.%d.%d.%d' % (index >> 16 & 0xff, index >> 8 & 0xff,
+                                         index & 0xff)
+        self.mac = '52:54:00:%02x:%02x:%02x' % (index >> 16 & 0xff,
+                                                index >> 8 & 0xff,
+                                                index & 0xff)
+        self.provision_state = states.DEPLOYING
+        self.driver_info = {
+            'ipmi_address': self.address,
+            'ipmi_username': 'admin',
+            'ipmi_password': 'password',
+            'provisioning_server': '192.0.2.1',
+            'provisioning_server_http_port': '80',
+            'vendor': vendor,
+            'product_family': product_family,
+            'virtmedia_deploy_iso': BASE_ISO,
+        }
+        self.driver_internal_info = {'is_whole_disk_image': True}
+        self.instance_info = {}
+        self.properties = {}
+
+    def save(self):
+        pass
+
+
+class FakeTask(object):
+    def __init__(self, node):
+        self.node = node
+        self.context = None
+        self.ports = []
+
+
+class Fleet(object):
+    """The fake BMCs of the nodes, keyed by their address."""
+
+    def __init__(self, latency, timings=None, faults=None, time_scale=1.0,
+                 seed=None):
+        self.latency = latency
+        self.timings = timings
+        self.faults = faults
+        self.time_scale = time_scale
+        self.seed = seed
+        self.log = fakes.RequestLog()
+        self.bmcs = {}
+        self.boot_devices = {}
+
+    def add(self, node, kind):
+        if kind == 'nokia':
+            bmc = nokia_bmc.NokiaBMCSimulator(
+                node.address, self.latency, self.log, timings=self.timings,
+                faults=self.faults, time_scale=self.time_scale,
+                seed=None if self.seed is None else self.seed + len(
+                    self.bmcs))
+        else:
+            bmc = fakes.FakeRedfishBMC(node.address, kind, self.latency,
+                                       self.log)
+        self.bmcs[node.address] = bmc
+        return bmc
+
+    def _ipmi(self, address):
+        bmc = self.bmcs[address]
+        if isinstance(bmc, nokia_bmc.NokiaBMCSimulator):
+            return bmc
+        # Redfish BMCs also take raw IPMI commands, e.g. for boot options.
+        return fakes.FakeIpmiBMC(address, self.latency, self.log)
+
+    def simulator_totals(self):
+        """Returns the Nokia commands run and the faults injected."""
+        commands = collections.Counter()
+        injected = collections.Counter()
+        for bmc in self.bmcs.values():
+            if isinstance(bmc, nokia_bmc.NokiaBMCSimulator):
+                commands.update(bmc.commands)
+                injected.update(bmc.injected)
+        return dict(commands), dict(injected)
+
+    def parse_ipmi_driver_info(self, node):
+        return {'address': node.driver_info['ipmi_address'],
+                'username': node.driver_info['ipmi_username'],
+                'password': node.driver_info['ipmi_password']}
+
+    def send_raw(self, task, raw_bytes):
+        return self._ipmi(task.node.address).send_raw(raw_bytes)
+
+    def exec_ipmitool(self, driver_info, command):
+        return self._ipmi(driver_info['address']).execute(command)
+
+    def node_set_boot_device(self, task, device, persistent=False):
+        self.log.record(task.node.address, 'ipmi')
+        self.latency.wait()
+        self.boot_devices[task.node.uuid] = device
+
+    def redfish_client(self, base_url, username=None, password=None,
+                       default_prefix=None, **kwargs):
+        return fakes.FakeRedfishClient(
+            self.bmcs[base_url.split('://', 1)[-1]], base_url)
+
+    def typepath(self):
+        return fakes.FakeTypepath(self.bmcs)
+
+    def patches(self, vendor):
+        patches = [
+            mock.patch.object(ipmitool, '_parse_driver_info',
+                              self.parse_ipmi_driver_info),
+            mock.patch.object(ipmitool, 'send_raw', self.send_raw),
+            mock.patch.object(ipmitool, '_exec_ipmitool', self.exec_ipmitool),
+            mock.patch.object(manager_utils, 'node_set_boot_device',
+                              self.node_set_boot_device),
+            mock.patch.object(deploy_utils, 'get_single_nic_with_vif_port_id',
+                              lambda task: task.node.mac),
+        ]
+        if vendor in ('dell', 'hp'):
+            patches.append(mock.patch(
+                'ironic_virtmedia_driver.vendors.%s.%s.redfish_client' % (
+                    vendor, vendor), self.redfish_client))
+        if vendor == 'hp':
+            patches.append(mock.patch(
+                'redfish.ris.tpdefs.Typesandpathdefines', self.typepath))
+        return patches
+
+
+class SubprocessCounter(object):
+    """Counts the processes started through subprocess."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def patch(self):
+        original = subprocess.Popen.__init__
+        counter = self
+
+        def __init__(self, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            original(self, *args, **kwargs)
+
+        return mock.patch.object(subprocess.Popen, '__init__', __init__)
+
+
+def _scaled_sleep(scale):
+    def sleep(seconds):
+        fakes._real_sleep(seconds * scale)
+    return sleep
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_operation(boot, operation, tasks, concurrency):
+    """Runs an operation on all the tasks, returns its timings."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def _call(task):
+        start = time.time()
+        try:
+            if operation == 'prepare_ramdisk':
+                boot.prepare_ramdisk(task, {})
+            else:
+                getattr(boot, operation)(task)
+        except Exception as e:
+            with lock:
+                errors.append('%s: %s' % (task.node.name, e))
+            return
+        with lock:
+            latencies.append(time.time() - start)
+
+    pool = futurist.ThreadPoolExecutor(max_workers=concurrency)
+    start = time.time()
+    try:
+        waiters.wait_for_all([pool.submit(_call, task) for task in tasks])
+    finally:
+        pool.shutdown(wait=False)
+    wall_time = time.time() - start
+
+    result = common.summarize(latencies)
+    result.update(wall_time=wall_time, errors=len(errors),
+                  error_samples=errors[:5],
+                  nodes_per_second=len(latencies) / wall_time
+                  if wall_time else None)
+    return result
+
+
+def run_fleet(name, nodes, latency, concurrency, first_index=0,
+              **bmc_options):
+    """Runs the operations of a fleet of one vendor.
+
+    :param bmc_options: the timings, faults, time_scale and seed of the
+        simulated Nokia BMCs.
+
+    :returns: the results of the fleet, as a dictionary.
+    """
+    vendor, product_family, kind = FLEETS[name]
+    results = {'vendor': vendor, 'product_family': product_family,
+               'nodes': nodes}
+    try:
+        importlib.import_module('ironic_virtmedia_driver.vendors.%s.%s' % (
+            vendor, product_family.lower()))
+    except ImportError as e:
+        results['error'] = 'Cannot load the vendor code: %s' % e
+        return results
+
+    fleet = Fleet(latency, **bmc_options)
+    tasks = []
+    for index in range(first_index, first_index + nodes):
+        node = FakeNode(index, vendor, product_family)
+        fleet.add(node, kind)
+        tasks.append(FakeTask(node))
+
+    collector = fakes.MetricsCollector()
+    subprocesses = SubprocessCounter()
+    patches = fleet.patches(vendor) + [subprocesses.patch()]
+    for patch in patches:
+        patch.start()
+    try:
+        boot = virtmedia_ipmi_boot.VirtualMediaAndIpmiBoot()
+        with collector.installed():
+            start = time.time()
+            for operation in OPERATIONS:
+                results[operation] = _run_operation(boot, operation, tasks,
+                                                    concurrency)
+            results['wall_time'] = time.time() - start
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+
+    results['phases'] = dict((phase, common.summarize(samples))
+                             for phase, samples in collector.timers.items())
+    results['counters'] = dict(collector.counters)
+    results['bmc_requests'] = dict(fleet.log.per_kind)
+    results['bmc_requests_per_node'] = (
+        float(sum(fleet.log.per_kind.values())) / nodes if nodes else 0)
+    if kind == 'nokia':
+        (results['bmc_commands'],
+         results['faults_injected']) = fleet.simulator_totals()
+    results['subprocesses'] = subprocesses.count
+    results['peak_rss_kb'] = _peak_rss_kb()
+    return results
+
+
+def run(fleets, nodes, latency_spec, time_scale, concurrency, iso_size,
+        base_dir=None, timings=None, faults=None, seed=None):
+    latency = fakes.LatencyProfile(latency_spec)
+    results = {'nodes_per_fleet': nodes, 'latency': latency_spec,
+               'time_scale': time_scale, 'concurrency': concurrency,
+               'iso_size': iso_size, 'bmc_timings': timings,
+               'faults': faults, 'seed': seed, 'fleets': {}}
+    with common.share_root(base_dir) as root, \
+            mock.patch('time.sleep', _scaled_sleep(time_scale)):
+        common.make_iso(os.path.join(root, BASE_ISO), iso_size)
+        for position, name in enumerate(fleets):
+            results['fleets'][name] = run_fleet(
+                name, nodes, latency, concurrency or nodes,
+                first_index=position * nodes, timings=timings, faults=faults,
+                time_scale=time_scale, seed=seed)
+    results['peak_rss_kb'] = _peak_rss_kb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=50,
+                        help='nodes per vendor')
+    parser.add_argument('--vendors', default=','.join(sorted(FLEETS)),
+                        help='comma separated, among %s' % ', '.join(
+                            sorted(FLEETS)))
+    parser.add_argument('--latency', default='lognormal:20,0.5',
+                        help="BMC response times: 'constant:MS', "
+                             "'uniform:LOW,HIGH' or 'lognormal:MEDIAN,SIGMA'")
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help='factor applied to the sleeps of the driver')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='nodes handled at once, all of them by default')
+    parser.add_argument('--bmc-timings', default='',
+                        help='delays of the simulated Nokia BMCs in BMC '
+                             'seconds, among %s' % ', '.join(
+                                 '%s=%g' % item for item in sorted(
+                                     nokia_bmc.DEFAULT_TIMINGS.items())))
+    parser.add_argument('--faults', default='',
+                        help='failure probabilities of the simulated Nokia '
+                             'BMCs, among %s' % ', '.join(
+                                 sorted(nokia_bmc.DEFAULT_FAULTS)))
+    parser.add_argument('--seed', type=int,
+                        help='seed of the fault injection')
+    parser.add_argument('--iso-mb', type=int, default=16)
+    parser.add_argument('--dir', help='directory to run in, e.g. a tmpfs')
+    parser.add_argument('--output', help='JSON output file')
+    args = parser.parse_args()
+
+    fleets = [name.strip() for name in args.vendors.split(',') if name]
+    unknown = set(fleets) - set(FLEETS)
+    if unknown:
+        parser.error('Unknown vendors: %s' % ', '.join(sorted(unknown)))
+    try:
+        timings = nokia_bmc.parse_settings(args.bmc_timings,
+                                           nokia_bmc.DEFAULT_TIMINGS)
+        faults = nokia_bmc.parse_settings(args.faults,
+                                          nokia_bmc.DEFAULT_FAULTS)
+    except ValueError as e:
+        parser.error(str(e))
+    common.write_results(run(fleets, args.nodes, args.latency,
+                             args.time_scale, args.concurrency,
+                             args.iso_mb * 1024 * 1024, args.dir,
+                             timings=timings, faults=faults, seed=args.seed),
+                         args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Stateful simulator of the Nokia OEM IPMI virtual media commands.
+
+It models what the HW17, RM18, OR18 and OE19 classes rely on:
+
+* the virtual media service, which is only started by a restart once
+  enabled (0x32 0xca/0xcb 0x08, 0x32 0xcb 0x0a);
+* the CD, FD and HD device counts (0x32 0xca/0xcb 0x04-0x06) and the
+  CD/DVD enable status (0x32 0xca/0xcb 0x00), applied after a delay;
+* the RIS configuration (0x32 0x9f 0x01), with its progress bit, and the
+  RIS restarts (0x32 0x9f 0x01 0x0b, 0x32 0x9f 0x08 0x0b);
+* the image scan of the share and the image redirection (0x32 0xd7,
+  0x32 0xd8);
+* the HW17 NFS commands (0x3c 0x00-0x03) and their mount progress;
+* 'bmc reset cold', which makes the BMC unreachable for a while and
+  drops the mounts.
+
+Delays are given in BMC seconds and multiplied by the time scale, like
+the sleeps of the driver in the benchmarks. Failures are injected with
+the given probabilities: a failed command raises as ipmitool does, an
+NFS error ends a mount, and a stuck mount never completes until a BMC
+reset.
+"""
+
+import collections
+import random
+import threading
+import time
+
+from oslo_concurrency import processutils
+
+from ironic.common import exception
+
+# BMC seconds
+DEFAULT_TIMINGS = {
+    'service_restart': 3.0,
+    'device_count': 3.0,
+    'toggle': 1.5,
+    'ris_restart': 4.0,
+    'image_scan': 8.0,
+    'mount': 3.0,
+    'bmc_reset': 60.0,
+}
+
+# Probabilities
+DEFAULT_FAULTS = {
+    'command': 0.0,
+    'nfs_error': 0.0,
+    'stuck_mount': 0.0,
+}
+
+_NAME_LENGTH = 64
+
+
+def parse_settings(spec, defaults):
+    """Parses 'name=value,...' over a copy of defaults.
+
+    :raises: ValueError on unknown names or invalid values.
+    """
+    settings = dict(defaults)
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        name, _sep, value = item.partition('=')
+        name = name.strip()
+        if name not in defaults:
+            raise ValueError('Unknown setting %r, expected one of %s' % (
+                name, ', '.join(sorted(defaults))))
+        settings[name] = float(value)
+    return settings
+
+
+def _decode(hex_bytes):
+    """Decodes the '0x..' bytes of a string argument, up to a NUL."""
+    chars = []
+    for byte in hex_bytes:
+        value = int(byte, 16)
+        if not value:
+            break
+        chars.append(chr(value))
+    return ''.join(chars)
+
+
+class _Delayed(object):
+    """A value taking effect some time after being set."""
+
+    def __init__(self, value):
+        self._value = value
+        self._next = None
+        self._at = 0
+
+    def set(self, value, delay):
+        self._value = self.get()
+        self._next = value
+        self._at = time.time() + delay
+
+    def get(self):
+        if self._next is not None and time.time() >= self._at:
+            self._value, self._next = self._next, None
+        return self._value
+
+
+class NokiaBMCSimulator(object):
+    """A Nokia BMC answering the raw and ipmitool commands of a node.
+
+    :param address: the BMC address, used in the request log.
+    :param latency: a LatencyProfile of the command round trips.
+    :param log: a RequestLog.
+    :param timings: BMC delays, see DEFAULT_TIMINGS.
+    :param faults: fault probabilities, see DEFAULT_FAULTS.
+    :param time_scale: factor applied to the BMC delays.
+    :param images_on_share: the images the RIS scan finds on the share.
+    :param seed: seed of the fault injection.
+    """
+
+    def __init__(self, address, latency, log, timings=None, faults=None,
+                 time_scale=1.0, images_on_share=1, seed=None):
+        self.address = address
+        self.latency = latency
+        self.log = log
+        self.timings = dict(DEFAULT_TIMINGS, **(timings or {}))
+        self.faults = dict(DEFAULT_FAULTS, **(faults or {}))
+        self.time_scale = time_scale
+        self.images_on_share = images_on_share
+        self.commands = collections.Counter()
+        self.injected = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._unreachable_until = 0
+        self.service_enabled = False
+        self.service_running = _Delayed(False)
+        self.device_counts = dict((device, _Delayed(4))
+                                  for device in ('0x04', '0x05', '0x06'))
+        self.cd_enabled = _Delayed(False)
+        self.ris = {}
+        self.progress_bit = False
+        self._reset_media()
+
+    def _reset_media(self):
+        self.images_available = _Delayed(0)
+        self.image = None
+        self.mount = _Delayed(None)
+
+    def _delay(self, name):
+        return self.timings[name] * self.time_scale
+
+    def _chance(self, fault):
+        if self.faults[fault] and self._random.random() < self.faults[fault]:
+            self.injected[fault] += 1
+            return True
+        return False
+
+    def _start_mount(self, image):
+        """Starts mounting image, ending mounted, in error or never."""
+        self.image = image
+        self.mount = _Delayed('mounting')
+        if self._chance('stuck_mount'):
+            return
+        self.mount.set('nfserror' if self._chance('nfs_error') else 'mounted',
+                       self._delay('mount'))
+
+    def _mount_status(self):
+        return self.mount.get()
+
+    # Nokia OEM commands, 0x32
+
+    def _oem(self, args):
+        command = args[:2]
+        if command == ['0xca', '0x08']:
+            self.commands['get_service_status'] += 1
+            return ' %02x\n' % int(self.service_running.get())
+        if command == ['0xcb', '0x08']:
+            self.commands['set_service_enabled'] += 1
+            self.service_enabled = bool(int(args[2], 16))
+            if not self.service_enabled:
+                self.service_running = _Delayed(False)
+            return ''
+        if command == ['0xcb', '0x0a']:
+            self.commands['restart_service'] += 1
+            # Only a restart starts the service of an enabled BMC.
+            self.service_running = _Delayed(False)
+            if self.service_enabled:
+                self.service_running.set(True, self._delay('service_restart'))
+            return ''
+        if command[0] == '0xca' and args[1] in self.device_counts:
+            self.commands['get_device_count'] += 1
+            return ' %d\n' % self.device_counts[args[1]].get()
+        if command[0] == '0xcb' and args[1] in self.device_counts:
+            self.commands['set_device_count'] += 1
+            self.device_counts[args[1]].set(int(args[2], 16),
+                                            self._delay('device_count'))
+            return ''
+        if command == ['0xca', '0x00']:
+            self.commands['get_cd_enabled'] += 1
+            return ' %02x\n' % int(self.cd_enabled.get())
+        if command == ['0xcb', '0x00']:
+            self.commands['set_cd_enabled'] += 1
+            self.cd_enabled.set(bool(int(args[2], 16)), self._delay('toggle'))
+            return ''
+        if command[0] == '0x9f':
+            return self._ris(args[1:])
+        if command == ['0xd8', '0x00']:
+            self.commands['get_image_count'] += 1
+            return ' 01 %02x\n' % self.images_available.get()
+        if command == ['0xd7', '0x01']:
+            self.commands['set_image'] += 1
+            if not self.images_available.get():
+                return None
+            self._start_mount(_decode(args[5:]))
+            return ''
+        if command == ['0xd7', '0x00']:
+            self.commands['stop_redirection'] += 1
+            if int(args[5], 16) == 0:
+                self.image = None
+                self.mount = _Delayed(None)
+            return ''
+        if command == ['0xd8', '0x06']:
+            self.commands['get_mounted_image'] += 1
+            status = self._mount_status()
+            if status == 'nfserror':
+                return None
+            name = self.image if status == 'mounted' else ''
+            data = bytearray(name.encode('utf-8')).ljust(_NAME_LENGTH, b'\0')
+            return ' %s\n' % ' '.join('%02x' % byte for byte in data)
+        return ''
+
+    def _ris(self, args):
+        if args[:2] == ['0x01', '0x0d']:
+            self.commands['clear_ris'] += 1
+            self.ris = {}
+            self.progress_bit = False
+            return ''
+        if args[:2] == ['0x01', '0x05']:
+            self.commands['set_share_type'] += 1
+            self.ris['share_type'] = _decode(args[3:])
+            return ''
+        if args[:2] == ['0x01', '0x02']:
+            self.commands['set_server'] += 1
+            self.ris['server'] = _decode(args[3:])
+            return ''
+        if args[:3] == ['0x01', '0x01', '0x00']:
+            self.commands['set_progress_bit'] += 1
+            value = bool(int(args[3], 16))
+            if value and self.progress_bit:
+                # Setting an already set progress bit fails.
+                return None
+            self.progress_bit = value
+            return ''
+        if args[:3] == ['0x01', '0x01', '0x01']:
+            self.commands['set_path'] += 1
+            if not self.progress_bit:
+                return None
+            self.ris['path'] = _decode(args[3:])
+            return ''
+        if args[:3] == ['0x01', '0x0b', '0x01']:
+            self.commands['restart_ris_cd'] += 1
+            self._reset_media()
+            if (self.ris.get('share_type') == 'nfs' and self.ris.get('server')
+                    and self.ris.get('path') and not self.progress_bit):
+                self.images_available.set(self.images_on_share,
+                                          self._delay('ris_restart') +
+                                          self._delay('image_scan'))
+            return ''
+        if args[:2] == ['0x08', '0x0b']:
+            self.commands['restart_ris'] += 1
+            self._reset_media()
+            return ''
+        return ''
+
+    # HW17 NFS commands, 0x3c
+
+    def _nfs(self, args):
+        command = int(args[0], 16)
+        if command == 0x00:
+            self.commands['nfs_stop'] += 1
+            self.ris = {}
+            self._reset_media()
+            return ''
+        if command == 0x01:
+            self.commands['nfs_configure'] += 1
+            self.ris[{0: 'server', 1: 'path', 2: 'image'}.get(
+                int(args[1], 16), args[1])] = _decode(args[2:])
+            return ''
+        if command == 0x02:
+            self.commands['nfs_start'] += 1
+            if not all(self.ris.get(key) for key in ('server', 'path',
+                                                     'image')):
+                return None
+            self._start_mount(self.ris['image'])
+            return ''
+        if command == 0x03:
+            self.commands['nfs_status'] += 1
+            return {'mounting': ' 64\n', 'mounted': ' 00\n',
+                    'nfserror': ' 20\n'}.get(self._mount_status(), ' 01\n')
+        return ''
+
+    def _answer(self, args):
+        """Returns the output of a raw command, None if it fails."""
+        if args[:1] == ['0x32']:
+            return self._oem(args[1:])
+        if args[:1] == ['0x3c']:
+            return self._nfs(args[1:])
+        self.commands['other_raw'] += 1
+        return ''
+
+    def _reachable(self):
+        return time.time() >= self._unreachable_until
+
+    def send_raw(self, raw_bytes):
+        """Answers ipmitool.send_raw.
+
+        :raises: IPMIFailure, as ipmitool, if the command fails.
+        """
+        self.log.record(self.address, 'ipmi')
+        self.latency.wait()
+        with self._lock:
+            out = None
+            if self._reachable() and not self._chance('command'):
+                out = self._answer(raw_bytes.lower().split())
+        if out is None:
+            raise exception.IPMIFailure(cmd=raw_bytes)
+        return out, ''
+
+    def execute(self, command):
+        """Answers ipmitool._exec_ipmitool.
+
+        :raises: ProcessExecutionError, as processutils, if it fails.
+        """
+        self.log.record(self.address, 'ipmi')
+        self.latency.wait()
+        with self._lock:
+            if not self._reachable() or self._chance('command'):
+                raise processutils.ProcessExecutionError(
+                    exit_code=1, cmd=command,
+                    stderr='Unable to establish IPMI v2 / RMCP+ session')
+            if command == 'bmc reset cold':
+                self.commands['bmc_reset'] += 1
+                self._unreachable_until = (time.time() +
+                                           self._delay('bmc_reset'))
+                self.service_running = _Delayed(False)
+                if self.service_enabled:
+                    self.service_running.set(True, self._delay('bmc_reset'))
+                self._reset_media()
+                return 'Sent cold reset command to MC\n', ''
+            self.commands['ipmitool_%s' % '_'.join(command.split()[:2])] += 1
+            return '', ''
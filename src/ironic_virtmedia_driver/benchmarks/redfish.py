@@ -0,0 +1,149 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Measures the Redfish round trips of the DELL and HP virtual media flows.
+
+The vendor classes attach and detach a virtual CD through the real
+Redfish client, against a local HTTPS redfish_bmc per BMC kind and
+latency profile. The requests per attach and detach, by method, and the
+wall time of each are reported.
+
+Usage: python -m ironic_virtmedia_driver.benchmarks.redfish
+    [--kinds idrac,ilo4,ilo5] [--latency PROFILE]... [--iterations N]
+    [--output FILE]
+"""
+
+import argparse
+import collections
+import shutil
+import tempfile
+import time
+
+from ironic_virtmedia_driver.benchmarks import common
+from ironic_virtmedia_driver.benchmarks import fakes
+from ironic_virtmedia_driver.benchmarks import fleet
+from ironic_virtmedia_driver.benchmarks import redfish_bmc
+from ironic_virtmedia_driver import virtmedia_ipmi_boot
+
+# BMC kind: (vendor, product_family)
+VENDORS = {
+    'idrac': ('dell', 'DELL'),
+    'ilo4': ('hp', 'HP'),
+    'ilo5': ('hp', 'HP'),
+}
+
+IMAGE = 'deploy-bench-node-0.iso'
+
+
+def _measure(server, call, samples, requests, errors):
+    first = server.request_count()
+    start = time.time()
+    try:
+        call()
+    except Exception as e:
+        errors.append(str(e))
+        return
+    samples.append(time.time() - start)
+    requests.append(server.requests_since(first))
+
+
+def _summarize_requests(per_call):
+    methods = collections.Counter()
+    for call_requests in per_call:
+        methods.update(request['method'] for request in call_requests)
+    calls = len(per_call) or 1
+    return {'requests_per_call': float(sum(methods.values())) / calls,
+            'methods_per_call': dict((method, float(count) / calls)
+                                     for method, count in methods.items())}
+
+
+def run_kind(kind, latency_spec, iterations, certfile, keyfile):
+    vendor, product_family = VENDORS[kind]
+    results = {'vendor': vendor, 'product_family': product_family}
+    server = redfish_bmc.start_bmc(kind, fakes.LatencyProfile(latency_spec),
+                                   certfile=certfile, keyfile=keyfile)
+    try:
+        node = fleet.FakeNode(0, vendor, product_family)
+        task = fleet.FakeTask(node)
+        driver_info = {'address': server.address, 'username': 'admin',
+                       'password': 'password',
+                       'provisioning_server': '192.0.2.1',
+                       'provisioning_server_http_port': '80',
+                       'vendor': vendor, 'product_family': product_family}
+        try:
+            hw = virtmedia_ipmi_boot._get_hw_library(driver_info)
+        except Exception as e:
+            results['error'] = 'Cannot load the vendor code: %s' % e
+            return results
+
+        samples = {'attach': [], 'detach': []}
+        requests = {'attach': [], 'detach': []}
+        errors = []
+        for _ in range(iterations):
+            _measure(server, lambda: hw.attach_virtual_cd(IMAGE, driver_info,
+                                                          task),
+                     samples['attach'], requests['attach'], errors)
+            _measure(server, lambda: hw.detach_virtual_cd(driver_info, task),
+                     samples['detach'], requests['detach'], errors)
+        for operation in ('attach', 'detach'):
+            results[operation] = common.summarize(samples[operation])
+            results[operation].update(_summarize_requests(
+                requests[operation]))
+        results['errors'] = len(errors)
+        results['error_samples'] = errors[:5]
+        results['request_log'] = requests['attach'][:1] + \
+            requests['detach'][:1]
+    finally:
+        server.stop()
+    return results
+
+
+def run(kinds, latency_specs, iterations):
+    results = {'iterations': iterations, 'profiles': {}}
+    cert_dir = tempfile.mkdtemp(prefix='virtmedia-bench-bmc-')
+    try:
+        certfile, keyfile = redfish_bmc.create_self_signed_cert(cert_dir)
+        for latency_spec in latency_specs:
+            results['profiles'][latency_spec] = dict(
+                (kind, run_kind(kind, latency_spec, iterations, certfile,
+                                keyfile))
+                for kind in kinds)
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kinds', default=','.join(redfish_bmc.KINDS))
+    parser.add_argument('--latency', action='append',
+                        help="BMC response times, can be repeated: "
+                             "'constant:MS', 'uniform:LOW,HIGH' or "
+                             "'lognormal:MEDIAN,SIGMA'")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--output', help='JSON output file')
+    args = parser.parse_args()
+
+    kinds = [kind.strip() for kind in args.kinds.split(',') if kind]
+    unknown = set(kinds) - set(VENDORS)
+    if unknown:
+        parser.error('Unknown BMC kinds: %s' % ', '.join(sorted(unknown)))
+    common.write_results(run(kinds, args.latency or ['constant:0',
+                                                     'lognormal:50,0.5'],
+                             args.iterations), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Local Redfish BMC for the Dell iDRAC and HP iLO virtual media flows.
+
+A FakeRedfishBMC resource tree (iDRAC, iLO 4 for gen9, iLO 5 for gen10)
+is served over HTTP, or HTTPS with a self-signed certificate when none is
+given, so the vendor classes can talk to it with the real Redfish client.
+Every request is answered after a delay drawn from the latency profile
+and logged.
+
+Usage: python -m ironic_virtmedia_driver.benchmarks.redfish_bmc
+    [--kind idrac|ilo4|ilo5] [--host HOST] [--port N] [--latency PROFILE]
+    [--http] [--certfile FILE --keyfile FILE]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+from oslo_concurrency import processutils
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from ironic_virtmedia_driver.benchmarks import fakes
+
+KINDS = ('idrac', 'ilo4', 'ilo5')
+
+
+class RedfishRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'fake-redfish-bmc'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        data = self.rfile.read(length)
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def _handle(self):
+        start = time.time()
+        body = self._read_body()
+        response = self.server.bmc.handle(self.command, self.path, body)
+        # Logged before answering, so a client never sees its request
+        # missing from the log.
+        self.server.record(self.command, self.path, response.status,
+                           time.time() - start)
+        data = b''
+        if response.status != 204:
+            data = response.text.encode('utf-8')
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data and self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_GET = do_HEAD = do_POST = do_PATCH = do_DELETE = _handle
+
+
+class FakeRedfishServer(socketserver.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    """Threaded server of a FakeRedfishBMC, logging the requests.
+
+    :param address: a (host, port) tuple, port 0 for any free port.
+    :param bmc: the FakeRedfishBMC to serve.
+    :param certfile: certificate to serve HTTPS with, None for HTTP.
+    :param keyfile: private key of the certificate.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, bmc, certfile=None, keyfile=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           RedfishRequestHandler)
+        self.bmc = bmc
+        self.scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            # The handshakes happen in the request threads, not on accept.
+            self.socket = context.wrap_socket(self.socket, server_side=True,
+                                              do_handshake_on_connect=False)
+            self.scheme = 'https'
+        self._lock = threading.Lock()
+        self.requests = []
+        self._thread = None
+
+    @property
+    def address(self):
+        """The host:port of the BMC, as set in driver_info."""
+        return '%s:%d' % self.server_address[:2]
+
+    def record(self, method, path, status, seconds):
+        with self._lock:
+            self.requests.append({'method': method, 'path': path,
+                                  'status': status, 'seconds': seconds})
+
+    def request_count(self):
+        with self._lock:
+            return len(self.requests)
+
+    def requests_since(self, index):
+        with self._lock:
+            return list(self.requests[index:])
+
+    def start(self):
+        """Serves in a daemon thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def create_self_signed_cert(directory):
+    """Creates a self-signed certificate for localhost with openssl.
+
+    :returns: a (certfile, keyfile) tuple.
+    """
+    certfile = os.path.join(directory, 'bmc.crt')
+    keyfile = os.path.join(directory, 'bmc.key')
+    processutils.execute('openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                         '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                         '-keyout', keyfile, '-out', certfile)
+    return certfile, keyfile
+
+
+def start_bmc(kind, latency, log=None, host='127.0.0.1', port=0,
+              certfile=None, keyfile=None):
+    """Starts serving a fake BMC.
+
+    :param kind: one of KINDS.
+    :param latency: a LatencyProfile.
+    :param log: a RequestLog shared with other BMCs.
+    :returns: the running FakeRedfishServer.
+    """
+    server = FakeRedfishServer((host, port), None, certfile, keyfile)
+    server.bmc = fakes.FakeRedfishBMC(server.address, kind, latency,
+                                      log or fakes.RequestLog())
+    return server.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kind', choices=KINDS, default='idrac')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--latency', default='constant:0')
+    parser.add_argument('--http', action='store_true',
+                        help='serve HTTP instead of HTTPS')
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args()
+
+    cert_dir = None
+    certfile, keyfile = args.certfile, args.keyfile
+    if not args.http and not certfile:
+        cert_dir = tempfile.mkdtemp(prefix='fake-redfish-bmc-')
+        certfile, keyfile = create_self_signed_cert(cert_dir)
+    server = start_bmc(args.kind, fakes.LatencyProfile(args.latency),
+                       host=args.host, port=args.port,
+                       certfile=None if args.http else certfile,
+                       keyfile=keyfile)
+    sys.stdout.write('Serving a fake %s on %s://%s\n' % (
+        args.kind, server.scheme, server.address))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        if cert_dir:
+            shutil.rmtree(cert_dir, ignore_errors=True)
+        for request in server.requests:
+            sys.stdout.write('%(method)s %(path)s %(status)d '
+                             '%(seconds).3f\n' % request)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Micro-benchmarks of the share file preparation pipeline.
+
+Each stage runs for a number of nodes at once, in every directory given
+(e.g. a tmpfs and a disk), for every ISO size and concurrency level:
+
+* floppy: _prepare_floppy_image;
+* append_dd: the former tar.gz plus dd append, for comparison;
+* append: _append_floppy_to_cd;
+* node_iso: _prepare_node_iso, cloning the base ISO and appending;
+* remaster: _add_params_to_cd, adding the parameters to the ISO9660
+  file system of the clone instead;
+* remove: _remove_share_file of a per-node ISO;
+* fetch: image_cache.fetch of the base ISO from a local HTTP server.
+
+For each batch the wall time of the calls, the bytes written, the read
+and write system calls (from /proc/self/io), the processes started and
+the fsync and syncfs calls are recorded.
+
+Usage: python -m ironic_virtmedia_driver.benchmarks.share
+    [--dirs DIR,...] [--iso-mb N,...] [--concurrency N,...]
+    [--stages STAGE,...] [--iterations N] [--fsync] [--sparse]
+    [--output FILE]
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import futurist
+from futurist import waiters
+
+from ironic_virtmedia_driver.benchmarks import append
+from ironic_virtmedia_driver.benchmarks import common
+from ironic_virtmedia_driver.benchmarks import fleet
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver import image_server
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver import virtmedia
+
+mock = fleet.mock
+
+STAGES = ('floppy', 'append_dd', 'append', 'node_iso', 'remaster', 'remove',
+          'fetch')
+
+BASE_ISO = 'bench-base.iso'
+
+PARAMS = {'BOOTIF': '52:54:00:12:34:56',
+          'os_net_config': '{"network_config": []}',
+          'ipa-api-url': 'http://192.0.2.1:6385'}
+
+_IO_FIELDS = ('wchar', 'write_bytes', 'syscr', 'syscw')
+
+
+def _read_io():
+    """Returns the I/O counters of the process, empty if unavailable."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                name, _sep, value = line.partition(':')
+                if name in _IO_FIELDS:
+                    counters[name] = int(value)
+    except IOError:
+        pass
+    return counters
+
+
+def _fs_type(path):
+    """Returns the type of the file system holding path, e.g. tmpfs."""
+    path = os.path.realpath(path)
+    best = ('', 'unknown')
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                mount_point = fields[1]
+                if ((path == mount_point or path.startswith(
+                        mount_point.rstrip('/') + '/')) and
+                        len(mount_point) >= len(best[0])):
+                    best = (mount_point, fields[2])
+    except IOError:
+        pass
+    return best[1]
+
+
+class SyncCounter(object):
+    """Counts the fsync, fdatasync and syncfs calls."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _wrap(self, function):
+        def wrapper(*args):
+            with self._lock:
+                self.count += 1
+            return function(*args)
+        return wrapper
+
+    def patches(self):
+        patches = [mock.patch.object(os, 'fsync', self._wrap(os.fsync))]
+        if hasattr(os, 'fdatasync'):
+            patches.append(mock.patch.object(os, 'fdatasync',
+                                             self._wrap(os.fdatasync)))
+        if share_utils._SYNCFS is not None:
+            patches.append(mock.patch.object(
+                share_utils, '_SYNCFS', self._wrap(share_utils._SYNCFS)))
+        return patches
+
+
+def _serve(root, queue):
+    server = image_server.create_server(root, '127.0.0.1', 0)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _start_image_server(root):
+    """Serves root over HTTP from a child process.
+
+    The sends of the server would otherwise be counted with the writes of
+    the fetch.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(root, queue))
+    process.daemon = True
+    process.start()
+    return process, queue.get(timeout=30)
+
+
+class Pipeline(object):
+    """The stages, as a setup not measured and a measured call."""
+
+    def __init__(self, root, port):
+        self.root = root
+        self.port = port
+        self._fetches = 0
+        self._lock = threading.Lock()
+
+    def _path(self, filename):
+        return os.path.join(self.root, filename)
+
+    def _node_files(self, task):
+        floppy = virtmedia._prepare_floppy_image(task, PARAMS)
+        iso = virtmedia._get_deploy_iso_name(task.node)
+        share_utils.clone_file(self._path(BASE_ISO), self._path(iso))
+        return iso, floppy
+
+    def setup(self, stage, task):
+        if stage in ('append_dd', 'append', 'remaster'):
+            return self._node_files(task)
+        if stage == 'node_iso':
+            return (virtmedia._prepare_floppy_image(task, PARAMS),)
+        if stage == 'remove':
+            floppy = virtmedia._prepare_floppy_image(task, PARAMS)
+            return (virtmedia._prepare_node_iso(task, BASE_ISO, floppy),)
+        if stage == 'fetch':
+            with self._lock:
+                self._fetches += 1
+                # A new href each time, so that it is not a cache hit.
+                return ('http://127.0.0.1:%d%s%s?bench=%d' % (
+                    self.port, CONF.virtmedia_image_server_prefix, BASE_ISO,
+                    self._fetches),)
+        return ()
+
+    def call(self, stage, task, *args):
+        if stage == 'floppy':
+            virtmedia._prepare_floppy_image(task, PARAMS)
+        elif stage == 'append_dd':
+            append._legacy_append(self.root, args[0], args[1])
+        elif stage == 'append':
+            virtmedia._append_floppy_to_cd(args[0], args[1])
+        elif stage == 'remaster':
+            virtmedia._add_params_to_cd(args[0], args[1], PARAMS)
+        elif stage == 'node_iso':
+            virtmedia._prepare_node_iso(task, BASE_ISO, args[0])
+        elif stage == 'remove':
+            virtmedia._remove_share_file(args[0])
+        elif stage == 'fetch':
+            image_cache.fetch(None, args[0])
+
+    def cleanup(self):
+        """Removes all the files but the base ISO."""
+        for name in os.listdir(self.root):
+            if name != BASE_ISO and os.path.isfile(self._path(name)):
+                os.remove(self._path(name))
+        cache_root = image_cache._cache_root()
+        if os.path.isdir(cache_root):
+            for name in os.listdir(cache_root):
+                os.remove(os.path.join(cache_root, name))
+
+
+def _run_batch(pipeline, stage, tasks, pool):
+    """Runs a stage for all the tasks at once, returns what it cost."""
+    args = dict((task.node.uuid, pipeline.setup(stage, task))
+                for task in tasks)
+    latencies = []
+    lock = threading.Lock()
+
+    def _call(task):
+        start = time.time()
+        pipeline.call(stage, task, *args[task.node.uuid])
+        with lock:
+            latencies.append(time.time() - start)
+
+    syncs = SyncCounter()
+    subprocesses = fleet.SubprocessCounter()
+    patches = syncs.patches() + [subprocesses.patch()]
+    for patch in patches:
+        patch.start()
+    try:
+        io_before = _read_io()
+        start = time.time()
+        futures = [pool.submit(_call, task) for task in tasks]
+        waiters.wait_for_all(futures)
+        wall_time = time.time() - start
+        io_after = _read_io()
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+    for future in futures:
+        # Raises the first failure.
+        future.result()
+    cost = dict((name, io_after[name] - io_before[name])
+                for name in io_after)
+    cost.update(latencies=latencies, wall_time=wall_time,
+                subprocesses=subprocesses.count, syncs=syncs.count)
+    return cost
+
+
+def _summarize(costs, nodes):
+    latencies = []
+    for cost in costs:
+        latencies.extend(cost.pop('latencies'))
+    result = common.summarize(latencies)
+    batches = len(costs) or 1
+    for name in sorted(set(name for cost in costs for name in cost)):
+        total = sum(cost.get(name, 0) for cost in costs)
+        result['%s_per_batch' % name] = float(total) / batches
+        if name != 'wall_time':
+            result['%s_per_node' % name] = float(total) / (batches * nodes)
+    return result
+
+
+def run_directory(base_dir, iso_sizes, concurrency_levels, stages,
+                  iterations, dense=True):
+    results = {'fs_type': _fs_type(base_dir), 'sizes': {}}
+    with common.share_root(base_dir) as root:
+        server, port = _start_image_server(root)
+        pool = futurist.ThreadPoolExecutor(max_workers=max(
+            concurrency_levels))
+        try:
+            pipeline = Pipeline(root, port)
+            for iso_size in iso_sizes:
+                common.make_iso(os.path.join(root, BASE_ISO), iso_size,
+                                dense)
+                size_results = results['sizes'][str(iso_size)] = {}
+                for concurrency in concurrency_levels:
+                    tasks = [fleet.FakeTask(fleet.FakeNode(index, 'nokia',
+                                                           'RM18'))
+                             for index in range(concurrency)]
+                    level_results = size_results[str(concurrency)] = {}
+                    for stage in stages:
+                        costs = []
+                        for _ in range(iterations):
+                            costs.append(_run_batch(pipeline, stage, tasks,
+                                                    pool))
+                            pipeline.cleanup()
+                        level_results[stage] = _summarize(costs, concurrency)
+        finally:
+            pool.shutdown()
+            server.terminate()
+    return results
+
+
+def run(dirs, iso_sizes, concurrency_levels, stages, iterations,
+        dense=True):
+    results = {'iso_sizes': iso_sizes, 'concurrency': concurrency_levels,
+               'iterations': iterations, 'dense': dense,
+               'fsync': CONF.virtmedia_fsync_share_files, 'dirs': {}}
+    for base_dir in dirs:
+        results['dirs'][base_dir] = run_directory(
+            base_dir, iso_sizes, concurrency_levels, stages, iterations,
+            dense)
+    return results
+
+
+def _default_dirs():
+    dirs = [tempfile.gettempdir()]
+    if os.path.isdir('/dev/shm'):
+        dirs.insert(0, '/dev/shm')
+    return ','.join(dirs)
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dirs', default=_default_dirs(),
+                        help='directories to run in, e.g. a tmpfs and a '
+                             'disk')
+    parser.add_argument('--iso-mb', type=_int_list, default=[16, 64, 256])
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 8, 32])
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--fsync', action='store_true')
+    parser.add_argument('--sparse', action='store_true',
+                        help='sparse base ISOs, only the first MiB written')
+    parser.add_argument('--output', help='JSON output file')
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error('Unknown stages: %s' % ', '.join(sorted(unknown)))
+    CONF.set_override('virtmedia_fsync_share_files', args.fsync)
+    common.write_results(run([path for path in args.dirs.split(',') if path],
+                             [size * 1024 * 1024 for size in args.iso_mb],
+                             args.concurrency, stages, args.iterations,
+                             not args.sparse), args.output)
+
+
+if __name__ == '__main__':
+    main()
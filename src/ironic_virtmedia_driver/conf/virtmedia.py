@@ -21,6 +21,242 @@ opts = [
     cfg.StrOpt('remote_image_share_root',
                default='/remote_image_share_root',
                help=_('Ironic conductor node\'s "NFS" root path')),
+    cfg.BoolOpt('virtmedia_deploy_iso_cache',
+                default=True,
+                help=_('Whether deploy ISOs given as a Glance UUID or '
+                       'an HTTP(S) URL are downloaded once into a shared '
+                       'cache under remote_image_share_root and hardlinked '
+                       'to the per-node file names.')),
+    cfg.IntOpt('virtmedia_deploy_iso_cache_timeout',
+               default=60,
+               min=1,
+               help=_('Timeout in seconds for the HTTP requests made when '
+                      'revalidating or downloading a cached deploy ISO.')),
+    cfg.IntOpt('virtmedia_deploy_iso_download_connections',
+               default=4,
+               min=1,
+               help=_('Number of connections an HTTP(S) deploy ISO is '
+                      'downloaded over, in byte ranges, when the server '
+                      'accepts range requests. 1 downloads it in a single '
+                      'stream.')),
+    cfg.IntOpt('virtmedia_deploy_iso_download_segment_mb',
+               default=32,
+               min=1,
+               help=_('Minimum size in MiB of the byte ranges a deploy ISO '
+                      'is downloaded in. Smaller images are downloaded in '
+                      'a single stream.')),
+    cfg.BoolOpt('virtmedia_fsync_share_files',
+                default=False,
+                help=_('Whether the images written to remote_image_share_root '
+                       'are fsynced before they are handed to the BMC.')),
+    cfg.BoolOpt('virtmedia_reuse_node_images',
+                default=False,
+                help=_('Whether the per-node floppy image and deploy ISO are '
+                       'kept after use and reused by the next deploy or '
+                       'clean of the node when its ramdisk parameters and '
+                       'the base deploy ISO have not changed.')),
+    cfg.IntOpt('virtmedia_bulk_share_workers',
+               default=8,
+               min=1,
+               help=_('Number of workers building share images when '
+                      'preparing the ramdisk of many nodes at once.')),
+    cfg.IntOpt('virtmedia_bulk_bmc_workers',
+               default=32,
+               min=1,
+               help=_('Number of workers talking to BMCs when preparing or '
+                      'cleaning up the ramdisk of many nodes at once.')),
+    cfg.IntOpt('virtmedia_share_quota_bytes',
+               default=0,
+               min=0,
+               help=_('Maximum number of bytes used by the files in '
+                      'remote_image_share_root. Cached deploy ISOs and the '
+                      'images of idle nodes are evicted, least recently '
+                      'used first, to stay under it. 0 means no quota.')),
+    cfg.IntOpt('virtmedia_share_min_free_bytes',
+               default=0,
+               min=0,
+               help=_('Minimum free space in remote_image_share_root for '
+                      'the ramdisk of a node to be prepared. 0 disables '
+                      'the check.')),
+    cfg.IntOpt('virtmedia_share_gc_interval',
+               default=0,
+               min=0,
+               help=_('Interval in seconds between garbage collections of '
+                      'remote_image_share_root. 0 disables the periodic '
+                      'task.')),
+    cfg.IntOpt('virtmedia_share_gc_grace',
+               default=3600,
+               min=0,
+               help=_('Age in seconds after which temporary files left in '
+                      'remote_image_share_root are removed.')),
+    cfg.BoolOpt('virtmedia_profiling_enabled',
+                default=False,
+                help=_('Profile the boot interface and vendor hardware '
+                       'calls of a sampled fraction of the calls, and of '
+                       'the nodes with virtmedia_profile set in their '
+                       'driver_info. When disabled the calls are not '
+                       'wrapped at all.')),
+    cfg.FloatOpt('virtmedia_profiling_sample_rate',
+                 default=0.0,
+                 min=0.0,
+                 max=1.0,
+                 help=_('Fraction of the calls profiled when '
+                        'virtmedia_profiling_enabled is set.')),
+    cfg.StrOpt('virtmedia_profiling_dir',
+               default='/var/log/ironic/virtmedia-profiles',
+               help=_('Directory receiving a subdirectory of cProfile and '
+                      'tracemalloc dumps per node.')),
+    cfg.IntOpt('virtmedia_profiling_max_bytes',
+               default=50 * 1024 * 1024,
+               min=0,
+               help=_('Maximum size of the profiling dumps of a node, the '
+                      'oldest dumps are removed above it.')),
+    cfg.IntOpt('virtmedia_profiling_traceback_frames',
+               default=1,
+               min=1,
+               help=_('Number of frames stored per traced memory '
+                      'allocation.')),
+    cfg.BoolOpt('virtmedia_reconcile_media_state',
+                default=False,
+                help=_('Record the state of the virtual media devices of '
+                       'the nodes and skip the BMC detach and attach '
+                       'operations that would not change it. The state is '
+                       'saved once per operation and only trusted by the '
+                       'conductor process that recorded it. Disable if '
+                       'the media of the nodes are also changed outside of '
+                       'ironic.')),
+    cfg.BoolOpt('virtmedia_share_index',
+                default=False,
+                help=_('Answer the existence checks of validate() on the '
+                       'files of remote_image_share_root from an in-memory '
+                       'index kept current with inotify.')),
+    cfg.IntOpt('virtmedia_share_index_rescan_interval',
+               default=300,
+               min=0,
+               help=_('Interval in seconds between full rescans of the '
+                      'share index, picking up the changes inotify does '
+                      'not see, like the ones made by other hosts of a '
+                      'network share. 0 rescans on every query.')),
+    cfg.IntOpt('virtmedia_share_index_entry_ttl',
+               default=10,
+               min=0,
+               help=_('Seconds a file found in the share index is trusted '
+                      'before it is checked on the share again, as inotify '
+                      'does not see the files removed by other hosts of a '
+                      'network share. 0 checks it on every query.')),
+    cfg.StrOpt('virtmedia_image_server_host',
+               default='0.0.0.0',
+               help=_('Address the virtmedia-image-server listens on.')),
+    cfg.PortOpt('virtmedia_image_server_port',
+                default=80,
+                help=_('Port the virtmedia-image-server listens on, the '
+                       'provisioning_server_http_port of the nodes.')),
+    cfg.StrOpt('virtmedia_image_server_prefix',
+               default='/bootimages/',
+               help=_('URL path under which virtmedia-image-server serves '
+                      'remote_image_share_root.')),
+    cfg.IntOpt('virtmedia_image_server_max_connections_per_client',
+               default=8,
+               min=0,
+               help=_('Maximum number of concurrent connections of a '
+                      'client to virtmedia-image-server, 0 for no limit.')),
+    cfg.IntOpt('virtmedia_image_server_keepalive_timeout',
+               default=30,
+               min=1,
+               help=_('Seconds after which virtmedia-image-server closes '
+                      'an idle connection.')),
+    cfg.BoolOpt('virtmedia_image_server_stats',
+                default=False,
+                help=_('Whether virtmedia-image-server serves the bytes '
+                       'sent per node and per file as JSON on /_stats. '
+                       'The statistics are served without '
+                       'authentication.')),
+    cfg.BoolOpt('virtmedia_page_cache_warm',
+                default=False,
+                help=_('Read the base deploy ISOs in use into the page '
+                       'cache ahead of the BMCs, and keep them there.')),
+    cfg.BoolOpt('virtmedia_page_cache_drop_node_images',
+                default=True,
+                help=_('Drop the per-node images from the page cache once '
+                       'written, so they do not evict the deploy ISOs.')),
+    cfg.IntOpt('virtmedia_page_cache_report_interval',
+               default=300,
+               min=0,
+               help=_('Interval in seconds between the reports of the page '
+                      'cache residency of the deploy ISOs in use, which '
+                      'also warms them again, with '
+                      'virtmedia_page_cache_warm. 0 disables it.')),
+    cfg.StrOpt('virtmedia_cd_params_format',
+               default='append',
+               choices=['append', 'iso9660'],
+               help=_('How the parameters are passed on the per-node CD. '
+                      '"append" appends the floppy image to the ISO as a '
+                      'tar archive. "iso9660" adds them to the ISO9660 '
+                      'file system as /virtmedia/params, in the format of '
+                      'parameters.txt, for ramdisks reading it from the '
+                      'mounted CD. The "iso9660" images cannot be read by '
+                      'libarchive or bsdtar, only mounted or read by '
+                      'readers seeking to the new directories.')),
+    cfg.BoolOpt('virtmedia_cd_params_include_floppy',
+                default=True,
+                help=_('With the "iso9660" virtmedia_cd_params_format, '
+                       'also add the floppy image to the CD as '
+                       '/virtmedia/floppy.img.')),
+    cfg.IntOpt('virtmedia_provisioning_server_health_ttl',
+               default=30,
+               min=0,
+               help=_('Seconds the result of a reachability probe of a '
+                      'provisioning server of a pool is trusted.')),
+    cfg.FloatOpt('virtmedia_provisioning_server_probe_timeout',
+                 default=2.0,
+                 min=0.1,
+                 help=_('Timeout in seconds of the reachability probes of '
+                        'the provisioning servers of a pool.')),
+    cfg.IntOpt('virtmedia_provisioning_server_failure_backoff',
+               default=300,
+               min=0,
+               help=_('Seconds a provisioning server of a pool is avoided '
+                      'after attaching virtual media through it failed.')),
+    cfg.StrOpt('virtmedia_params_delivery',
+               default='media',
+               choices=['media', 'http'],
+               help=_('How the parameters reach the deploy ramdisk. '
+                      '"media" puts them in a per-node floppy image and '
+                      'ISO. "http" has all the nodes boot the deploy ISO '
+                      'unmodified, the ramdisk fetching its parameters '
+                      'from the conductor by MAC or node UUID, see '
+                      'virtmedia_params_server_port.')),
+    cfg.StrOpt('virtmedia_params_server_host',
+               help=_('Address the conductor serves the ramdisk '
+                      'parameters on, with the "http" '
+                      'virtmedia_params_delivery. Defaults to the my_ip '
+                      'of the conductor. The parameters are served without '
+                      'authentication to whoever knows a MAC of the node, '
+                      'so avoid addresses reachable from outside the '
+                      'provisioning network, like 0.0.0.0.')),
+    cfg.PortOpt('virtmedia_params_server_port',
+                default=8089,
+                help=_('Port the conductor serves the ramdisk parameters '
+                       'on, under /v1/params/<MAC or node UUID>, with the '
+                       '"http" virtmedia_params_delivery.')),
+    cfg.StrOpt('virtmedia_share_layout',
+               default='flat',
+               choices=['flat', 'hashed', 'node'],
+               help=_('Where the per-node files are put in '
+                      'remote_image_share_root. "flat" puts them at the '
+                      'top of the share. "hashed" puts them in 256 '
+                      'directories, nodes/<xx>, by a hash of the node '
+                      'UUID. "node" puts them in nodes/<node UUID>; the '
+                      'NFS path of the Nokia BMCs is limited to 64 '
+                      'characters, which the node directory exceeds with '
+                      'the default remote_share, so use "hashed" with '
+                      'them. Run virtmedia-share-migrate after changing '
+                      'it.')),
+    cfg.BoolOpt('virtmedia_share_layout_compat',
+                default=True,
+                help=_('Whether the per-node files of a node left in the '
+                       'other virtmedia_share_layout layouts are removed '
+                       'along with the current ones.')),
 ]
 
 
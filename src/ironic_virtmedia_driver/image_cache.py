@@ -0,0 +1,561 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Content-addressed cache for remote deploy ISOs.
+
+Deploy ISOs referenced by a Glance UUID or an HTTP(S) URL are downloaded
+once into CACHE_DIR under remote_image_share_root. Each cache entry is
+named after the href and a validator of its content (the Glance checksum,
+or the ETag / Last-Modified of the HTTP resource), so a changed image gets
+a new entry instead of overwriting the one nodes may still be reading.
+The superseded entries are left to share_gc, which removes them once no
+per-node ISO links to them anymore.
+
+Downloads are hashed while they are written and checked against the
+checksum Glance publishes for the image. The digests are kept in a
+<file>.digest sidecar, trusted as long as the file is not modified.
+
+Large HTTP(S) images are downloaded over several connections at once
+with byte range requests, when the server accepts them, each writing its
+part of a preallocated sparse file.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import futurist
+from futurist import waiters
+from ironic_lib import metrics_utils
+from ironic_lib import utils as ironic_utils
+from oslo_concurrency import lockutils
+from oslo_log import log as logging
+import requests
+
+from ironic.common import exception
+from ironic.common.glance_service import service_utils
+from ironic.common import image_service
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver import virtmedia_exception
+
+LOG = logging.getLogger(__name__)
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+CACHE_DIR = '.virtmedia-cache'
+
+DIGEST_SUFFIX = '.digest'
+
+_CHUNK_SIZE = 1024 * 1024
+
+_STATS = {'hits': 0, 'misses': 0, 'revalidations': 0}
+_STATS_LOCK = threading.Lock()
+
+
+def _count(name):
+    with _STATS_LOCK:
+        _STATS[name] += 1
+    METRICS.send_counter('VirtmediaImageCache.%s' % name, 1)
+
+
+def get_stats():
+    """Returns a copy of the cache hit/miss counters of this process."""
+    with _STATS_LOCK:
+        return dict(_STATS)
+
+
+def is_cacheable(image_href):
+    """Whether the deploy ISO href can be served from the cache."""
+    if not CONF.virtmedia_deploy_iso_cache:
+        return False
+    if service_utils.is_glance_image(image_href):
+        return True
+    return image_href.startswith(('http://', 'https://'))
+
+
+def _cache_root():
+    return os.path.join(CONF.remote_image_share_root, CACHE_DIR)
+
+
+def _digest(*parts):
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _meta_path(href_key):
+    return os.path.join(_cache_root(), '%s.json' % href_key)
+
+
+def _entry_path(href, validator):
+    return os.path.join(_cache_root(), '%s.iso' % _digest(href, validator))
+
+
+def _load_meta(href_key):
+    try:
+        with open(_meta_path(href_key)) as meta_file:
+            return json.load(meta_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_meta(href_key, meta):
+    with share_utils.atomic_path(_meta_path(href_key)) as tmp_path:
+        with open(tmp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+
+def _publish(tmp_path, entry_path):
+    os.chmod(tmp_path, 0o444)
+    share_utils.publish(tmp_path, entry_path)
+
+
+class _HashingFile(object):
+    """A file object hashing what is written to it.
+
+    When the expected size is known, writing more than that fails at
+    once instead of after the whole image was downloaded.
+    """
+
+    def __init__(self, image_file, image_href, algorithm, size=None):
+        self._file = image_file
+        self._image_href = image_href
+        self._size = size
+        self.name = image_file.name
+        self.written = 0
+        self.hashes = {'sha256': hashlib.sha256()}
+        if algorithm not in self.hashes:
+            self.hashes[algorithm] = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.written += len(data)
+        if self._size is not None and self.written > self._size:
+            raise virtmedia_exception.ImageChecksumMismatch(
+                image_href=self._image_href,
+                reason='more than the expected %d bytes' % self._size)
+        for content_hash in self.hashes.values():
+            content_hash.update(data)
+        self._file.write(data)
+
+    def rehash(self):
+        """Hashes the file again, when it was not written through write.
+
+        The file image service links or copies local files by name.
+        """
+        for name in self.hashes:
+            self.hashes[name] = hashlib.new(name)
+        self.written = 0
+        with open(self.name, 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(_CHUNK_SIZE), b''):
+                self.written += len(chunk)
+                for content_hash in self.hashes.values():
+                    content_hash.update(chunk)
+
+
+def get_expected_checksum(context, image_href):
+    """Returns the checksum the image service publishes for an image.
+
+    :param context: request context.
+    :param image_href: href of the image.
+    :returns: a dictionary with the hash 'algorithm', its hex 'digest'
+        and the 'size' of the image, or None when nothing is published,
+        which is the case for all but Glance images.
+    """
+    if not service_utils.is_glance_image(image_href):
+        return None
+    image_info = image_service.get_image_service(
+        image_href, context=context).show(image_href)
+    if image_info.get('os_hash_algo') and image_info.get('os_hash_value'):
+        algorithm = image_info['os_hash_algo']
+        digest = image_info['os_hash_value']
+    elif image_info.get('checksum'):
+        algorithm, digest = 'md5', image_info['checksum']
+    else:
+        return None
+    return {'algorithm': algorithm, 'digest': digest,
+            'size': image_info.get('size')}
+
+
+def _digest_path(path):
+    return path + DIGEST_SUFFIX
+
+
+def _file_identity(path):
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+
+def save_digest(path, digests):
+    """Writes the digests of a published file to its sidecar.
+
+    :param path: full path of the file.
+    :param digests: a dictionary mapping hash algorithms to hex digests.
+    """
+    with share_utils.atomic_path(_digest_path(path)) as tmp_path:
+        with open(tmp_path, 'w') as digest_file:
+            json.dump({'identity': _file_identity(path),
+                       'digests': digests}, digest_file)
+
+
+def get_trusted_digests(path):
+    """Returns the digests of a file recorded in its sidecar.
+
+    :param path: full path of the file.
+    :returns: a dictionary mapping hash algorithms to hex digests, empty
+        if there is no sidecar or the file changed since it was written.
+    """
+    try:
+        with open(_digest_path(path)) as digest_file:
+            sidecar = json.load(digest_file)
+        if sidecar['identity'] == _file_identity(path):
+            return sidecar['digests']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def matches_checksum(path, expected):
+    """Whether the sidecar of a file shows it has the expected checksum."""
+    return bool(expected) and get_trusted_digests(path).get(
+        expected['algorithm']) == expected['digest'].lower()
+
+
+def remove_digest(path):
+    ironic_utils.unlink_without_raise(_digest_path(path))
+
+
+def download(context, image_href, path, expected=None):
+    """Downloads an image, hashing it as it is written.
+
+    :param context: request context.
+    :param image_href: href of the image.
+    :param path: full path to download the image to.
+    :param expected: the checksum to verify, as returned by
+        get_expected_checksum, or None.
+    :returns: a dictionary mapping hash algorithms, sha256 and the one of
+        the expected checksum, to the hex digests of the image.
+    :raises: ImageChecksumMismatch, if the image is not what was expected.
+    :raises: ImageDownloadFailed, if downloading the image failed.
+    """
+    algorithm = expected['algorithm'] if expected else 'sha256'
+    service = image_service.get_image_service(image_href, context=context)
+    with open(path, 'wb') as image_file:
+        hashing_file = _HashingFile(image_file, image_href, algorithm,
+                                    expected and expected.get('size'))
+        service.download(image_href, hashing_file)
+    if hashing_file.written != os.path.getsize(path):
+        hashing_file.rehash()
+
+    digests = dict((name, content_hash.hexdigest())
+                   for name, content_hash in hashing_file.hashes.items())
+    if expected and digests[algorithm] != expected['digest'].lower():
+        raise virtmedia_exception.ImageChecksumMismatch(
+            image_href=image_href,
+            reason='%s digest %s, expected %s' % (
+                algorithm, digests[algorithm], expected['digest']))
+    return digests
+
+
+class _RangesNotSupported(Exception):
+    pass
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _hash_file(path):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _get_range_segments(response):
+    """Returns the byte ranges to download a response in, or None.
+
+    :param response: the response to the GET of the image, not consumed.
+    :returns: a list of (start, end) tuples, end being inclusive, or None
+        when the image is better downloaded in a single stream.
+    """
+    connections = CONF.virtmedia_deploy_iso_download_connections
+    segment_size = CONF.virtmedia_deploy_iso_download_segment_mb * 1024 * 1024
+    try:
+        size = int(response.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+    if (connections < 2 or not hasattr(os, 'pwrite') or
+            response.headers.get('Accept-Ranges', '').lower() != 'bytes' or
+            response.headers.get('Content-Encoding') or
+            size < 2 * segment_size):
+        return None
+    segment_size = max(segment_size, -(-size // connections))
+    return [(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)]
+
+
+def _download_range(href, fd, start, end, if_range, stop):
+    """Downloads bytes start to end of an image to the same offsets of fd.
+
+    :param stop: an Event set when a segment failed, and set if this one
+        does.
+    :raises: _RangesNotSupported, if the server does not answer with the
+        range.
+    """
+    try:
+        _download_range_to_fd(href, fd, start, end, if_range, stop)
+    except Exception:
+        stop.set()
+        raise
+
+
+def _download_range_to_fd(href, fd, start, end, if_range, stop):
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    if if_range:
+        headers['If-Range'] = if_range
+    response = requests.get(href, headers=headers, stream=True,
+                            timeout=CONF.virtmedia_deploy_iso_cache_timeout)
+    with response:
+        content_range = response.headers.get('Content-Range', '')
+        if (response.status_code != 206 or
+                content_range.split('/')[0] != 'bytes %d-%d' % (start, end)):
+            raise _RangesNotSupported(
+                'HTTP status %s, Content-Range %r' % (response.status_code,
+                                                      content_range))
+        offset = start
+        for chunk in response.iter_content(_CHUNK_SIZE):
+            if stop.is_set():
+                # Another segment failed.
+                return
+            if offset + len(chunk) > end + 1:
+                raise IOError('Range %d-%d is longer than expected' % (
+                    start, end))
+            _pwrite_all(fd, chunk, offset)
+            offset += len(chunk)
+        if offset != end + 1:
+            raise IOError('Range %d-%d ended after %d bytes' % (
+                start, end, offset - start))
+
+
+def _download_ranges(href, path, segments, if_range):
+    """Downloads the segments of an image in parallel into path.
+
+    The file is preallocated to the size of the image, sparse, and each
+    segment is written at its offset as it arrives.
+
+    :raises: _RangesNotSupported, if the server does not answer with the
+        ranges.
+    :raises: IOError, OSError or RequestException if the download failed.
+    """
+    stop = threading.Event()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, segments[-1][1] + 1)
+        pool = futurist.ThreadPoolExecutor(max_workers=min(
+            len(segments), CONF.virtmedia_deploy_iso_download_connections))
+        try:
+            futures = [pool.submit(_download_range, href, fd, start, end,
+                                   if_range, stop)
+                       for start, end in segments]
+            waiters.wait_for_all(futures)
+        finally:
+            pool.shutdown(wait=False)
+        for future in futures:
+            future.result()
+    finally:
+        os.close(fd)
+
+
+def _fetch_glance(context, href, href_key):
+    expected = get_expected_checksum(context, href)
+    if expected:
+        validator = '%s:%s' % (expected['algorithm'], expected['digest'])
+        entry_path = _entry_path(href, validator)
+    else:
+        # No checksum is published, but the data of a Glance image never
+        # changes, so the entry downloaded last for it stays valid.
+        entry_path = _load_meta(href_key).get('entry')
+        entry_path = entry_path and os.path.join(_cache_root(), entry_path)
+    if entry_path and os.path.isfile(entry_path):
+        _count('hits')
+        return entry_path
+
+    _count('misses')
+    tmp_path = os.path.join(_cache_root(), '%s.part' % href_key)
+    try:
+        digests = download(context, href, tmp_path, expected)
+        if not expected:
+            validator = 'sha256:%s' % digests['sha256']
+            entry_path = _entry_path(href, validator)
+        _publish(tmp_path, entry_path)
+    finally:
+        ironic_utils.unlink_without_raise(tmp_path)
+    save_digest(entry_path, digests)
+    _save_meta(href_key, {'href': href, 'validator': validator,
+                          'entry': os.path.basename(entry_path)})
+    return entry_path
+
+
+def _check_length(href, response, written):
+    """Checks a whole body download against its Content-Length.
+
+    The urllib3 releases that do not enforce it would otherwise let a
+    truncated image become a cache entry.
+
+    :raises: ImageDownloadFailed, if fewer or more bytes were received.
+    """
+    length = response.headers.get('Content-Length')
+    if (not length or response.headers.get('Content-Encoding', 'identity')
+            != 'identity'):
+        # The length of an encoded body is not the one of the image.
+        return
+    try:
+        length = int(length)
+    except ValueError:
+        return
+    if written != length:
+        raise exception.ImageDownloadFailed(
+            image_href=href,
+            reason='received %d bytes, expected %d' % (written, length))
+
+
+def _fetch_http(href, href_key):
+    meta = _load_meta(href_key)
+    cached_entry = None
+    headers = {}
+    if meta.get('entry'):
+        cached_entry = os.path.join(_cache_root(), meta['entry'])
+        if os.path.isfile(cached_entry):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = requests.get(
+            href, headers=headers, stream=True,
+            timeout=CONF.virtmedia_deploy_iso_cache_timeout)
+    except requests.RequestException as e:
+        raise exception.ImageDownloadFailed(image_href=href, reason=e)
+
+    with response:
+        if response.status_code == 304 and headers:
+            _count('revalidations')
+            _count('hits')
+            return cached_entry
+
+        if response.status_code != 200:
+            raise exception.ImageDownloadFailed(
+                image_href=href,
+                reason='HTTP status %s' % response.status_code)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        validator = etag or last_modified
+        _count('misses')
+
+        # The ranges must be of the same image, a weak ETag cannot tell.
+        if_range = (etag if etag and not etag.startswith('W/')
+                    else last_modified)
+        segments = if_range and _get_range_segments(response)
+        tmp_path = os.path.join(_cache_root(), '%s.part' % href_key)
+        try:
+            digest = None
+            if segments:
+                # The ranges are asked for on new connections.
+                response.close()
+                try:
+                    _download_ranges(href, tmp_path, segments, if_range)
+                    digest = _hash_file(tmp_path)
+                except _RangesNotSupported as e:
+                    LOG.info("Downloading %(href)s in a single stream, "
+                             "byte ranges are not served: %(error)s",
+                             {'href': href, 'error': e})
+                    METRICS.send_counter(
+                        'VirtmediaImageCache.range_fallbacks', 1)
+                    response = requests.get(
+                        href, stream=True,
+                        timeout=CONF.virtmedia_deploy_iso_cache_timeout)
+                    if response.status_code != 200:
+                        response.close()
+                        raise exception.ImageDownloadFailed(
+                            image_href=href,
+                            reason='HTTP status %s' % response.status_code)
+            if digest is None:
+                content_hash = hashlib.sha256()
+                written = 0
+                with response, open(tmp_path, 'wb') as tmp_file:
+                    for chunk in response.iter_content(_CHUNK_SIZE):
+                        content_hash.update(chunk)
+                        tmp_file.write(chunk)
+                        written += len(chunk)
+                _check_length(href, response, written)
+                digest = content_hash.hexdigest()
+            if not validator:
+                # Nothing to revalidate against, so at least make the entry
+                # content addressed to share it between identical hrefs.
+                validator = 'sha256:%s' % digest
+            entry_path = _entry_path(href, validator)
+            _publish(tmp_path, entry_path)
+            save_digest(entry_path, {'sha256': digest})
+        except (IOError, OSError, requests.RequestException) as e:
+            raise exception.ImageDownloadFailed(image_href=href, reason=e)
+        finally:
+            ironic_utils.unlink_without_raise(tmp_path)
+
+    # The superseded entry may have been returned to a caller that has not
+    # linked it yet, the share garbage collection removes it once unused.
+    _save_meta(href_key, {'href': href, 'validator': validator,
+                          'etag': etag, 'last_modified': last_modified,
+                          'entry': os.path.basename(entry_path)})
+    return entry_path
+
+
+def fetch(context, image_href):
+    """Returns the path of the cache entry for image_href.
+
+    The image is downloaded only when there is no valid cache entry for
+    it. Concurrent callers asking for the same href are serialized, so a
+    fleet deploy results in a single download.
+
+    :param context: request context.
+    :param image_href: Glance UUID or HTTP(S) URL of the image.
+    :returns: full path of the cached image.
+    :raises: ImageDownloadFailed, if downloading the image failed.
+    """
+    href_key = _digest(image_href)
+    if not os.path.isdir(_cache_root()):
+        try:
+            os.makedirs(_cache_root())
+        except OSError:
+            if not os.path.isdir(_cache_root()):
+                raise
+
+    with lockutils.lock('virtmedia-iso-cache-%s' % href_key):
+        if service_utils.is_glance_image(image_href):
+            entry_path = _fetch_glance(context, image_href, href_key)
+        else:
+            entry_path = _fetch_http(image_href, href_key)
+
+    LOG.debug("Deploy ISO %(href)s served from cache entry %(entry)s, "
+              "cache stats: %(stats)s",
+              {'href': image_href, 'entry': entry_path, 'stats': get_stats()})
+    return entry_path
+
@@ -0,0 +1,353 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""HTTP server for the images of remote_image_share_root.
+
+The Redfish based vendors (DELL, HP) have the BMC fetch the images from
+http://<provisioning_server>:<provisioning_server_http_port>/bootimages/.
+This server can be run, with the virtmedia-image-server command, instead
+of a general purpose web server. It is tuned for the way BMC virtual
+media clients read images, with many small range requests:
+
+* the file data is sent with sendfile, without copying it through user
+  space;
+* single byte ranges (Range, If-Range) are supported, as well as
+  conditional requests with ETag and Last-Modified;
+* connections are kept alive, with a cap on the number of concurrent
+  connections per client;
+* the bytes sent are counted per node and per file, sent as metrics and,
+  with virtmedia_image_server_stats, served as JSON on /_stats.
+
+Only the ISO and floppy images are served, not the files of the hidden
+directories of the share, like the image manifests and the image cache.
+"""
+
+import email.utils
+import json
+import os
+import re
+import socket
+import sys
+import threading
+
+from ironic_lib import metrics_utils
+from oslo_log import log as logging
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+from ironic.common import service as ironic_service
+from ironic_virtmedia_driver.conf import CONF
+
+LOG = logging.getLogger(__name__)
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+STATS_PATH = '/_stats'
+
+_CHUNK_SIZE = 1024 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_SERVED_EXTENSIONS = ('.iso', '.img')
+_NODE_FILE = re.compile(r'^(?:image-(?P<img>.+)\.img|'
+                        r'deploy-(?P<iso>.+)\.iso|'
+                        r'boot-(?P<uuid>.+)\.iso)$')
+
+
+def node_of_file(filename):
+    """Returns the node name or UUID a share file belongs to, or None."""
+    match = _NODE_FILE.match(os.path.basename(filename))
+    if not match:
+        return None
+    return match.group('img') or match.group('iso') or match.group('uuid')
+
+
+def _parse_range(header, size):
+    """Parses a Range header.
+
+    :returns: a (start, end) tuple, end being inclusive, None when the
+        whole file is to be sent, or False when the range is not
+        satisfiable.
+    """
+    match = _RANGE.match(header.strip())
+    if not match:
+        # Multiple ranges or other units, the whole file is fine.
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = min(int(last), size)
+        if not length:
+            return False
+        return size - length, size - 1
+    start = int(first)
+    if start >= size:
+        return False
+    end = min(int(last), size - 1) if last else size - 1
+    if end < start:
+        return None
+    return start, end
+
+
+class ImageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'virtmedia-image-server'
+
+    def setup(self):
+        self.timeout = CONF.virtmedia_image_server_keepalive_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # The headers and the body are sent separately, do not let Nagle
+        # delay the body of small range responses waiting for an ACK.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        client = self.client_address[0]
+        if not self.server.acquire_client(client):
+            LOG.debug("Rejecting a connection of %s, too many connections",
+                      client)
+            self.wfile.write(b'HTTP/1.1 503 Service Unavailable\r\n'
+                             b'Retry-After: 1\r\nContent-Length: 0\r\n'
+                             b'Connection: close\r\n\r\n')
+            return
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.timeout:
+            # Idle keep-alive connection.
+            pass
+        finally:
+            self.server.release_client(client)
+
+    def log_message(self, format, *args):
+        LOG.debug("%s - %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _send_empty(self, code, headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _resolve(self, url_path):
+        """Returns the full path of the requested file, None if invalid."""
+        prefix = self.server.prefix
+        if not url_path.startswith(prefix):
+            return None
+        relative = urlparse.unquote(url_path[len(prefix):])
+        full_path = os.path.realpath(os.path.join(self.server.root,
+                                                  relative))
+        if not full_path.startswith(self.server.real_root + os.sep):
+            return None
+        served_path = full_path[len(self.server.real_root) + 1:]
+        if (not served_path.endswith(_SERVED_EXTENSIONS) or
+                any(part.startswith('.')
+                    for part in served_path.split(os.sep))):
+            return None
+        return full_path
+
+    def _serve_stats(self, send_body):
+        body = json.dumps(self.server.get_stats(),
+                          sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return (if_none_match.strip() == '*' or
+                    etag in [tag.strip() for tag in if_none_match.split(',')])
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def _requested_range(self, etag, last_modified, size):
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() not in (etag, last_modified):
+            return None
+        return _parse_range(range_header, size)
+
+    def _serve(self, send_body):
+        url_path = urlparse.urlsplit(self.path).path
+        if url_path == STATS_PATH and CONF.virtmedia_image_server_stats:
+            self._serve_stats(send_body)
+            return
+
+        full_path = self._resolve(url_path)
+        try:
+            image_file = open(full_path, 'rb') if full_path else None
+        except (IOError, OSError):
+            image_file = None
+        if image_file is None or not os.path.isfile(full_path):
+            self._send_empty(404)
+            return
+
+        with image_file:
+            stat = os.fstat(image_file.fileno())
+            size = stat.st_size
+            etag = '"%x-%x-%x"' % (stat.st_ino, size,
+                                   int(stat.st_mtime * 1000000))
+            last_modified = email.utils.formatdate(stat.st_mtime,
+                                                   usegmt=True)
+            validators = (('ETag', etag), ('Last-Modified', last_modified))
+
+            if self._not_modified(etag, stat.st_mtime):
+                self._send_empty(304, validators)
+                return
+
+            byte_range = self._requested_range(etag, last_modified, size)
+            if byte_range is False:
+                self._send_empty(416, (('Content-Range',
+                                        'bytes */%d' % size),))
+                return
+
+            if byte_range is None:
+                start, length = 0, size
+                self.send_response(200)
+            else:
+                start = byte_range[0]
+                length = byte_range[1] - start + 1
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    byte_range[0], byte_range[1], size))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            for name, value in validators:
+                self.send_header(name, value)
+            self.end_headers()
+            if send_body and length:
+                self.wfile.flush()
+                sent = self._send_file(image_file, start, length)
+                self.server.count(os.path.relpath(full_path,
+                                                  self.server.real_root),
+                                  sent)
+
+    def _send_file(self, image_file, offset, count):
+        """Sends count bytes of image_file from offset, returns the bytes sent.
+
+        socket.sendfile uses os.sendfile, so the data is not copied through
+        user space; it falls back to plain sends where that is not
+        available.
+        """
+        if hasattr(self.connection, 'sendfile'):
+            return self.connection.sendfile(image_file, offset, count)
+
+        image_file.seek(offset)
+        sent = 0
+        while sent < count:
+            chunk = image_file.read(min(_CHUNK_SIZE, count - sent))
+            if not chunk:
+                break
+            self.connection.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+
+class ImageServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server of the files of a share directory."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root, prefix,
+                 max_connections_per_client):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           ImageRequestHandler)
+        self.root = root
+        self.real_root = os.path.realpath(root)
+        self.prefix = '/%s/' % prefix.strip('/') if prefix.strip('/') else '/'
+        self.max_connections_per_client = max_connections_per_client
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._node_bytes = {}
+        self._file_bytes = {}
+
+    def acquire_client(self, client):
+        with self._lock:
+            count = self._connections.get(client, 0)
+            if (self.max_connections_per_client and
+                    count >= self.max_connections_per_client):
+                return False
+            self._connections[client] = count + 1
+            return True
+
+    def release_client(self, client):
+        with self._lock:
+            self._connections[client] -= 1
+            if not self._connections[client]:
+                del self._connections[client]
+
+    def count(self, filename, sent):
+        node = node_of_file(filename)
+        with self._lock:
+            self._file_bytes[filename] = (
+                self._file_bytes.get(filename, 0) + sent)
+            if node:
+                self._node_bytes[node] = self._node_bytes.get(node, 0) + sent
+        METRICS.send_counter('VirtmediaImageServer.bytes_sent', sent)
+        if node:
+            METRICS.send_counter(
+                'VirtmediaImageServer.bytes_sent.%s' % node, sent)
+
+    def get_stats(self):
+        """Returns the bytes sent per node and per file, and connections."""
+        with self._lock:
+            return {'nodes': dict(self._node_bytes),
+                    'files': dict(self._file_bytes),
+                    'connections': dict(self._connections)}
+
+
+def create_server(root=None, host=None, port=None):
+    """Creates an ImageServer configured from the virtmedia options.
+
+    :param root: the directory to serve, defaults to
+        remote_image_share_root.
+    :param host: the address to listen on.
+    :param port: the port to listen on, 0 for any free port.
+    """
+    return ImageServer(
+        (host if host is not None else CONF.virtmedia_image_server_host,
+         port if port is not None else CONF.virtmedia_image_server_port),
+        root or CONF.remote_image_share_root,
+        CONF.virtmedia_image_server_prefix,
+        CONF.virtmedia_image_server_max_connections_per_client)
+
+
+def main():
+    """Entry point of the virtmedia-image-server command."""
+    ironic_service.prepare_service(sys.argv)
+    server = create_server()
+    LOG.info("Serving %(root)s on %(address)s", {
+        'root': server.root, 'address': server.server_address})
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,453 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-place ISO9660 remastering.
+
+Adds a directory of small files at the top of an existing ISO9660 image
+without rewriting it. The file data, a new root directory, the new
+directory and new path tables are appended after the end of the image,
+and the volume descriptors are rewritten in place to point to them. The
+new root directory lists the original entries unchanged, so every
+original file and directory is still found at its original extent, and
+the El Torito boot catalog and boot images are left untouched.
+
+The primary volume descriptor and the Joliet supplementary ones are all
+updated. On a reflink clone of a base ISO, the per-node image then only
+costs the few blocks written.
+
+The original subdirectories still refer to the original root directory
+as their parent, which only matters to readers walking up with '..'.
+
+Readers following the volume descriptors and directory extents, like the
+Linux kernel, firmware and pycdlib, see the new files. Streaming readers
+that only read forward, like libarchive and so bsdtar, cannot reach the
+new root directory, which is now past the file data they have already
+read, and fail on the image.
+"""
+
+import os
+import struct
+import time
+
+SECTOR_SIZE = 2048
+
+_FIRST_DESCRIPTOR_SECTOR = 16
+_STANDARD_ID = b'CD001'
+_TYPE_PRIMARY = 1
+_TYPE_SUPPLEMENTARY = 2
+_TYPE_TERMINATOR = 255
+_JOLIET_ESCAPES = (b'%/@', b'%/C', b'%/E')
+
+_FLAG_DIRECTORY = 0x02
+
+_DIRECTORY_MODE = 0o40555
+_FILE_MODE = 0o100444
+
+# Offsets in a volume descriptor.
+_VOLUME_SPACE_SIZE = 80
+_ESCAPE_SEQUENCES = 88
+_LOGICAL_BLOCK_SIZE = 128
+_PATH_TABLE_SIZE = 132
+_L_PATH_TABLE = 140
+_OPTIONAL_L_PATH_TABLE = 144
+_M_PATH_TABLE = 148
+_OPTIONAL_M_PATH_TABLE = 152
+_ROOT_RECORD = 156
+_ROOT_RECORD_SIZE = 34
+
+
+class ISO9660Error(Exception):
+    pass
+
+
+def _both_endian_32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _both_endian_16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _recording_date(timestamp):
+    tm = time.gmtime(timestamp)
+    return struct.pack('7B', tm.tm_year - 1900, tm.tm_mon, tm.tm_mday,
+                       tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+
+
+def _sectors(size):
+    return -(-size // SECTOR_SIZE)
+
+
+class _Record(object):
+    """A directory record, its system use area kept as is."""
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+
+    @classmethod
+    def build(cls, name, extent, size, flags, timestamp, system_use=b''):
+        system_use += b'\0' * (len(system_use) % 2)
+        length = 33 + len(name) + (1 - len(name) % 2) + len(system_use)
+        data = bytearray(length)
+        data[0] = length
+        data[2:10] = _both_endian_32(extent)
+        data[10:18] = _both_endian_32(size)
+        data[18:25] = _recording_date(timestamp)
+        data[25] = flags
+        data[28:32] = _both_endian_16(1)
+        data[32] = len(name)
+        data[33:33 + len(name)] = name
+        data[length - len(system_use):] = system_use
+        return cls(data)
+
+    @property
+    def name(self):
+        return bytes(self.data[33:33 + self.data[32]])
+
+    @property
+    def extent(self):
+        return struct.unpack_from('<I', self.data, 2)[0]
+
+    @property
+    def size(self):
+        return struct.unpack_from('<I', self.data, 10)[0]
+
+    def system_use_entries(self):
+        """Yields the (signature, entry) of the SUSP entries."""
+        offset = 33 + self.data[32] + (1 - self.data[32] % 2)
+        while offset + 4 <= len(self.data):
+            length = self.data[offset + 2]
+            if length < 4:
+                break
+            yield (bytes(self.data[offset:offset + 2]),
+                   bytes(self.data[offset:offset + length]))
+            offset += length
+
+    def relocate(self, extent, size):
+        self.data[2:10] = _both_endian_32(extent)
+        self.data[10:18] = _both_endian_32(size)
+
+
+def _pack_records(records):
+    """Packs directory records in sectors, none crossing a sector."""
+    sectors = []
+    current = bytearray()
+    for record in records:
+        if len(current) + len(record.data) > SECTOR_SIZE:
+            sectors.append(bytes(current.ljust(SECTOR_SIZE, b'\0')))
+            current = bytearray()
+        current += record.data
+    sectors.append(bytes(current.ljust(SECTOR_SIZE, b'\0')))
+    return b''.join(sectors)
+
+
+def _read_records(iso_file, extent, size):
+    iso_file.seek(extent * SECTOR_SIZE)
+    data = bytearray(iso_file.read(size))
+    records = []
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if not length:
+            # The rest of the sector is padding.
+            offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+            continue
+        records.append(_Record(data[offset:offset + length]))
+        offset += length
+    return records
+
+
+def _read_path_table(iso_file, location, size):
+    """Returns the entries of an L path table as [name, extent, parent]."""
+    iso_file.seek(location * SECTOR_SIZE)
+    data = bytearray(iso_file.read(size))
+    entries = []
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if not length:
+            break
+        extent, parent = struct.unpack_from('<IH', data, offset + 2)
+        entries.append([bytes(data[offset + 8:offset + 8 + length]), extent,
+                        parent])
+        offset += 8 + length + length % 2
+    return entries
+
+
+def _build_path_table(entries, big_endian):
+    extent_format = '>IH' if big_endian else '<IH'
+    data = bytearray()
+    for name, extent, parent in entries:
+        data += struct.pack('BB', len(name), 0)
+        data += struct.pack(extent_format, extent, parent)
+        data += name + b'\0' * (len(name) % 2)
+    return bytes(data)
+
+
+def _insert_path_entry(entries, name, extent):
+    """Adds or updates a directory under the root in path table entries.
+
+    The entries stay sorted by level, parent number and name, and the
+    parent numbers following an insertion are renumbered.
+    """
+    position = None
+    for index, (entry_name, _extent, parent) in enumerate(entries[1:], 1):
+        if parent != 1:
+            if position is None and parent > 1:
+                position = index
+            continue
+        if entry_name == name:
+            entries[index][1] = extent
+            return
+        if position is None and entry_name > name:
+            position = index
+    if position is None:
+        position = len(entries)
+    number = position + 1
+    for entry in entries:
+        if entry[2] >= number:
+            entry[2] += 1
+    entries.insert(position, [name, extent, 1])
+
+
+class _Tree(object):
+    """A directory hierarchy, the one of a volume descriptor."""
+
+    def __init__(self, sector, descriptor, joliet):
+        self.sector = sector
+        self.descriptor = bytearray(descriptor)
+        self.joliet = joliet
+        self.root = _Record(descriptor[_ROOT_RECORD:
+                                       _ROOT_RECORD + _ROOT_RECORD_SIZE])
+        # The length of the Rock Ridge PX entries, None without Rock Ridge.
+        self.px_length = None
+
+    def detect_rock_ridge(self, dot_record):
+        """Looks for Rock Ridge in the '.' record of the root directory."""
+        entries = dict(dot_record.system_use_entries())
+        if not self.joliet and b'SP' in entries:
+            self.px_length = len(entries.get(b'PX', b'')) or 36
+
+    def encode_name(self, name, directory=False):
+        if self.joliet:
+            return name.encode('utf-16-be')
+        name = name.upper()
+        if not directory:
+            name += ('' if '.' in name else '.') + ';1'
+        return name.encode('ascii')
+
+    def rock_ridge(self, name, extent, directory):
+        """Returns the Rock Ridge entries of a new record.
+
+        :param name: the name, None for '.' and '..'.
+        """
+        if self.px_length is None:
+            return b''
+        # Mode, links, user and group.
+        px = b''.join(_both_endian_32(value) for value in (
+            _DIRECTORY_MODE if directory else _FILE_MODE,
+            2 if directory else 1, 0, 0))
+        if self.px_length > 36:
+            # RRIP 1.12, with the file serial number.
+            px += _both_endian_32(extent)
+        entries = b'PX' + struct.pack('BB', 4 + len(px), 1) + px
+        if name is not None:
+            name = name.encode('utf-8')
+            entries += b'NM' + struct.pack('BBB', 5 + len(name), 1, 0) + name
+        return entries
+
+
+def _find_trees(iso_file):
+    trees = []
+    sector = _FIRST_DESCRIPTOR_SECTOR
+    while True:
+        iso_file.seek(sector * SECTOR_SIZE)
+        descriptor = iso_file.read(SECTOR_SIZE)
+        if (len(descriptor) < SECTOR_SIZE or
+                descriptor[1:6] != _STANDARD_ID):
+            raise ISO9660Error('No volume descriptor terminator')
+        kind = bytearray(descriptor[:1])[0]
+        if kind == _TYPE_TERMINATOR:
+            break
+        if kind == _TYPE_PRIMARY:
+            trees.append(_Tree(sector, descriptor, False))
+        elif kind == _TYPE_SUPPLEMENTARY and any(
+                descriptor[_ESCAPE_SEQUENCES:_ESCAPE_SEQUENCES + 3] == escape
+                for escape in _JOLIET_ESCAPES):
+            trees.append(_Tree(sector, descriptor, True))
+        sector += 1
+    if not trees or trees[0].joliet:
+        raise ISO9660Error('No primary volume descriptor')
+    block_size = struct.unpack_from('<H', trees[0].descriptor,
+                                    _LOGICAL_BLOCK_SIZE)[0]
+    if block_size != SECTOR_SIZE:
+        raise ISO9660Error('Unsupported logical block size %d' % block_size)
+    return trees
+
+
+def _validate_name(name):
+    if not name or len(name) > 30 or not all(
+            c.isalnum() or c in '_.' for c in name):
+        raise ValueError('Invalid file name %r, expected up to 30 letters, '
+                         'digits, dots and underscores' % name)
+
+
+def _dot_records(tree, extent, size, parent_extent, parent_size,
+                 timestamp):
+    """Returns the '.' and '..' records of a new directory."""
+    return [_Record.build(b'\0', extent, size, _FLAG_DIRECTORY, timestamp,
+                          tree.rock_ridge(None, extent, True)),
+            _Record.build(b'\1', parent_extent, parent_size,
+                          _FLAG_DIRECTORY, timestamp,
+                          tree.rock_ridge(None, parent_extent, True))]
+
+
+class _Writer(object):
+    """Appends sectors at the end of the image."""
+
+    def __init__(self, fd, first_sector):
+        self.fd = fd
+        self.next_sector = first_sector
+        self.written = 0
+
+    def allocate(self, size):
+        sector = self.next_sector
+        self.next_sector += max(_sectors(size), 1)
+        return sector
+
+    def write(self, sector, data):
+        data = data.ljust(max(_sectors(len(data)), 1) * SECTOR_SIZE, b'\0')
+        os.lseek(self.fd, sector * SECTOR_SIZE, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            count = os.write(self.fd, view)
+            view = view[count:]
+        self.written += len(data)
+
+
+def add_files(iso_path, directory, files, timestamp=None):
+    """Adds a directory of files at the top of an ISO9660 image in place.
+
+    If the directory already exists at the top of the image, it is
+    replaced.
+
+    :param iso_path: full path of the image, modified in place.
+    :param directory: the name of the directory to add, e.g. 'virtmedia'.
+    :param files: a list of (file name, contents) tuples, contents being
+        bytes. Names are made of up to 30 letters, digits, dots and
+        underscores.
+    :param timestamp: the recording time of the new entries, defaults to
+        now.
+    :returns: a tuple of the offset the appended data starts at and the
+        number of bytes written.
+    :raises: ISO9660Error, if the image is not a supported ISO9660 image.
+    :raises: ValueError, if a name is invalid.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    _validate_name(directory)
+    for name, _contents in files:
+        _validate_name(name)
+
+    with open(iso_path, 'rb') as iso_file:
+        trees = _find_trees(iso_file)
+        end = max(os.fstat(iso_file.fileno()).st_size,
+                  struct.unpack_from('<I', trees[0].descriptor,
+                                     _VOLUME_SPACE_SIZE)[0] * SECTOR_SIZE)
+        roots = [_read_records(iso_file, tree.root.extent, tree.root.size)
+                 for tree in trees]
+        path_tables = [_read_path_table(
+            iso_file,
+            struct.unpack_from('<I', tree.descriptor, _L_PATH_TABLE)[0],
+            struct.unpack_from('<I', tree.descriptor, _PATH_TABLE_SIZE)[0])
+            for tree in trees]
+
+    fd = os.open(iso_path, os.O_WRONLY)
+    try:
+        writer = _Writer(fd, _sectors(end))
+        start = writer.next_sector * SECTOR_SIZE
+
+        # The data is shared by all the hierarchies.
+        file_extents = []
+        for name, contents in files:
+            sector = writer.allocate(len(contents))
+            if contents:
+                writer.write(sector, contents)
+            file_extents.append((name, sector, len(contents)))
+
+        for tree, root_records, path_table in zip(trees, roots, path_tables):
+            tree.detect_rock_ridge(root_records[0])
+
+            dir_name = tree.encode_name(directory, directory=True)
+            file_records = sorted(
+                (_Record.build(tree.encode_name(name), sector, size, 0,
+                               timestamp,
+                               tree.rock_ridge(name, sector, False))
+                 for name, sector, size in file_extents),
+                key=lambda record: record.name)
+            # The sizes of the records do not depend on their extents.
+            dir_size = len(_pack_records(
+                _dot_records(tree, 0, 0, 0, 0, timestamp) + file_records))
+            dir_sector = writer.allocate(dir_size)
+
+            entries = [record for record in root_records[2:]
+                       if record.name != dir_name]
+            entries.append(_Record.build(
+                dir_name, dir_sector, dir_size, _FLAG_DIRECTORY, timestamp,
+                tree.rock_ridge(directory, dir_sector, True)))
+            entries.sort(key=lambda record: record.name)
+            root_size = len(_pack_records(root_records[:2] + entries))
+            root_sector = writer.allocate(root_size)
+            for record in root_records[:2]:
+                record.relocate(root_sector, root_size)
+
+            writer.write(dir_sector, _pack_records(
+                _dot_records(tree, dir_sector, dir_size, root_sector,
+                             root_size, timestamp) + file_records))
+            writer.write(root_sector, _pack_records(root_records[:2] +
+                                                    entries))
+
+            path_table[0][1] = root_sector
+            _insert_path_entry(path_table, dir_name, dir_sector)
+            l_table = _build_path_table(path_table, False)
+            l_sector = writer.allocate(len(l_table))
+            writer.write(l_sector, l_table)
+            m_sector = writer.allocate(len(l_table))
+            writer.write(m_sector, _build_path_table(path_table, True))
+
+            tree.root.relocate(root_sector, root_size)
+            descriptor = tree.descriptor
+            descriptor[_ROOT_RECORD:_ROOT_RECORD + _ROOT_RECORD_SIZE] = (
+                tree.root.data)
+            descriptor[_PATH_TABLE_SIZE:_PATH_TABLE_SIZE + 8] = (
+                _both_endian_32(len(l_table)))
+            descriptor[_L_PATH_TABLE:_L_PATH_TABLE + 4] = struct.pack(
+                '<I', l_sector)
+            descriptor[_OPTIONAL_L_PATH_TABLE:
+                       _OPTIONAL_L_PATH_TABLE + 4] = b'\0' * 4
+            descriptor[_M_PATH_TABLE:_M_PATH_TABLE + 4] = struct.pack(
+                '>I', m_sector)
+            descriptor[_OPTIONAL_M_PATH_TABLE:
+                       _OPTIONAL_M_PATH_TABLE + 4] = b'\0' * 4
+
+        # The descriptors go last, the image is only switched to the new
+        # hierarchies once they are complete.
+        for tree in trees:
+            tree.descriptor[_VOLUME_SPACE_SIZE:_VOLUME_SPACE_SIZE + 8] = (
+                _both_endian_32(writer.next_sector))
+            writer.write(tree.sector, bytes(tree.descriptor))
+        return start, writer.written
+    finally:
+        os.close(fd)
@@ -0,0 +1,201 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Page cache policy for the files of remote_image_share_root.
+
+When many BMCs start reading the same deploy ISO at once, a cold page
+cache turns into a storm of disk reads on the conductor. The base deploy
+ISOs in use are therefore warmed, and kept warm, with a WILLNEED advice,
+while the per-node images, each read once by a single BMC, are dropped
+from the cache with a DONTNEED advice once written so they do not push
+the deploy ISOs out of it.
+
+DONTNEED only drops clean pages, so per-node images are fully dropped
+when virtmedia_fsync_share_files is set and otherwise as soon as the
+kernel has written them back.
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+import threading
+
+from ironic_lib import metrics_utils
+from oslo_log import log as logging
+
+from ironic_virtmedia_driver.conf import CONF
+
+LOG = logging.getLogger(__name__)
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+_PAGE_SIZE = mmap.PAGESIZE
+
+_WARM_CHUNK = 4 * 1024 * 1024
+
+# From sys/mman.h, for when os and mmap do not provide them.
+_PROT_READ = 0x1
+_MAP_SHARED = 0x01
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+_active_lock = threading.Lock()
+_active = set()
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t,
+                              ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_long)
+        libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+        libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_char_p)
+        return libc
+    except (AttributeError, OSError, TypeError):
+        return None
+
+_LIBC = _load_libc()
+
+
+def _advise(path, advice, madvice, offset=0, length=0, chunk=None):
+    """Gives an advice on a range of a file, length 0 meaning to its end.
+
+    :param chunk: when given, the fadvise advice is given for successive
+        ranges of that size, as the kernel caps the readahead a single
+        WILLNEED advice triggers.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            if not chunk:
+                os.posix_fadvise(fd, offset, length, advice)
+                return True
+            end = offset + length if length else size
+            for start in range(offset, end, chunk):
+                os.posix_fadvise(fd, start, min(chunk, end - start), advice)
+            return True
+        if not size or not hasattr(mmap.mmap, 'madvise'):
+            return False
+        start = offset - offset % _PAGE_SIZE
+        mapped = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+        try:
+            mapped.madvise(madvice, start,
+                           (length or size - offset) + offset - start)
+        finally:
+            mapped.close()
+        return True
+    finally:
+        os.close(fd)
+
+
+def warm(path):
+    """Starts reading a shared image into the page cache.
+
+    The image is remembered as active, so report() keeps it warm.
+
+    :param path: full path of the image.
+    """
+    if not CONF.virtmedia_page_cache_warm:
+        return
+    try:
+        _advise(path, getattr(os, 'POSIX_FADV_WILLNEED', None),
+                getattr(mmap, 'MADV_WILLNEED', None), chunk=_WARM_CHUNK)
+    except (IOError, OSError) as e:
+        LOG.debug("Cannot warm %(path)s: %(err)s", {'path': path, 'err': e})
+        return
+    with _active_lock:
+        _active.add(path)
+
+
+def drop(path, offset=0, length=0):
+    """Drops a per-node image, or a range of it, from the page cache.
+
+    :param path: full path of the image.
+    :param offset: the start of the range.
+    :param length: the length of the range, 0 meaning to the end.
+    """
+    if not CONF.virtmedia_page_cache_drop_node_images:
+        return
+    try:
+        _advise(path, getattr(os, 'POSIX_FADV_DONTNEED', None),
+                getattr(mmap, 'MADV_DONTNEED', None), offset, length)
+    except (IOError, OSError) as e:
+        LOG.debug("Cannot drop %(path)s from the page cache: %(err)s",
+                  {'path': path, 'err': e})
+
+
+def resident_fraction(path):
+    """Returns the fraction of a file present in the page cache.
+
+    :param path: full path of the file.
+    :returns: a float between 0 and 1, None if it cannot be known.
+    """
+    if _LIBC is None:
+        return None
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if not size:
+            return 1.0
+        address = _LIBC.mmap(None, size, _PROT_READ, _MAP_SHARED, fd, 0)
+        if address in (None, _MAP_FAILED):
+            return None
+        try:
+            pages = -(-size // _PAGE_SIZE)
+            vector = ctypes.create_string_buffer(pages)
+            if _LIBC.mincore(address, size, vector) != 0:
+                return None
+            resident = sum(1 for byte in bytearray(vector.raw) if byte & 1)
+            return float(resident) / pages
+        finally:
+            _LIBC.munmap(address, size)
+    finally:
+        os.close(fd)
+
+
+def report():
+    """Re-warms the active images and reports how much of them is cached.
+
+    Images that no longer exist stop being active. A single gauge is sent,
+    the residency of the least cached image, so the metric names do not
+    grow with the images; the residency of each image is logged.
+
+    :returns: a dictionary mapping the paths of the active images to their
+        resident fraction.
+    """
+    with _active_lock:
+        paths = sorted(_active)
+    fractions = {}
+    for path in paths:
+        try:
+            fraction = resident_fraction(path)
+        except (IOError, OSError):
+            with _active_lock:
+                _active.discard(path)
+            continue
+        fractions[path] = fraction
+        if fraction is not None and fraction < 1.0:
+            warm(path)
+    known = [fraction for fraction in fractions.values()
+             if fraction is not None]
+    if known:
+        METRICS.send_gauge('VirtmediaPageCache.resident_percent',
+                           int(min(known) * 100))
+    LOG.debug("Page cache residency of the active images: %s", fractions)
+    return fractions
@@ -0,0 +1,260 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""HTTP endpoint of the deploy ramdisk parameters, in the conductor.
+
+With the "http" virtmedia_params_delivery, the nodes boot the deploy ISO
+unmodified, without a floppy image, and the ramdisk fetches its
+parameters from the conductor that prepared it, trying the MACs of its
+interfaces::
+
+    GET http://<conductor>:<virtmedia_params_server_port>/v1/params/<MAC>
+
+The node UUID may be used instead of a MAC. The answer is the
+parameters.txt file the floppy image would have held.
+
+The parameters are published in an in-memory table by prepare_ramdisk,
+and withdrawn when the ramdisk is cleaned up. They are also kept in the
+driver_internal_info of the node, so after a restart of the conductor
+the table is filled again from the node on a lookup miss. The server is
+started in the conductor on the first publication, or by a periodic task
+after a restart. It does not authenticate the requests, so it listens on
+the my_ip of the conductor by default, not on all its addresses.
+"""
+
+import re
+import socket
+import threading
+
+from ironic_lib import metrics_utils
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+from ironic.common import context as ironic_context
+from ironic.common import exception
+from ironic.common.i18n import _
+from ironic.common import states
+from ironic import objects
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import virtmedia_exception
+
+LOG = logging.getLogger(__name__)
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+PARAMS_PATH = '/v1/params/'
+
+# driver_internal_info key of the parameters published for a node.
+PARAMS_INFO = 'virtmedia_params'
+
+# The nodes whose ramdisk may be looking its parameters up.
+_SERVED_STATES = frozenset([states.DEPLOYING, states.DEPLOYWAIT,
+                            states.CLEANING, states.CLEANWAIT])
+
+_MAC_SEPARATORS = re.compile(r'[-:.]')
+_MAC = re.compile(r'^(?:[0-9a-f]{2}:){5}[0-9a-f]{2}$')
+
+_LOCK = threading.Lock()
+# key: parameters file contents, keys being node UUIDs and MACs
+_TABLE = {}
+# node UUID: keys published for it
+_NODE_KEYS = {}
+_SERVER = None
+
+
+def _normalize(key):
+    """Returns the table key of a MAC, in any notation, or a node UUID."""
+    key = key.strip().lower()
+    digits = _MAC_SEPARATORS.sub('', key)
+    if len(digits) == 12 and all(c in '0123456789abcdef' for c in digits):
+        return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+    return key
+
+
+def lookup(key):
+    """Returns the parameters published for a MAC or node UUID, or None."""
+    key = _normalize(key)
+    with _LOCK:
+        contents = _TABLE.get(key)
+    if contents is None:
+        contents = _load(key)
+    return contents
+
+
+def _load(key):
+    """Publishes again the parameters kept in the node of a table key.
+
+    Used on a lookup miss, for the parameters published before a restart
+    of the conductor.
+
+    :returns: the parameters, None if the node of the key has none.
+    """
+    if not (uuidutils.is_uuid_like(key) or _MAC.match(key)):
+        return None
+    context = ironic_context.get_admin_context()
+    try:
+        if _MAC.match(key):
+            port = objects.Port.get_by_address(context, key)
+            node = objects.Node.get_by_id(context, port.node_id)
+        else:
+            node = objects.Node.get_by_uuid(context, key)
+    except exception.NotFound:
+        return None
+    published = node.driver_internal_info.get(PARAMS_INFO)
+    if not published or node.provision_state not in _SERVED_STATES:
+        return None
+    contents = published['contents'].encode('utf-8')
+    keys = _publish(node.uuid, published['macs'], contents)
+    LOG.info("Published again the ramdisk parameters of node %s kept in "
+             "the node", node.uuid)
+    return contents if key in keys else None
+
+
+def _publish(node_uuid, macs, contents):
+    keys = set([_normalize(node_uuid)] + [_normalize(mac) for mac in macs
+                                          if mac])
+    with _LOCK:
+        _withdraw(node_uuid)
+        for key in keys:
+            _TABLE[key] = contents
+        _NODE_KEYS[node_uuid] = keys
+    return keys
+
+
+def publish(node_uuid, macs, contents):
+    """Publishes the parameters of a node, replacing the previous ones.
+
+    :param node_uuid: the UUID of the node.
+    :param macs: the MACs the ramdisk may look its parameters up with.
+    :param contents: the parameters file, as bytes.
+    """
+    ensure_started()
+    keys = _publish(node_uuid, macs, contents)
+    LOG.debug("Published the ramdisk parameters of node %(node)s for "
+              "%(keys)s", {'node': node_uuid, 'keys': sorted(keys)})
+
+
+def publish_node(node, macs, contents):
+    """Publishes the parameters of a node and keeps them in the node.
+
+    :param node: the node, saved with the parameters in its
+        driver_internal_info.
+    :param macs: the MACs the ramdisk may look its parameters up with.
+    :param contents: the parameters file, as bytes.
+    """
+    publish(node.uuid, macs, contents)
+    driver_internal_info = node.driver_internal_info
+    driver_internal_info[PARAMS_INFO] = {
+        'macs': sorted(set(_normalize(mac) for mac in macs if mac)),
+        'contents': contents.decode('utf-8')}
+    node.driver_internal_info = driver_internal_info
+    node.save()
+
+
+def _withdraw(node_uuid):
+    for key in _NODE_KEYS.pop(node_uuid, ()):
+        _TABLE.pop(key, None)
+
+
+def withdraw(node_uuid):
+    """Withdraws the parameters of a node, if any."""
+    with _LOCK:
+        _withdraw(node_uuid)
+
+
+def withdraw_node(node):
+    """Withdraws the parameters of a node, also from the node, if any."""
+    withdraw(node.uuid)
+    driver_internal_info = node.driver_internal_info
+    if driver_internal_info.pop(PARAMS_INFO, None) is not None:
+        node.driver_internal_info = driver_internal_info
+        node.save()
+
+
+class ParamsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'virtmedia-params-server'
+
+    def log_message(self, format, *args):
+        LOG.debug("%s - %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        url_path = urlparse.unquote(urlparse.urlsplit(self.path).path)
+        contents = None
+        if url_path.startswith(PARAMS_PATH):
+            contents = lookup(url_path[len(PARAMS_PATH):])
+        if contents is None:
+            METRICS.send_counter('VirtmediaParamsServer.misses', 1)
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        METRICS.send_counter('VirtmediaParamsServer.hits', 1)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(contents)))
+        # The parameters change with every deploy.
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(contents)
+
+
+class ParamsServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server of the published parameters."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           ParamsRequestHandler)
+
+
+def ensure_started():
+    """Starts the server in a daemon thread, once per process.
+
+    :returns: the running ParamsServer.
+    :raises: VirtmediaOperationError, if the server cannot listen.
+    """
+    global _SERVER
+    with _LOCK:
+        if _SERVER is None:
+            address = (CONF.virtmedia_params_server_host or CONF.my_ip,
+                       CONF.virtmedia_params_server_port)
+            try:
+                server = ParamsServer(address)
+            except socket.error as e:
+                raise virtmedia_exception.VirtmediaOperationError(
+                    operation=_('starting the parameters server on %s:%s')
+                    % address, error=e)
+            thread = threading.Thread(target=server.serve_forever,
+                                      name='virtmedia-params-server')
+            thread.daemon = True
+            thread.start()
+            LOG.info("Serving the ramdisk parameters on %s",
+                     server.server_address)
+            _SERVER = server
+        return _SERVER
@@ -0,0 +1,178 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Opt-in profiling of the boot interface and vendor hardware calls.
+
+When virtmedia_profiling_enabled is set, the methods given to
+instrument() are replaced, on the instance, by wrappers profiling a
+sampled fraction of the calls, and every call for nodes with the
+virtmedia_profile driver_info flag. When the option is not set nothing
+is wrapped, so the calls run exactly as before.
+
+Each profiled call writes, to <virtmedia_profiling_dir>/<node uuid>/:
+
+* <time>-<call>.prof, cProfile statistics loadable with pstats.Stats;
+* <time>-<call>.tracemalloc, a tracemalloc snapshot loadable with
+  tracemalloc.Snapshot.load, when tracemalloc is available.
+
+The oldest dumps of a node are removed to keep its directory under
+virtmedia_profiling_max_bytes.
+"""
+
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+
+from oslo_log import log as logging
+from oslo_utils import fileutils
+from oslo_utils import strutils
+
+from ironic_virtmedia_driver.conf import CONF
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOG = logging.getLogger(__name__)
+
+# driver_info flag requesting every call of a node to be profiled.
+PROFILE_FLAG = 'virtmedia_profile'
+
+# cProfile profiles a single thread and, on recent Python versions, only
+# one profiler can be active in the process, so calls are profiled one at
+# a time. Calls made meanwhile, including the nested ones, run as usual.
+_profile_lock = threading.Lock()
+
+
+def _find_node(args, kwargs):
+    """Returns the node of the task among the arguments of a call."""
+    for arg in list(args) + list(kwargs.values()):
+        node = getattr(arg, 'node', None)
+        if node is not None:
+            return node
+    return None
+
+
+def _should_profile(node):
+    if node is not None and strutils.bool_from_string(
+            (node.driver_info or {}).get(PROFILE_FLAG, False)):
+        return True
+    rate = CONF.virtmedia_profiling_sample_rate
+    return rate > 0 and random.random() < rate
+
+
+def _start_tracing():
+    """Starts tracemalloc, returns whether it has to be stopped."""
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(CONF.virtmedia_profiling_traceback_frames)
+    return True
+
+
+def _stop_tracing(started):
+    """Returns a snapshot of the allocations and stops tracing."""
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot()
+    if started:
+        tracemalloc.stop()
+    return snapshot
+
+
+def _enforce_size_cap(directory):
+    """Removes the oldest dumps of directory above the size cap."""
+    max_bytes = CONF.virtmedia_profiling_max_bytes
+    dumps = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        dumps.append((stat.st_mtime, stat.st_size, path))
+    used = sum(size for _mtime, size, _path in dumps)
+    for _mtime, size, path in sorted(dumps):
+        if used <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        used -= size
+
+
+def _dump(node, call_name, profile, snapshot):
+    node_id = node.uuid if node is not None else 'no-node'
+    directory = os.path.join(CONF.virtmedia_profiling_dir, node_id)
+    fileutils.ensure_tree(directory)
+    now = time.time()
+    prefix = os.path.join(directory, '%s.%06d-%s' % (
+        time.strftime('%Y%m%dT%H%M%S', time.localtime(now)),
+        int(now % 1 * 1000000), call_name))
+    profile.dump_stats(prefix + '.prof')
+    if snapshot is not None:
+        snapshot.dump(prefix + '.tracemalloc')
+    _enforce_size_cap(directory)
+    LOG.debug("Profile of %(call)s for node %(node)s written to "
+              "%(prefix)s.*", {'call': call_name, 'node': node_id,
+                               'prefix': prefix})
+
+
+def _profiled(method, call_name):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        node = _find_node(args, kwargs)
+        if not _should_profile(node):
+            return method(*args, **kwargs)
+        if not _profile_lock.acquire(False):
+            LOG.debug("Not profiling %s, another call is being profiled",
+                      call_name)
+            return method(*args, **kwargs)
+
+        try:
+            started = _start_tracing()
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(method, *args, **kwargs)
+            finally:
+                snapshot = _stop_tracing(started)
+                try:
+                    _dump(node, call_name, profile, snapshot)
+                except (IOError, OSError) as e:
+                    LOG.warning("Could not write the profile of %(call)s: "
+                                "%(err)s", {'call': call_name, 'err': e})
+        finally:
+            _profile_lock.release()
+    return wrapper
+
+
+def instrument(obj, method_names):
+    """Wraps methods of obj to profile them, if profiling is enabled.
+
+    :param obj: the instance whose methods are wrapped.
+    :param method_names: the names of the methods to wrap.
+    """
+    if not CONF.virtmedia_profiling_enabled:
+        return
+    prefix = type(obj).__name__
+    for name in method_names:
+        method = getattr(obj, name, None)
+        if method is not None:
+            setattr(obj, name,
+                    _profiled(method, '%s.%s' % (prefix, name)))
@@ -0,0 +1,262 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Pool of provisioning servers the BMCs read the images from.
+
+The provisioning_server of a node may be a comma separated pool of
+servers exporting the same share, each given as::
+
+    HOST[:PORT][;weight=WEIGHT][;subnet=CIDR]...[;locality=NAME]...
+
+The port defaults to provisioning_server_http_port and the weight to 1.
+The servers tagged with a subnet holding the BMC address of the node, or
+with its provisioning_locality, are preferred over the others.
+
+At attach time the least loaded of the preferred servers that are
+healthy is chosen, or of the other healthy servers when no preferred one
+is: the one with the fewest virtual media attached through
+it by this conductor relative to its weight, ties broken by a hash of the
+node so that conductors spread the nodes alike. A server is healthy when
+its HTTP port accepts connections and no attach through it failed
+recently; the probes are cached for a while.
+"""
+
+import hashlib
+import re
+import socket
+import threading
+import time
+
+from ironic_lib import metrics_utils
+import netaddr
+from oslo_log import log as logging
+
+from ironic.common import exception
+from ironic.common.i18n import _
+from ironic_virtmedia_driver.conf import CONF
+
+LOG = logging.getLogger(__name__)
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+_ADDRESS = re.compile(r'^(?:\[(?P<ipv6>[^\]]+)\]|(?P<host>[^:\[\]]+))'
+                      r'(?::(?P<port>\d+))?$')
+
+_LOCK = threading.Lock()
+# (host, port): set of node UUIDs
+_ATTACHMENTS = {}
+# (host, port): (healthy, time of the probe)
+_HEALTH = {}
+# (host, port): time of the last failed attach
+_FAILURES = {}
+
+
+class ProvisioningServer(object):
+    """A provisioning server of a pool.
+
+    :param host: the IP address or host name.
+    :param port: the HTTP port, as a string like in driver_info.
+    :param weight: the share of the attachments it takes, relative to
+        the other servers.
+    :param subnets: the IPNetworks it is local to.
+    :param localities: the names of the localities it is local to.
+    """
+
+    def __init__(self, host, port, weight=1.0, subnets=(), localities=()):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.subnets = list(subnets)
+        self.localities = list(localities)
+
+    @property
+    def key(self):
+        return (self.host, self.port)
+
+    def is_local_to(self, bmc_address, locality):
+        if locality and locality in self.localities:
+            return True
+        if bmc_address and self.subnets:
+            try:
+                address = netaddr.IPAddress(bmc_address)
+            except (netaddr.AddrFormatError, ValueError):
+                return False
+            return any(address in subnet for subnet in self.subnets)
+        return False
+
+    def __repr__(self):
+        return '%s:%s' % (self.host, self.port)
+
+
+def _invalid(entry, reason):
+    return exception.InvalidParameterValue(
+        _("Invalid provisioning_server entry %(entry)r: %(reason)s") %
+        {'entry': entry, 'reason': reason})
+
+
+def _parse_entry(entry, default_port):
+    fields = [field.strip() for field in entry.split(';')]
+    match = _ADDRESS.match(fields[0])
+    if not match:
+        raise _invalid(entry, _('expected HOST[:PORT]'))
+    server = ProvisioningServer(match.group('ipv6') or match.group('host'),
+                                match.group('port') or str(default_port))
+    for field in fields[1:]:
+        name, sep, value = field.partition('=')
+        name, value = name.strip(), value.strip()
+        try:
+            if not sep or not value:
+                raise ValueError(field)
+            if name == 'weight':
+                server.weight = float(value)
+                if server.weight <= 0:
+                    raise ValueError(value)
+            elif name == 'subnet':
+                server.subnets.append(netaddr.IPNetwork(value))
+            elif name == 'locality':
+                server.localities.append(value)
+            else:
+                raise _invalid(entry, _('unknown tag %s') % name)
+        except (netaddr.AddrFormatError, ValueError):
+            raise _invalid(entry, _('invalid tag %s') % field)
+    return server
+
+
+def parse(provisioning_server, default_port):
+    """Parses the provisioning_server of a node.
+
+    :param provisioning_server: a single address, or a comma separated
+        pool of entries.
+    :param default_port: the provisioning_server_http_port of the node.
+    :returns: a list of ProvisioningServers, of one server when no pool is
+        given.
+    :raises: InvalidParameterValue, if an entry is invalid.
+    """
+    if ',' not in provisioning_server and ';' not in provisioning_server:
+        # A plain address, as before pools, IPv6 ones included.
+        return [ProvisioningServer(provisioning_server.strip(),
+                                   str(default_port))]
+    servers = [_parse_entry(entry.strip(), default_port)
+               for entry in provisioning_server.split(',') if entry.strip()]
+    if not servers:
+        raise _invalid(provisioning_server, _('no server'))
+    return servers
+
+
+def _probe(server):
+    try:
+        connection = socket.create_connection(
+            (server.host, int(server.port)),
+            CONF.virtmedia_provisioning_server_probe_timeout)
+    except (socket.error, ValueError) as e:
+        LOG.warning("Provisioning server %(server)s is unreachable: "
+                    "%(error)s", {'server': server, 'error': e})
+        return False
+    connection.close()
+    return True
+
+
+def is_healthy(server):
+    """Whether a server is reachable and no attach through it failed lately.
+
+    The reachability is probed at most once per
+    virtmedia_provisioning_server_health_ttl.
+    """
+    now = time.time()
+    with _LOCK:
+        failed_at = _FAILURES.get(server.key)
+        probe = _HEALTH.get(server.key)
+    if (failed_at is not None and now - failed_at <
+            CONF.virtmedia_provisioning_server_failure_backoff):
+        return False
+    if (probe is not None and now - probe[1] <
+            CONF.virtmedia_provisioning_server_health_ttl):
+        return probe[0]
+    healthy = _probe(server)
+    with _LOCK:
+        _HEALTH[server.key] = (healthy, time.time())
+    return healthy
+
+
+def _load(server):
+    return float(len(_ATTACHMENTS.get(server.key, ()))) / server.weight
+
+
+def _spread(node_uuid, server):
+    return hashlib.sha256(('%s %s' % (node_uuid, server)).encode(
+        'utf-8')).hexdigest()
+
+
+def select(servers, node_uuid, bmc_address=None, locality=None):
+    """Chooses the provisioning server a node attaches its media through.
+
+    :param servers: the pool, as returned by parse.
+    :param node_uuid: the UUID of the node.
+    :param bmc_address: the address of the BMC, matched against the
+        subnets of the servers.
+    :param locality: the provisioning_locality of the node.
+    :returns: the least loaded of the healthy local servers, or of the
+        other healthy servers when no local server is healthy. When no
+        server is healthy, the least loaded of the local servers, or of
+        them all when none is local.
+    """
+    if len(servers) == 1:
+        return servers[0]
+    local = [server for server in servers
+             if server.is_local_to(bmc_address, locality)]
+    candidates = local or servers
+    healthy = [server for server in candidates if is_healthy(server)]
+    if not healthy and local:
+        healthy = [server for server in servers
+                   if server not in local and is_healthy(server)]
+    if not healthy:
+        LOG.warning("No healthy provisioning server for node %(node)s "
+                    "among %(servers)s, choosing among them all",
+                    {'node': node_uuid, 'servers': candidates})
+        METRICS.send_counter('ProvisioningPool.no_healthy_server', 1)
+        healthy = candidates
+    with _LOCK:
+        return min(healthy, key=lambda server: (
+            _load(server), _spread(node_uuid, server)))
+
+
+def attached(server, node_uuid):
+    """Records that a node attached its media through a server."""
+    with _LOCK:
+        for node_uuids in _ATTACHMENTS.values():
+            node_uuids.discard(node_uuid)
+        _ATTACHMENTS.setdefault(server.key, set()).add(node_uuid)
+        _FAILURES.pop(server.key, None)
+
+
+def detached(node_uuid):
+    """Records that a node detached its media."""
+    with _LOCK:
+        for node_uuids in _ATTACHMENTS.values():
+            node_uuids.discard(node_uuid)
+
+
+def failed(server):
+    """Records that attaching through a server failed, to avoid it."""
+    METRICS.send_counter('ProvisioningPool.attach_failures', 1)
+    with _LOCK:
+        _FAILURES[server.key] = time.time()
+
+
+def get_stats():
+    """Returns the attachments per server of this conductor."""
+    with _LOCK:
+        return dict(('%s:%s' % key, len(node_uuids))
+                    for key, node_uuids in _ATTACHMENTS.items())
@@ -0,0 +1,492 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Garbage collection and quota management of remote_image_share_root.
+
+The files the driver writes to the share are classified as:
+
+* per-node images (image-<name>.img, deploy-<name>.iso, base-<name>.iso
+  and their digests, boot-<uuid>.iso and the image manifests), at the
+  top of the share or below nodes/ depending on the share layout, which
+  may be evicted to honour the quota while their node is idle, and are
+  orphans once their node is gone. As node names are optional and not
+  unique over time, an image is only taken for an orphan when it is
+  attributed to a deleted node by its UUID: in its name, in its node
+  directory or in the manifest of the node;
+* cached deploy ISOs, evicted least recently used first to honour the
+  quota unless a node is busy with them, and their digests, removed with
+  them. The entries superseded by a newer version of their image are
+  orphans once no per-node ISO links to them anymore and they were not
+  used for virtmedia_share_gc_grace;
+* temporary files left behind by failed operations (.tar.gz, .tmp and
+  .part files), removed once older than virtmedia_share_gc_grace.
+
+Any other file, like the deploy ISOs put in the share by the operator, is
+never touched.
+
+The space used is counted once per inode, as the per-node ISOs may be
+hardlinks to a cache entry or a base ISO, and the extents reflinked
+clones share with each other are counted once. Evicting a file only
+frees the space of the extents it does not share, and only once all its
+hardlinks are removed: the files linked from files that are kept are
+not evicted.
+"""
+
+import argparse
+import collections
+import fcntl
+import json
+import os
+import re
+import struct
+import sys
+import time
+
+from ironic_lib import metrics_utils
+from ironic_lib import utils as ironic_utils
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+
+from ironic.common import context as ironic_context
+from ironic.common import service as ironic_service
+from ironic.common import states
+from ironic import objects
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import virtmedia_exception
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+LOG = logging.getLogger(__name__)
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+# Nodes in these states may be reading or about to read their images.
+BUSY_STATES = frozenset([states.DEPLOYING, states.DEPLOYWAIT,
+                         states.CLEANING, states.CLEANWAIT])
+
+_NODE_NAME_FILE = re.compile(r'^(?:image-(?P<img>.+)\.img|'
+                             r'(?:deploy|base)-(?P<iso>.+)\.iso'
+                             r'(?:\.digest)?)$')
+_NODE_UUID_FILE = re.compile(r'^boot-(?P<uuid>.+)\.iso$')
+_TEMPORARY_FILE = re.compile(r'\.(?:tar\.gz|tmp|part)$')
+
+# _IOWR('f', 11, struct fiemap) from linux/fs.h
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQIIII')
+# fe_logical, fe_physical, fe_length and fe_flags.
+_FIEMAP_EXTENT = struct.Struct('=QQQ16xI12x')
+_FIEMAP_EXTENT_LAST = 0x1
+_FIEMAP_EXTENT_SHARED = 0x2000
+_FIEMAP_EXTENT_COUNT = 64
+
+
+def _shared_extents(path):
+    """Returns the extents a file shares with other files, like reflinks.
+
+    :param path: full path of the file.
+    :returns: a list of (physical offset, length) tuples, empty when the
+        file system cannot tell, like NFS.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return []
+    extents = []
+    try:
+        start = 0
+        while True:
+            buf = bytearray(_FIEMAP_HEADER.size +
+                            _FIEMAP_EXTENT.size * _FIEMAP_EXTENT_COUNT)
+            _FIEMAP_HEADER.pack_into(buf, 0, start, 0xffffffffffffffff, 0,
+                                     0, _FIEMAP_EXTENT_COUNT, 0)
+            fcntl.ioctl(fd, _FS_IOC_FIEMAP, buf, True)
+            mapped = _FIEMAP_HEADER.unpack_from(buf)[3]
+            if not mapped:
+                return extents
+            for index in range(mapped):
+                logical, physical, length, flags = (
+                    _FIEMAP_EXTENT.unpack_from(
+                        buf, _FIEMAP_HEADER.size +
+                        index * _FIEMAP_EXTENT.size))
+                if flags & _FIEMAP_EXTENT_SHARED:
+                    extents.append((physical, length))
+                if flags & _FIEMAP_EXTENT_LAST:
+                    return extents
+            start = logical + length
+    except (IOError, OSError):
+        return []
+    finally:
+        os.close(fd)
+
+
+class ShareFile(object):
+    """A file of the share, as seen by a garbage collection."""
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.size = stat.st_blocks * 512
+        self.last_used = max(stat.st_atime, stat.st_mtime)
+        self.nlink = stat.st_nlink
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.shared_extents = (_shared_extents(path) if stat.st_blocks
+                               else [])
+        # The space its removal would free.
+        self.exclusive_size = max(0, self.size - sum(
+            length for _physical, length in self.shared_extents))
+
+
+class _Usage(object):
+    """The space used by files, counting shared inodes and extents once."""
+
+    def __init__(self):
+        self.total = 0
+        self._inodes = set()
+        self._extents = set()
+
+    def add(self, share_file):
+        if share_file.inode in self._inodes:
+            return
+        self._inodes.add(share_file.inode)
+        self.total += share_file.exclusive_size
+        for physical, length in share_file.shared_extents:
+            extent = (share_file.inode[0], physical)
+            if extent not in self._extents:
+                self._extents.add(extent)
+                self.total += length
+
+
+def _scan(directory):
+    """Yields the regular files of directory as (name, ShareFile)."""
+    try:
+        entries = list(scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            yield entry.name, ShareFile(entry.path,
+                                        entry.stat(follow_symlinks=False))
+        except OSError:
+            # Removed while scanning.
+            continue
+
+
+def _scan_node_files(root):
+    """Yields the files of the top of the share and of its node directories.
+
+    The node directories are nodes/<xx>/ and nodes/<node UUID>/, as laid
+    out by share_layout.
+    """
+    for item in _scan(root):
+        yield item
+    nodes_dir = os.path.join(root, share_utils.NODES_DIR)
+    try:
+        entries = list(scandir(nodes_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+        except OSError:
+            continue
+        for item in _scan(entry.path):
+            yield item
+
+
+def _remove_empty_node_dirs(root, nodes, dry_run, now=None):
+    """Removes the node directories left empty for the grace period.
+
+    The directories the busy nodes may be writing to are kept.
+    """
+    if dry_run:
+        return
+    now = time.time() if now is None else now
+    busy_dirs = set()
+    for node_uuid, (_name, provision_state) in nodes.items():
+        if provision_state in BUSY_STATES:
+            busy_dirs.add(node_uuid)
+            busy_dirs.add(share_utils.node_hash_prefix(node_uuid))
+    nodes_dir = os.path.join(root, share_utils.NODES_DIR)
+    try:
+        entries = list(scandir(nodes_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if (not entry.is_dir(follow_symlinks=False) or
+                    entry.name in busy_dirs or
+                    now - entry.stat(follow_symlinks=False).st_mtime <=
+                    CONF.virtmedia_share_gc_grace):
+                # Maybe created for a node being prepared.
+                continue
+            os.rmdir(entry.path)
+        except OSError:
+            # Not empty.
+            continue
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as manifest:
+            manifest = json.load(manifest)
+    except (IOError, OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def _manifest_files(manifest):
+    """Returns the share files a manifest refers to, normalized."""
+    files = set()
+    for key in ('floppy', 'iso'):
+        if manifest.get(key):
+            files.add(os.path.normpath(manifest[key]))
+            files.add(os.path.normpath(manifest[key] +
+                                       image_cache.DIGEST_SUFFIX))
+    for filename in manifest.get('files') or ():
+        files.add(os.path.normpath(filename))
+    return files
+
+
+def _node_dir_uuid(relative_path):
+    """Returns the node UUID of the node directory of a file, if any."""
+    parts = relative_path.split(os.sep)
+    if (len(parts) == 3 and parts[0] == share_utils.NODES_DIR and
+            uuidutils.is_uuid_like(parts[1])):
+        return parts[1]
+    return None
+
+
+def classify(root, nodes, now=None):
+    """Classifies the files of the share.
+
+    :param root: the share root directory.
+    :param nodes: a dictionary mapping the UUID of every existing node to
+        a (name, provision_state) tuple.
+    :param now: the current time, for the grace period of temporary files.
+    :returns: a tuple of (orphans, evictable, total_size); orphans and
+        evictable being lists of ShareFile, evictable ordered least
+        recently used first, and total_size the bytes used, shared inodes
+        and extents counted once.
+    """
+    now = time.time() if now is None else now
+    # The file names of the unnamed nodes hold 'None'. Several nodes may
+    # share a name, a name being busy when any of them is.
+    names = {}
+    for name, provision_state in nodes.values():
+        names['%s' % name] = (names.get('%s' % name, False) or
+                              provision_state in BUSY_STATES)
+    orphans = []
+    evictable = []
+    usage = _Usage()
+
+    # The files of the deleted nodes, and the bases of the busy ones.
+    deleted_files = set()
+    busy_bases = set()
+    manifest_dir = os.path.join(root, share_utils.MANIFEST_DIR)
+    for name, share_file in _scan(manifest_dir):
+        usage.add(share_file)
+        node_uuid = name.rsplit('.', 1)[0]
+        if _TEMPORARY_FILE.search(name):
+            orphans.append(share_file)
+        elif node_uuid not in nodes:
+            orphans.append(share_file)
+            deleted_files |= _manifest_files(_load_manifest(share_file.path))
+        elif nodes[node_uuid][1] in BUSY_STATES:
+            base = _load_manifest(share_file.path).get('base')
+            if base:
+                busy_bases.add(os.path.normpath(base))
+
+    for name, share_file in _scan_node_files(root):
+        usage.add(share_file)
+        if _TEMPORARY_FILE.search(name):
+            if now - share_file.last_used > CONF.virtmedia_share_gc_grace:
+                orphans.append(share_file)
+            continue
+
+        relative_path = os.path.relpath(share_file.path, root)
+        dir_uuid = _node_dir_uuid(relative_path)
+        match = _NODE_NAME_FILE.match(name)
+        if match:
+            node_name = match.group('img') or match.group('iso')
+            # Whether the node owning the file is busy, None when no
+            # existing node owns it.
+            if dir_uuid is not None:
+                busy = (nodes[dir_uuid][1] in BUSY_STATES
+                        if dir_uuid in nodes else None)
+            else:
+                busy = names.get(node_name)
+            if busy is False:
+                evictable.append(share_file)
+            elif busy is None and (dir_uuid is not None or
+                                   relative_path in deleted_files):
+                orphans.append(share_file)
+            # Otherwise busy, or not attributable to a node, like the
+            # files put in the share by the operator.
+            continue
+
+        match = _NODE_UUID_FILE.match(name)
+        if (match and uuidutils.is_uuid_like(match.group('uuid')) and
+                match.group('uuid') not in nodes):
+            orphans.append(share_file)
+
+    cache_dir = os.path.join(root, image_cache.CACHE_DIR)
+    cache_files = list(_scan(cache_dir))
+    # The entries the cache returns for their href.
+    current_entries = set(
+        _load_manifest(share_file.path).get('entry')
+        for name, share_file in cache_files if name.endswith('.json'))
+    superseded = set()
+    for name, share_file in cache_files:
+        usage.add(share_file)
+        if _TEMPORARY_FILE.search(name):
+            if now - share_file.last_used > CONF.virtmedia_share_gc_grace:
+                orphans.append(share_file)
+            continue
+        if name.endswith('.iso'):
+            relative_path = os.path.join(image_cache.CACHE_DIR, name)
+            # Hardlinked entries are still attached as some node's ISO.
+            if share_file.nlink >= 2 or relative_path in busy_bases:
+                continue
+            if (name not in current_entries and now - share_file.last_used >
+                    CONF.virtmedia_share_gc_grace):
+                superseded.add(name)
+                orphans.append(share_file)
+            else:
+                evictable.append(share_file)
+    for name, share_file in cache_files:
+        if name.endswith(image_cache.DIGEST_SUFFIX):
+            entry_name = name[:-len(image_cache.DIGEST_SUFFIX)]
+            if (entry_name in superseded or
+                    not os.path.exists(os.path.join(cache_dir, entry_name))):
+                orphans.append(share_file)
+
+    evictable.sort(key=lambda share_file: share_file.last_used)
+    return orphans, evictable, usage.total
+
+
+def _remove(share_file, dry_run):
+    LOG.info("Share garbage collection: removing %(path)s "
+             "(%(size)d bytes)%(dry)s",
+             {'path': share_file.path, 'size': share_file.size,
+              'dry': ' [dry run]' if dry_run else ''})
+    if not dry_run:
+        ironic_utils.unlink_without_raise(share_file.path)
+
+
+def _by_inode(share_files):
+    """Groups the hardlinks of the same inode, keeping the order."""
+    links = collections.OrderedDict()
+    for share_file in share_files:
+        links.setdefault(share_file.inode, []).append(share_file)
+    return list(links.values())
+
+
+def collect(nodes, dry_run=False, root=None):
+    """Removes orphans and evicts files above the quota.
+
+    Evicting the images of a node invalidates its manifest, so the next
+    preparation of the node rebuilds them.
+
+    :param nodes: a dictionary mapping the UUID of every existing node to
+        a (name, provision_state) tuple.
+    :param dry_run: only log what would be removed.
+    :param root: the share root, defaults to remote_image_share_root.
+    :returns: a dictionary with the number of 'orphans' and 'evicted'
+        files, the 'freed' bytes and the 'used' bytes left.
+    """
+    root = root or CONF.remote_image_share_root
+    orphans, evictable, used = classify(root, nodes)
+    stats = {'orphans': 0, 'evicted': 0, 'freed': 0}
+
+    for links in _by_inode(orphans):
+        for share_file in links:
+            _remove(share_file, dry_run)
+            stats['orphans'] += 1
+        if len(links) >= links[0].nlink:
+            stats['freed'] += links[0].exclusive_size
+    used -= stats['freed']
+
+    quota = CONF.virtmedia_share_quota_bytes
+    if quota:
+        for links in _by_inode(evictable):
+            if used <= quota:
+                break
+            if len(links) < links[0].nlink:
+                # Also linked from a file that is kept, nothing is freed.
+                continue
+            for share_file in links:
+                _remove(share_file, dry_run)
+                stats['evicted'] += 1
+            stats['freed'] += links[0].exclusive_size
+            used -= links[0].exclusive_size
+        if used > quota:
+            LOG.warning("Share %(root)s uses %(used)d bytes, above the "
+                        "%(quota)d bytes quota, and nothing more can be "
+                        "evicted", {'root': root, 'used': used,
+                                    'quota': quota})
+
+    _remove_empty_node_dirs(root, nodes, dry_run)
+    stats['used'] = used
+    METRICS.send_gauge('VirtmediaShareGC.used_bytes', used)
+    METRICS.send_counter('VirtmediaShareGC.freed_bytes', stats['freed'])
+    LOG.debug("Share garbage collection of %(root)s: %(stats)s",
+              {'root': root, 'stats': stats})
+    return stats
+
+
+def get_nodes(context):
+    """Returns all the nodes as expected by collect()."""
+    return dict((node.uuid, (node.name, node.provision_state))
+                for node in objects.Node.list(context))
+
+
+def check_free_space(root=None):
+    """Checks there is enough free space to prepare a node.
+
+    :param root: the share root, defaults to remote_image_share_root.
+    :raises: VirtmediaShareFull, if the free space is below
+        virtmedia_share_min_free_bytes.
+    """
+    required = CONF.virtmedia_share_min_free_bytes
+    if not required:
+        return
+    root = root or CONF.remote_image_share_root
+    stat = os.statvfs(root)
+    free = stat.f_bavail * stat.f_frsize
+    if free < required:
+        raise virtmedia_exception.VirtmediaShareFull(
+            path=root, free=free, required=required)
+
+
+def main():
+    """Entry point of the virtmedia-share-gc command."""
+    parser = argparse.ArgumentParser(
+        description='Garbage collect remote_image_share_root.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only log what would be removed')
+    args, remaining = parser.parse_known_args()
+
+    ironic_service.prepare_service([sys.argv[0]] + remaining)
+    objects.register_all()
+    stats = collect(get_nodes(ironic_context.get_admin_context()),
+                    dry_run=args.dry_run)
+    print(json.dumps(stats, sort_keys=True))
@@ -0,0 +1,272 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-memory index of the files of remote_image_share_root.
+
+validate() is called very often across a fleet, and checking the deploy
+ISO of a node costs a metadata round trip to the share. The index answers
+existence, size and mtime queries of the files at the top of the share
+from memory.
+
+It is kept current with inotify, for the changes made through this host,
+and rebuilt by a full rescan every virtmedia_share_index_rescan_interval
+seconds, for the changes made elsewhere or when inotify is not available.
+The inotify descriptor is non-blocking and its pending events are applied
+when the index is queried, so no thread is involved. A file missing from
+the index is looked up on the share before reporting it missing, and a
+file found in it is looked up again once it was last checked more than
+virtmedia_share_index_entry_ttl seconds ago, so a file removed by another
+host of a network share is not reported present until the next rescan.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import stat
+import struct
+import threading
+import time
+
+from oslo_log import log as logging
+
+from ironic_virtmedia_driver.conf import CONF
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+LOG = logging.getLogger(__name__)
+
+ShareEntry = collections.namedtuple('ShareEntry', ['size', 'mtime'])
+
+# From linux/inotify.h
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF)
+_RESCAN_MASK = _IN_Q_OVERFLOW | _IN_IGNORED | _IN_DELETE_SELF | _IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (AttributeError, OSError, TypeError):
+        return None
+
+_INOTIFY = _load_inotify()
+
+
+def _stat_entry(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    return ShareEntry(file_stat.st_size, file_stat.st_mtime)
+
+
+class ShareIndex(object):
+    """Index of the regular files at the top of a share directory."""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._entries = {}
+        # When the entries changed since the last scan were last checked.
+        self._checked = {}
+        self._root_exists = False
+        self._scanned_at = None
+        self._inotify_fd = None
+
+    def _watch(self):
+        if _INOTIFY is None or self._inotify_fd is not None:
+            return
+        init1, add_watch = _INOTIFY
+        fd = init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            LOG.debug("inotify is not available, the share index relies on "
+                      "rescans only: %s", os.strerror(ctypes.get_errno()))
+            return
+        if add_watch(fd, self.root.encode('utf-8'), _WATCH_MASK) < 0:
+            LOG.debug("Cannot watch %(root)s, the share index relies on "
+                      "rescans only: %(err)s",
+                      {'root': self.root,
+                       'err': os.strerror(ctypes.get_errno())})
+            os.close(fd)
+            return
+        self._inotify_fd = fd
+
+    def _unwatch(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _rescan(self):
+        # Watch first, so nothing changed during the scan is missed.
+        self._watch()
+        entries = {}
+        try:
+            dir_entries = list(scandir(self.root))
+            root_exists = True
+        except OSError:
+            dir_entries = []
+            root_exists = False
+        for entry in dir_entries:
+            try:
+                if entry.is_file():
+                    file_stat = entry.stat()
+                    entries[entry.name] = ShareEntry(file_stat.st_size,
+                                                     file_stat.st_mtime)
+            except OSError:
+                continue
+        self._entries = entries
+        self._checked = {}
+        self._root_exists = root_exists
+        self._scanned_at = time.time()
+        if not root_exists:
+            self._unwatch()
+
+    def _read_events(self):
+        """Returns the names changed since the last call, None to rescan."""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._inotify_fd, _READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                _wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & _RESCAN_MASK:
+                    return None
+                if name and not mask & _IN_ISDIR:
+                    changed.add(name.decode('utf-8', 'replace'))
+
+    def _refresh(self):
+        if (self._scanned_at is None or time.time() - self._scanned_at >=
+                CONF.virtmedia_share_index_rescan_interval):
+            self._rescan()
+            return
+        if self._inotify_fd is None:
+            return
+        changed = self._read_events()
+        if changed is None:
+            self._unwatch()
+            self._rescan()
+            return
+        for name in changed:
+            self._check(name)
+
+    def _check(self, name):
+        """Updates the entry of a file from the share, returns it."""
+        entry = _stat_entry(os.path.join(self.root, name))
+        if entry is None:
+            self._entries.pop(name, None)
+            self._checked.pop(name, None)
+        else:
+            self._entries[name] = entry
+            self._checked[name] = time.time()
+        return entry
+
+    def root_exists(self):
+        """Whether the share root is an existing directory."""
+        with self._lock:
+            self._refresh()
+            return self._root_exists
+
+    def lookup(self, filename):
+        """Returns the ShareEntry of a share file, None if it is missing.
+
+        :param filename: a file name relative to the share root.
+        """
+        if os.sep in filename.strip(os.sep):
+            # Only the top of the share is indexed.
+            return _stat_entry(os.path.join(self.root, filename))
+        filename = filename.strip(os.sep)
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(filename)
+            if (entry is None or
+                    time.time() - self._checked.get(filename,
+                                                    self._scanned_at) >=
+                    CONF.virtmedia_share_index_entry_ttl):
+                entry = self._check(filename)
+            return entry
+
+    def isfile(self, filename):
+        """Whether filename is a regular file of the share."""
+        return self.lookup(filename) is not None
+
+    def list_isos(self):
+        """Returns the ISO inventory of the share.
+
+        :returns: a dictionary mapping the names of the ISO files at the
+            top of the share to their ShareEntry.
+        """
+        with self._lock:
+            self._refresh()
+            return dict((name, entry) for name, entry in self._entries.items()
+                        if name.endswith('.iso'))
+
+    def close(self):
+        with self._lock:
+            self._unwatch()
+
+
+_INDEX = [None]
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index():
+    """Returns the index of remote_image_share_root.
+
+    :returns: a ShareIndex, None when virtmedia_share_index is disabled.
+    """
+    if not CONF.virtmedia_share_index:
+        return None
+    root = CONF.remote_image_share_root
+    with _INDEX_LOCK:
+        if _INDEX[0] is None or _INDEX[0].root != root:
+            if _INDEX[0] is not None:
+                _INDEX[0].close()
+            _INDEX[0] = ShareIndex(root)
+        return _INDEX[0]
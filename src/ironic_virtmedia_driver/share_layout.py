@@ -0,0 +1,218 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Layout of the per-node files in remote_image_share_root.
+
+The floppy image and the deploy and boot ISOs of a node are put, depending
+on virtmedia_share_layout:
+
+* flat: at the top of the share, as they always were;
+* hashed: in nodes/<xx>/, xx being the first two hex digits of the
+  SHA-256 of the node UUID, so 256 directories share the nodes;
+* node: in nodes/<node UUID>/.
+
+The share file names handed to the vendor classes are then relative
+paths, like nodes/3f/deploy-node-1.iso: the Redfish ones append them to
+their remote_share, the Nokia ones point the NFS path of the BMC to the
+directory.
+
+With virtmedia_share_layout_compat, the files of a node left in the other
+layouts are removed along with the current ones. The virtmedia-share-
+migrate command moves the files of the idle nodes to the current layout.
+"""
+
+import argparse
+import errno
+import json
+import os
+import sys
+
+from ironic_lib import utils as ironic_utils
+from oslo_log import log as logging
+
+from ironic.common import context as ironic_context
+from ironic.common import service as ironic_service
+from ironic import objects
+from ironic_virtmedia_driver.conf import CONF
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver import share_gc
+from ironic_virtmedia_driver import share_utils
+
+LOG = logging.getLogger(__name__)
+
+LAYOUTS = ('flat', 'hashed', 'node')
+
+
+def node_dir(node_uuid, layout=None):
+    """Returns the directory of the files of a node, relative to the share.
+
+    :param node_uuid: the UUID of the node.
+    :param layout: one of LAYOUTS, defaults to virtmedia_share_layout.
+    :returns: the directory, '' for the top of the share.
+    """
+    layout = layout or CONF.virtmedia_share_layout
+    if layout == 'hashed':
+        return os.path.join(share_utils.NODES_DIR,
+                            share_utils.node_hash_prefix(node_uuid))
+    if layout == 'node':
+        return os.path.join(share_utils.NODES_DIR, node_uuid)
+    return ''
+
+
+def node_file(node, filename, layout=None):
+    """Returns the share file name of a file of a node.
+
+    :param node: the node the file belongs to.
+    :param filename: the base name of the file, e.g. deploy-<name>.iso.
+    :param layout: one of LAYOUTS, defaults to virtmedia_share_layout.
+    """
+    return os.path.join(node_dir(node.uuid, layout), filename)
+
+
+def stale_files(node, filename):
+    """Returns the share file names a file of a node has in other layouts.
+
+    :returns: an empty list unless virtmedia_share_layout_compat is set.
+    """
+    if not CONF.virtmedia_share_layout_compat:
+        return []
+    current = node_file(node, filename)
+    return [path for path in set(node_file(node, filename, layout)
+                                 for layout in LAYOUTS)
+            if path != current]
+
+
+def ensure_node_dir(node):
+    """Creates the directory of the files of a node, if missing."""
+    directory = node_dir(node.uuid)
+    if not directory:
+        return
+    try:
+        os.makedirs(os.path.join(CONF.remote_image_share_root, directory))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove_empty_node_dir(node_uuid, root=None):
+    """Removes the per-node directory of a node, with the node layout, if empty.
+
+    :param node_uuid: the UUID of the node.
+    :param root: the share root, defaults to remote_image_share_root.
+    """
+    directory = node_dir(node_uuid, 'node')
+    try:
+        os.rmdir(os.path.join(root or CONF.remote_image_share_root,
+                              directory))
+    except OSError:
+        # Missing, or not empty.
+        pass
+
+
+def _node_filenames(node_name, node_uuid):
+    return ['image-%s.img' % node_name, 'deploy-%s.iso' % node_name,
+            'deploy-%s.iso%s' % (node_name, image_cache.DIGEST_SUFFIX),
+            'base-%s.iso' % node_name,
+            'base-%s.iso%s' % (node_name, image_cache.DIGEST_SUFFIX),
+            'boot-%s.iso' % node_uuid]
+
+
+def migrate(nodes, dry_run=False, root=None):
+    """Moves the files of the idle nodes to the current layout.
+
+    When a file is in several layouts, the most recent copy is moved
+    and the others removed, unless it was already rebuilt in the current
+    layout.
+
+    The files of the nodes being deployed or cleaned are left alone, as
+    their BMCs may be reading them; a later run moves them. A moved file
+    invalidates the manifest of its node, so the images are checked
+    again, and attached again, the next time the node is prepared.
+
+    :param nodes: a dictionary mapping the UUID of every existing node to
+        a (name, provision_state) tuple.
+    :param dry_run: only log what would be moved.
+    :param root: the share root, defaults to remote_image_share_root.
+    :returns: a dictionary with the number of files 'moved' and
+        'removed', or to be on a dry run, and of 'busy' nodes skipped.
+    """
+    root = root or CONF.remote_image_share_root
+    layout = CONF.virtmedia_share_layout
+    stats = {'moved': 0, 'removed': 0, 'busy': 0}
+    for node_uuid, (name, provision_state) in nodes.items():
+        moves = []
+        target_dir = node_dir(node_uuid, layout)
+        for filename in _node_filenames(name, node_uuid):
+            target = os.path.join(root, target_dir, filename)
+            sources = [os.path.join(root, node_dir(node_uuid, other),
+                                    filename)
+                       for other in LAYOUTS if other != layout]
+            sources = sorted((source for source in sources
+                              if os.path.isfile(source)),
+                             key=os.path.getmtime, reverse=True)
+            if sources and not os.path.exists(target):
+                moves.append((sources.pop(0), target))
+            # Older copies, or already rebuilt in the current layout.
+            moves.extend((source, None) for source in sources)
+        if not moves:
+            continue
+        if provision_state in share_gc.BUSY_STATES:
+            stats['busy'] += 1
+            continue
+        for source, target in moves:
+            if target is None:
+                LOG.info("Share layout migration: removing %(source)s%(dry)s",
+                         {'source': source,
+                          'dry': ' [dry run]' if dry_run else ''})
+                stats['removed'] += 1
+                if not dry_run:
+                    ironic_utils.unlink_without_raise(source)
+                continue
+            LOG.info("Share layout migration: moving %(source)s to "
+                     "%(target)s%(dry)s",
+                     {'source': source, 'target': target,
+                      'dry': ' [dry run]' if dry_run else ''})
+            stats['moved'] += 1
+            if dry_run:
+                continue
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(source, target)
+        if not dry_run:
+            ironic_utils.unlink_without_raise(os.path.join(
+                root, share_utils.MANIFEST_DIR, '%s.json' % node_uuid))
+            remove_empty_node_dir(node_uuid, root)
+    LOG.debug("Share layout migration of %(root)s to %(layout)s: "
+              "%(stats)s", {'root': root, 'layout': layout, 'stats': stats})
+    return stats
+
+
+def main():
+    """Entry point of the virtmedia-share-migrate command."""
+    parser = argparse.ArgumentParser(
+        description='Move the per-node files of remote_image_share_root '
+                    'to the layout set by virtmedia_share_layout.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only log what would be moved')
+    args, remaining = parser.parse_known_args()
+
+    ironic_service.prepare_service([sys.argv[0]] + remaining)
+    objects.register_all()
+    stats = migrate(share_gc.get_nodes(ironic_context.get_admin_context()),
+                    dry_run=args.dry_run)
+    print(json.dumps(stats, sort_keys=True))
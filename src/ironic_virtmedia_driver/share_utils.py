@@ -0,0 +1,258 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""File helpers for images living in remote_image_share_root."""
+
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from ironic_lib import utils as ironic_utils
+from oslo_log import log as logging
+
+from ironic_virtmedia_driver.conf import CONF
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_DIR = '.virtmedia-manifests'
+
+# The per-node files of the hashed and node share layouts are below it.
+NODES_DIR = 'nodes'
+
+
+def node_hash_prefix(node_uuid):
+    """Returns the directory of a node below NODES_DIR, hashed layout."""
+    return hashlib.sha256(node_uuid.encode('utf-8')).hexdigest()[:2]
+
+# _IOW(0x94, 9, int) from linux/fs.h
+_FICLONE = 0x40049409
+
+_CHUNK_SIZE = 1024 * 1024
+
+_CLONE_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                      errno.EINVAL, errno.ENOSYS)
+
+
+def _data_segments(fd, size):
+    """Yields (offset, length) of the data regions of a sparse file."""
+    if not hasattr(os, 'SEEK_DATA'):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left up to the end of the file.
+                return
+            if e.errno == errno.EINVAL:
+                yield offset, size - offset
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    for offset, length in _data_segments(src_fd, size):
+        while length:
+            copied = os.copy_file_range(src_fd, dst_fd, length,
+                                        offset, offset)
+            if not copied:
+                break
+            offset += copied
+            length -= copied
+    os.ftruncate(dst_fd, size)
+
+
+def clone_file(src_path, dst_path):
+    """Creates dst_path as a copy of src_path without copying its data.
+
+    A reflink (FICLONE) clone is tried first, it shares all the extents
+    with the source until either file is modified. When the file system
+    does not support that, the data is copied in kernel with
+    copy_file_range, skipping the holes of the source, and as a last
+    resort through user space.
+
+    :param src_path: full path of the file to clone.
+    :param dst_path: full path of the clone, replaced if it exists.
+    :returns: the method used, one of 'reflink', 'copy_file_range' or
+        'copy'.
+    """
+    ironic_utils.unlink_without_raise(dst_path)
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return 'reflink'
+        except (IOError, OSError) as e:
+            if e.errno not in _CLONE_UNSUPPORTED:
+                raise
+
+        size = os.fstat(src.fileno()).st_size
+        if hasattr(os, 'copy_file_range'):
+            try:
+                _copy_file_range(src.fileno(), dst.fileno(), size)
+                return 'copy_file_range'
+            except OSError as e:
+                if e.errno not in _CLONE_UNSUPPORTED:
+                    raise
+                LOG.debug("copy_file_range of %(src)s failed: %(err)s",
+                          {'src': src_path, 'err': e})
+                dst.seek(0)
+                dst.truncate()
+                src.seek(0)
+
+        shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+        return 'copy'
+
+
+def link_file(src_path, dst_path):
+    """Makes dst_path a hardlink to src_path.
+
+    Falls back to copying when the share does not support hardlinks.
+    An existing dst_path is replaced atomically.
+
+    :param src_path: full path of the existing file.
+    :param dst_path: full path of the link, replaced if it exists.
+    """
+    with atomic_path(dst_path) as tmp_path:
+        try:
+            os.link(src_path, tmp_path)
+        except OSError as e:
+            LOG.debug("Hardlinking %(src)s failed (%(err)s), copying "
+                      "instead", {'src': src_path, 'err': e})
+            shutil.copyfile(src_path, tmp_path)
+
+
+def _load_syncfs():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.syncfs
+    except (AttributeError, OSError, TypeError):
+        return None
+
+_SYNCFS = _load_syncfs()
+
+
+class _GroupSync(object):
+    """Coalesces concurrent fsync requests into a single syncfs.
+
+    A caller is done once a syncfs of the share file system that started
+    after its request has completed. Callers arriving while a syncfs runs
+    wait for it and are all served by the next one.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._started = 0
+        self._completed = 0
+        self._running = False
+
+    def sync(self, fd):
+        with self._cond:
+            wanted = self._started + 1
+            while self._completed < wanted:
+                if self._running:
+                    self._cond.wait()
+                    continue
+                self._running = True
+                self._started += 1
+                generation = self._started
+                self._cond.release()
+                try:
+                    if _SYNCFS(fd) != 0:
+                        err = ctypes.get_errno()
+                        raise OSError(err, os.strerror(err))
+                finally:
+                    self._cond.acquire()
+                    self._running = False
+                    self._completed = generation
+                    self._cond.notify_all()
+
+
+_GROUP_SYNC = _GroupSync()
+# The batched_fsync blocks the calling thread is in.
+_BATCH = threading.local()
+
+
+@contextlib.contextmanager
+def batched_fsync():
+    """Batches the fsyncs of the share files published in the block.
+
+    Used when many nodes are prepared at once: instead of one fsync per
+    file, the concurrent requests are served by shared syncfs calls.
+    Only the files published by the calling thread are batched, the
+    other threads keep syncing their files one by one.
+    """
+    _BATCH.depth = getattr(_BATCH, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _BATCH.depth -= 1
+
+
+def sync_file(path):
+    """Flushes the data of a share file to stable storage."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if getattr(_BATCH, 'depth', 0) and _SYNCFS is not None:
+            _GROUP_SYNC.sync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def temp_path(final_path):
+    """Returns a unique temporary path next to final_path."""
+    return '%s.%s.tmp' % (final_path, uuid.uuid4().hex[:8])
+
+
+def publish(tmp_path, final_path):
+    """Atomically replaces final_path with the fully written tmp_path.
+
+    Readers of final_path, like a BMC streaming the image over NFS or
+    HTTP, see either the previous file or the new one, never a partially
+    written one.
+
+    :param tmp_path: the temporary file, on the same file system.
+    :param final_path: the path to publish it to.
+    """
+    if CONF.virtmedia_fsync_share_files:
+        sync_file(tmp_path)
+    os.rename(tmp_path, final_path)
+
+
+@contextlib.contextmanager
+def atomic_path(final_path):
+    """Yields a temporary path that is published to final_path on success.
+
+    The temporary file is removed if the block raises.
+    """
+    tmp_path = temp_path(final_path)
+    try:
+        yield tmp_path
+        publish(tmp_path, final_path)
+    finally:
+        ironic_utils.unlink_without_raise(tmp_path)
@@ -0,0 +1,36 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import shutil
+import tempfile
+import unittest
+
+from ironic_virtmedia_driver.conf import CONF
+
+
+class TestCase(unittest.TestCase):
+    """Base test case, restoring the configuration after each test."""
+
+    def config(self, **kwargs):
+        """Overrides configuration options for the duration of the test."""
+        for name, value in kwargs.items():
+            CONF.set_override(name, value)
+            self.addCleanup(CONF.clear_override, name)
+
+    def make_tempdir(self):
+        """Returns a temporary directory removed after the test."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir, True)
+        return tempdir
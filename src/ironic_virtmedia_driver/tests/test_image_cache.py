@@ -0,0 +1,254 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import os
+
+from ironic.common import exception
+
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver.tests import base
+from ironic_virtmedia_driver import virtmedia_exception
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+_HREF = 'http://192.0.2.1/deploy.iso'
+_GLANCE_HREF = '0c9b5d5e-0b5b-4a47-9cc2-5ab1b8c2f5e1'
+_IMAGE = b'deploy iso ' * 1000
+
+
+def _response(status_code=200, body=b'', headers=None):
+    response = mock.MagicMock(status_code=status_code,
+                              headers=headers or {})
+    response.iter_content.side_effect = lambda size: iter(
+        [body[i:i + size] for i in range(0, len(body), size)])
+    return response
+
+
+class ImageCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ImageCacheTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_deploy_iso_cache=True,
+                    virtmedia_deploy_iso_download_connections=1)
+        patcher = mock.patch.object(image_cache.requests, 'get',
+                                    autospec=True)
+        self.mock_get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _stats_delta(self, before):
+        after = image_cache.get_stats()
+        return dict((name, after[name] - before[name]) for name in after)
+
+    def _read(self, path):
+        with open(path, 'rb') as image_file:
+            return image_file.read()
+
+    def test_is_cacheable(self):
+        self.assertTrue(image_cache.is_cacheable(_HREF))
+        self.assertTrue(image_cache.is_cacheable(_GLANCE_HREF))
+        self.assertFalse(image_cache.is_cacheable('/srv/deploy.iso'))
+        self.config(virtmedia_deploy_iso_cache=False)
+        self.assertFalse(image_cache.is_cacheable(_HREF))
+
+    def test_fetch_http_miss(self):
+        self.mock_get.return_value = _response(
+            body=_IMAGE, headers={'ETag': '"v1"',
+                                  'Content-Length': str(len(_IMAGE))})
+        before = image_cache.get_stats()
+
+        path = image_cache.fetch(None, _HREF)
+
+        self.assertEqual(_IMAGE, self._read(path))
+        self.assertEqual(os.path.join(self.root, image_cache.CACHE_DIR),
+                         os.path.dirname(path))
+        self.assertEqual({'sha256': hashlib.sha256(_IMAGE).hexdigest()},
+                         image_cache.get_trusted_digests(path))
+        self.assertEqual({'hits': 0, 'misses': 1, 'revalidations': 0},
+                         self._stats_delta(before))
+        self.mock_get.assert_called_once_with(
+            _HREF, headers={}, stream=True, timeout=60)
+        # Nothing is left but the entry, its digest and the metadata.
+        self.assertEqual(3, len(os.listdir(os.path.dirname(path))))
+
+    def test_fetch_http_revalidated(self):
+        self.mock_get.return_value = _response(
+            body=_IMAGE, headers={'ETag': '"v1"',
+                                  'Last-Modified': 'Fri, 14 Jun 2019'})
+        path = image_cache.fetch(None, _HREF)
+        self.mock_get.reset_mock()
+        self.mock_get.return_value = _response(304)
+        before = image_cache.get_stats()
+
+        self.assertEqual(path, image_cache.fetch(None, _HREF))
+
+        self.mock_get.assert_called_once_with(
+            _HREF, headers={'If-None-Match': '"v1"',
+                            'If-Modified-Since': 'Fri, 14 Jun 2019'},
+            stream=True, timeout=60)
+        self.assertEqual({'hits': 1, 'misses': 0, 'revalidations': 1},
+                         self._stats_delta(before))
+        self.assertEqual(_IMAGE, self._read(path))
+
+    def test_fetch_http_changed(self):
+        self.mock_get.return_value = _response(
+            body=_IMAGE, headers={'ETag': '"v1"'})
+        old_path = image_cache.fetch(None, _HREF)
+        self.mock_get.return_value = _response(
+            body=b'new image', headers={'ETag': '"v2"'})
+
+        path = image_cache.fetch(None, _HREF)
+
+        self.assertNotEqual(old_path, path)
+        self.assertEqual(b'new image', self._read(path))
+        # Left to the share garbage collection, as a caller may be about
+        # to link it.
+        self.assertEqual(_IMAGE, self._read(old_path))
+
+    def test_fetch_http_entry_removed(self):
+        self.mock_get.return_value = _response(
+            body=_IMAGE, headers={'ETag': '"v1"'})
+        path = image_cache.fetch(None, _HREF)
+        os.unlink(path)
+        self.mock_get.reset_mock()
+
+        self.assertEqual(path, image_cache.fetch(None, _HREF))
+
+        # Not revalidated, as there is nothing to revalidate.
+        self.mock_get.assert_called_once_with(
+            _HREF, headers={}, stream=True, timeout=60)
+        self.assertEqual(_IMAGE, self._read(path))
+
+    def test_fetch_http_truncated(self):
+        self.mock_get.return_value = _response(
+            body=_IMAGE[:100], headers={'ETag': '"v1"',
+                                        'Content-Length': str(len(_IMAGE))})
+
+        self.assertRaises(exception.ImageDownloadFailed,
+                          image_cache.fetch, None, _HREF)
+
+        self.assertEqual([], [name for name in os.listdir(
+            os.path.join(self.root, image_cache.CACHE_DIR))
+            if not name.endswith('.json')])
+
+    def test_fetch_http_encoded_length_not_checked(self):
+        self.mock_get.return_value = _response(
+            body=_IMAGE, headers={'Content-Length': '100',
+                                  'Content-Encoding': 'gzip'})
+
+        self.assertEqual(_IMAGE, self._read(image_cache.fetch(None, _HREF)))
+
+    def test_fetch_http_error(self):
+        self.mock_get.return_value = _response(404)
+
+        self.assertRaises(exception.ImageDownloadFailed,
+                          image_cache.fetch, None, _HREF)
+
+    def test_fetch_http_ranges(self):
+        self.config(virtmedia_deploy_iso_download_connections=4,
+                    virtmedia_deploy_iso_download_segment_mb=1)
+        image = bytes(bytearray(i % 251 for i in range(3 * 1024 * 1024 + 7)))
+
+        def get(href, headers=None, **kwargs):
+            if not headers:
+                return _response(body=image, headers={
+                    'ETag': '"v1"', 'Accept-Ranges': 'bytes',
+                    'Content-Length': str(len(image))})
+            self.assertEqual('"v1"', headers['If-Range'])
+            start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+            return _response(206, image[start:end + 1], headers={
+                'Content-Range': 'bytes %d-%d/%d' % (start, end, len(image))})
+
+        self.mock_get.side_effect = get
+
+        path = image_cache.fetch(None, _HREF)
+
+        self.assertEqual(image, self._read(path))
+        self.assertEqual(hashlib.sha256(image).hexdigest(),
+                         image_cache.get_trusted_digests(path)['sha256'])
+        # The first GET and one per segment, the last one of 7 bytes.
+        self.assertEqual(5, self.mock_get.call_count)
+
+    def test_fetch_http_ranges_not_supported(self):
+        self.config(virtmedia_deploy_iso_download_connections=4,
+                    virtmedia_deploy_iso_download_segment_mb=1)
+        image = b'x' * (3 * 1024 * 1024)
+        headers = {'ETag': '"v1"', 'Accept-Ranges': 'bytes',
+                   'Content-Length': str(len(image))}
+        # The ranges are answered with the whole image.
+        self.mock_get.side_effect = lambda *args, **kwargs: _response(
+            body=image, headers=headers)
+
+        self.assertEqual(image, self._read(image_cache.fetch(None, _HREF)))
+
+
+@mock.patch.object(image_cache.image_service, 'get_image_service')
+class GlanceImageCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(GlanceImageCacheTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_deploy_iso_cache=True)
+
+    def _service(self, mock_get_service, image_info, image=_IMAGE):
+        service = mock_get_service.return_value
+        service.show.return_value = image_info
+        service.download.side_effect = (
+            lambda href, image_file: image_file.write(image))
+        return service
+
+    def test_fetch(self, mock_get_service):
+        service = self._service(mock_get_service, {
+            'os_hash_algo': 'sha512',
+            'os_hash_value': hashlib.sha512(_IMAGE).hexdigest(),
+            'size': len(_IMAGE)})
+
+        path = image_cache.fetch(None, _GLANCE_HREF)
+        self.assertEqual(path, image_cache.fetch(None, _GLANCE_HREF))
+
+        self.assertEqual(1, service.download.call_count)
+        self.assertEqual(hashlib.sha512(_IMAGE).hexdigest(),
+                         image_cache.get_trusted_digests(path)['sha512'])
+
+    def test_fetch_checksum_mismatch(self, mock_get_service):
+        self._service(mock_get_service, {'checksum': 'f' * 32})
+
+        self.assertRaises(virtmedia_exception.ImageChecksumMismatch,
+                          image_cache.fetch, None, _GLANCE_HREF)
+
+        self.assertEqual([], os.listdir(
+            os.path.join(self.root, image_cache.CACHE_DIR)))
+
+    def test_fetch_no_checksum(self, mock_get_service):
+        service = self._service(mock_get_service, {})
+
+        path = image_cache.fetch(None, _GLANCE_HREF)
+        self.assertEqual(path, image_cache.fetch(None, _GLANCE_HREF))
+
+        self.assertEqual(1, service.download.call_count)
+        with open(path, 'rb') as image_file:
+            self.assertEqual(_IMAGE, image_file.read())
+        with open(os.path.join(self.root, image_cache.CACHE_DIR, '%s.json' %
+                               image_cache._digest(_GLANCE_HREF))) as meta:
+            meta = json.load(meta)
+        self.assertEqual('sha256:%s' % hashlib.sha256(_IMAGE).hexdigest(),
+                         meta['validator'])
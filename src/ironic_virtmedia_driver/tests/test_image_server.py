@@ -0,0 +1,268 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import email.utils
+import json
+import os
+import threading
+import time
+
+from six.moves import http_client
+
+from ironic_virtmedia_driver import image_server
+from ironic_virtmedia_driver.tests import base
+
+_IMAGE = bytes(bytearray(i % 251 for i in range(100000)))
+
+
+class ParseRangeTestCase(base.TestCase):
+
+    def test_parse_range(self):
+        for header, expected in (('bytes=0-99', (0, 99)),
+                                 ('bytes=100-', (100, 999)),
+                                 ('bytes=900-2000', (900, 999)),
+                                 ('bytes=-100', (900, 999)),
+                                 ('bytes=-5000', (0, 999)),
+                                 ('bytes=1000-', False),
+                                 ('bytes=-0', False),
+                                 ('bytes=5-2', None),
+                                 ('bytes=0-1,5-6', None),
+                                 ('items=0-1', None),
+                                 ('bytes=-', None)):
+            self.assertEqual(expected,
+                             image_server._parse_range(header, 1000), header)
+
+    def test_node_of_file(self):
+        self.assertEqual('node-1', image_server.node_of_file(
+            'nodes/3f/deploy-node-1.iso'))
+        self.assertEqual('node-1', image_server.node_of_file(
+            'image-node-1.img'))
+        self.assertIsNone(image_server.node_of_file('deploy.iso'))
+
+
+class ImageServerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ImageServerTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(virtmedia_image_server_prefix='/bootimages/',
+                    virtmedia_image_server_max_connections_per_client=8,
+                    virtmedia_image_server_keepalive_timeout=30,
+                    virtmedia_image_server_stats=False)
+        self._write('deploy-node-1.iso', _IMAGE)
+        self._write('nodes/3f/image-node-2.img', b'floppy')
+        self._write('.virtmedia-cache/cached.iso', b'cached')
+        self._write('.virtmedia-manifests/node.json', b'{}')
+        self._write('notes.txt', b'notes')
+        self.mtime = os.path.getmtime(os.path.join(self.root,
+                                                   'deploy-node-1.iso'))
+
+    def _write(self, relative_path, contents):
+        path = os.path.join(self.root, relative_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as share_file:
+            share_file.write(contents)
+
+    def _start(self):
+        server = image_server.create_server(root=self.root,
+                                            host='127.0.0.1', port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _connect(self, server):
+        connection = http_client.HTTPConnection(*server.server_address,
+                                                timeout=10)
+        self.addCleanup(connection.close)
+        return connection
+
+    def _request(self, server, path, headers=None, method='GET',
+                 connection=None):
+        connection = connection or self._connect(server)
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_get(self):
+        server = self._start()
+
+        response, body = self._request(server,
+                                       '/bootimages/deploy-node-1.iso')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(_IMAGE, body)
+        self.assertEqual('bytes', response.getheader('Accept-Ranges'))
+        self.assertIsNotNone(response.getheader('ETag'))
+
+        response, body = self._request(server,
+                                       '/bootimages/nodes/3f/image-node-2.img')
+        self.assertEqual(b'floppy', body)
+
+    def test_head(self):
+        server = self._start()
+
+        response, body = self._request(
+            server, '/bootimages/deploy-node-1.iso', method='HEAD')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(str(len(_IMAGE)),
+                         response.getheader('Content-Length'))
+        self.assertEqual(b'', body)
+
+    def test_range(self):
+        server = self._start()
+        connection = self._connect(server)
+
+        # Several requests on a kept alive connection.
+        for header, start, end in (('bytes=0-2047', 0, 2047),
+                                   ('bytes=99000-', 99000, 99999),
+                                   ('bytes=-10', 99990, 99999),
+                                   ('bytes=99990-200000', 99990, 99999)):
+            response, body = self._request(
+                server, '/bootimages/deploy-node-1.iso',
+                headers={'Range': header}, connection=connection)
+            self.assertEqual(206, response.status, header)
+            self.assertEqual(_IMAGE[start:end + 1], body, header)
+            self.assertEqual('bytes %d-%d/%d' % (start, end, len(_IMAGE)),
+                             response.getheader('Content-Range'))
+
+    def test_range_not_satisfiable(self):
+        server = self._start()
+
+        response, body = self._request(
+            server, '/bootimages/deploy-node-1.iso',
+            headers={'Range': 'bytes=100000-'})
+
+        self.assertEqual(416, response.status)
+        self.assertEqual('bytes */%d' % len(_IMAGE),
+                         response.getheader('Content-Range'))
+        self.assertEqual(b'', body)
+
+    def test_if_range(self):
+        server = self._start()
+        response, _body = self._request(server,
+                                        '/bootimages/deploy-node-1.iso')
+        etag = response.getheader('ETag')
+
+        response, body = self._request(
+            server, '/bootimages/deploy-node-1.iso',
+            headers={'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual(206, response.status)
+        self.assertEqual(_IMAGE[:10], body)
+
+        # Changed since, the whole file is sent.
+        response, body = self._request(
+            server, '/bootimages/deploy-node-1.iso',
+            headers={'Range': 'bytes=0-9', 'If-Range': '"other"'})
+        self.assertEqual(200, response.status)
+        self.assertEqual(_IMAGE, body)
+
+    def test_not_modified(self):
+        server = self._start()
+        response, _body = self._request(server,
+                                        '/bootimages/deploy-node-1.iso')
+        etag = response.getheader('ETag')
+
+        for headers in ({'If-None-Match': etag},
+                        {'If-None-Match': '"other", %s' % etag},
+                        {'If-Modified-Since': email.utils.formatdate(
+                            self.mtime + 60, usegmt=True)}):
+            response, body = self._request(
+                server, '/bootimages/deploy-node-1.iso', headers=headers)
+            self.assertEqual(304, response.status, headers)
+            self.assertEqual(etag, response.getheader('ETag'))
+            self.assertEqual(b'', body)
+
+        for headers in ({'If-None-Match': '"other"'},
+                        {'If-Modified-Since': email.utils.formatdate(
+                            self.mtime - 60, usegmt=True)}):
+            response, body = self._request(
+                server, '/bootimages/deploy-node-1.iso', headers=headers)
+            self.assertEqual(200, response.status, headers)
+            self.assertEqual(_IMAGE, body)
+
+    def test_refused(self):
+        outside = os.path.join(os.path.dirname(self.root), 'outside.iso')
+        with open(outside, 'wb') as outside_file:
+            outside_file.write(b'outside')
+        self.addCleanup(os.unlink, outside)
+        os.symlink(outside, os.path.join(self.root, 'link.iso'))
+        server = self._start()
+        connection = self._connect(server)
+
+        for path in ('/bootimages/.virtmedia-cache/cached.iso',
+                     '/bootimages/.virtmedia-manifests/node.json',
+                     '/bootimages/notes.txt',
+                     '/bootimages/../outside.iso',
+                     '/bootimages/%2e%2e/outside.iso',
+                     '/bootimages/nodes/../../outside.iso',
+                     '/bootimages/link.iso',
+                     '/bootimages/missing.iso',
+                     '/bootimages/nodes',
+                     '/deploy-node-1.iso'):
+            response, body = self._request(server, path,
+                                           connection=connection)
+            self.assertEqual(404, response.status, path)
+            self.assertEqual(b'', body)
+
+    def test_connections_per_client(self):
+        self.config(virtmedia_image_server_max_connections_per_client=1)
+        server = self._start()
+        held = self._connect(server)
+        response, _body = self._request(
+            server, '/bootimages/nodes/3f/image-node-2.img', connection=held)
+        self.assertEqual(200, response.status)
+
+        # The kept alive connection holds the only one allowed.
+        response, body = self._request(
+            server, '/bootimages/nodes/3f/image-node-2.img')
+        self.assertEqual(503, response.status)
+        self.assertEqual('1', response.getheader('Retry-After'))
+
+        held.close()
+        for _i in range(50):
+            if not server.get_stats()['connections']:
+                break
+            time.sleep(0.1)
+        response, body = self._request(
+            server, '/bootimages/nodes/3f/image-node-2.img')
+        self.assertEqual(200, response.status)
+        self.assertEqual(b'floppy', body)
+
+    def test_stats(self):
+        server = self._start()
+        self._request(server, '/bootimages/deploy-node-1.iso',
+                      headers={'Range': 'bytes=0-99'})
+        self._request(server, '/bootimages/deploy-node-1.iso',
+                      headers={'Range': 'bytes=-10'})
+        self._request(server, '/bootimages/nodes/3f/image-node-2.img')
+        self._request(server, '/bootimages/deploy-node-1.iso',
+                      method='HEAD')
+
+        response, _body = self._request(server, image_server.STATS_PATH)
+        self.assertEqual(404, response.status)
+
+        self.config(virtmedia_image_server_stats=True)
+        response, body = self._request(server, image_server.STATS_PATH)
+        self.assertEqual(200, response.status)
+        stats = json.loads(body.decode('utf-8'))
+        self.assertEqual({'node-1': 110, 'node-2': 6}, stats['nodes'])
+        self.assertEqual({'deploy-node-1.iso': 110,
+                          os.path.join('nodes', '3f', 'image-node-2.img'): 6},
+                         stats['files'])
@@ -0,0 +1,164 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from ironic_virtmedia_driver import iso9660
+
+try:
+    import pycdlib
+except ImportError:
+    pycdlib = None
+
+_PARAMS = b'ipa-api-url=http://192.0.2.1:6385\n'
+_FLOPPY = b'\xeb\x3c\x90' + b'\0' * 5000
+
+
+@unittest.skipIf(pycdlib is None, 'pycdlib is not installed')
+class AddFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.iso_path = os.path.join(self.tmpdir, 'deploy.iso')
+
+    def _make_iso(self, joliet=True, rock_ridge=True):
+        iso = pycdlib.PyCdlib()
+        iso.new(joliet=3 if joliet else None,
+                rock_ridge='1.09' if rock_ridge else None,
+                vol_ident='DEPLOY')
+        kwargs = {}
+        if joliet:
+            kwargs['joliet_path'] = '/isolinux'
+        if rock_ridge:
+            kwargs['rr_name'] = 'isolinux'
+        iso.add_directory('/ISOLINUX', **kwargs)
+        kwargs = {}
+        if joliet:
+            kwargs['joliet_path'] = '/isolinux/isolinux.bin'
+        if rock_ridge:
+            kwargs['rr_name'] = 'isolinux.bin'
+        boot = b'\xfa' * 4096
+        iso.add_fp(io.BytesIO(boot), len(boot), '/ISOLINUX/ISOLINUX.BIN;1',
+                   **kwargs)
+        iso.add_eltorito('/ISOLINUX/ISOLINUX.BIN;1', '/ISOLINUX/BOOT.CAT;1')
+        kwargs = {}
+        if joliet:
+            kwargs['joliet_path'] = '/vmlinuz'
+        if rock_ridge:
+            kwargs['rr_name'] = 'vmlinuz'
+        kernel = b'kernel' * 1000
+        iso.add_fp(io.BytesIO(kernel), len(kernel), '/VMLINUZ.;1', **kwargs)
+        iso.write(self.iso_path)
+        iso.close()
+
+    def _read(self, iso, **path):
+        output = io.BytesIO()
+        iso.get_file_from_iso_fp(output, **path)
+        return output.getvalue()
+
+    def _children(self, iso, **path):
+        return set(child.file_identifier()
+                   for child in iso.list_children(**path)
+                   if not child.is_dot() and not child.is_dotdot())
+
+    def test_add_files_rock_ridge_joliet(self):
+        self._make_iso()
+        size = os.path.getsize(self.iso_path)
+
+        start, written = iso9660.add_files(
+            self.iso_path, 'virtmedia',
+            [('params', _PARAMS), ('floppy.img', _FLOPPY)])
+
+        # Only the descriptors are rewritten, the rest is appended.
+        self.assertEqual(size, start)
+        self.assertLess(size, os.path.getsize(self.iso_path))
+        self.assertEqual(0, os.path.getsize(self.iso_path) %
+                         iso9660.SECTOR_SIZE)
+        self.assertLessEqual(os.path.getsize(self.iso_path) - size, written)
+        iso = pycdlib.PyCdlib()
+        iso.open(self.iso_path)
+        try:
+            self.assertEqual(_PARAMS, self._read(
+                iso, rr_path='/virtmedia/params'))
+            self.assertEqual(_FLOPPY, self._read(
+                iso, rr_path='/virtmedia/floppy.img'))
+            self.assertEqual(_PARAMS, self._read(
+                iso, joliet_path='/virtmedia/params'))
+            self.assertEqual(_FLOPPY, self._read(
+                iso, joliet_path='/virtmedia/floppy.img'))
+            self.assertEqual(_PARAMS, self._read(
+                iso, iso_path='/VIRTMEDIA/PARAMS.;1'))
+            # The original files are still found.
+            self.assertEqual(b'kernel' * 1000, self._read(
+                iso, rr_path='/vmlinuz'))
+            self.assertEqual(b'\xfa' * 4096, self._read(
+                iso, joliet_path='/isolinux/isolinux.bin'))
+            self.assertIsNotNone(iso.eltorito_boot_catalog)
+        finally:
+            iso.close()
+
+    def test_add_files_replaces_directory(self):
+        self._make_iso()
+        iso9660.add_files(self.iso_path, 'virtmedia',
+                          [('params', b'old\n'), ('stale', b'x')])
+        iso9660.add_files(self.iso_path, 'virtmedia', [('params', _PARAMS)])
+
+        iso = pycdlib.PyCdlib()
+        iso.open(self.iso_path)
+        try:
+            self.assertEqual(_PARAMS, self._read(
+                iso, rr_path='/virtmedia/params'))
+            self.assertEqual(set(['params'.encode('utf-16-be')]),
+                             self._children(iso, joliet_path='/virtmedia'))
+            self.assertEqual(1, len([
+                child for child in iso.list_children(joliet_path='/')
+                if child.file_identifier() ==
+                'virtmedia'.encode('utf-16-be')]))
+        finally:
+            iso.close()
+
+    def test_add_files_plain_iso9660(self):
+        self._make_iso(joliet=False, rock_ridge=False)
+        iso9660.add_files(self.iso_path, 'virtmedia', [('params', _PARAMS)])
+
+        iso = pycdlib.PyCdlib()
+        iso.open(self.iso_path)
+        try:
+            self.assertEqual(_PARAMS, self._read(
+                iso, iso_path='/VIRTMEDIA/PARAMS.;1'))
+            self.assertEqual(b'kernel' * 1000, self._read(
+                iso, iso_path='/VMLINUZ.;1'))
+        finally:
+            iso.close()
+
+    def test_add_files_invalid_name(self):
+        self._make_iso()
+        with open(self.iso_path, 'rb') as iso_file:
+            before = iso_file.read()
+        self.assertRaises(ValueError, iso9660.add_files, self.iso_path,
+                          'virtmedia', [('../params', _PARAMS)])
+        with open(self.iso_path, 'rb') as iso_file:
+            self.assertEqual(before, iso_file.read())
+
+    def test_add_files_not_iso9660(self):
+        with open(self.iso_path, 'wb') as iso_file:
+            iso_file.write(b'\0' * 40 * iso9660.SECTOR_SIZE)
+        self.assertRaises(iso9660.ISO9660Error, iso9660.add_files,
+                          self.iso_path, 'virtmedia', [('params', _PARAMS)])
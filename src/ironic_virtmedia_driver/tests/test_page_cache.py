@@ -0,0 +1,122 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import errno
+import os
+import unittest
+
+from ironic_virtmedia_driver import page_cache
+from ironic_virtmedia_driver.tests import base
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'posix_fadvise needed')
+class PageCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(PageCacheTestCase, self).setUp()
+        self.config(virtmedia_page_cache_warm=True,
+                    virtmedia_page_cache_drop_node_images=True)
+        self.path = os.path.join(self.make_tempdir(), 'deploy.iso')
+        with open(self.path, 'wb') as image_file:
+            image_file.write(b'x' * 10000)
+        self.addCleanup(page_cache._active.clear)
+        patcher = mock.patch.object(os, 'posix_fadvise',
+                                    wraps=os.posix_fadvise)
+        self.mock_fadvise = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _advised(self):
+        return [call[0][1:] for call in self.mock_fadvise.call_args_list]
+
+    @mock.patch.object(page_cache, '_WARM_CHUNK', 4096)
+    def test_warm(self):
+        page_cache.warm(self.path)
+
+        self.assertEqual([(0, 4096, os.POSIX_FADV_WILLNEED),
+                          (4096, 4096, os.POSIX_FADV_WILLNEED),
+                          (8192, 1808, os.POSIX_FADV_WILLNEED)],
+                         self._advised())
+        self.assertEqual(set([self.path]), page_cache._active)
+
+    def test_warm_disabled(self):
+        self.config(virtmedia_page_cache_warm=False)
+
+        page_cache.warm(self.path)
+
+        self.assertFalse(self.mock_fadvise.called)
+        self.assertEqual(set(), page_cache._active)
+
+    def test_warm_missing(self):
+        page_cache.warm(self.path + '.missing')
+
+        self.assertEqual(set(), page_cache._active)
+
+    def test_drop(self):
+        page_cache.drop(self.path)
+        page_cache.drop(self.path, 8192)
+        page_cache.drop(self.path, 4096, 4096)
+
+        self.assertEqual([(0, 0, os.POSIX_FADV_DONTNEED),
+                          (8192, 0, os.POSIX_FADV_DONTNEED),
+                          (4096, 4096, os.POSIX_FADV_DONTNEED)],
+                         self._advised())
+
+    def test_drop_disabled(self):
+        self.config(virtmedia_page_cache_drop_node_images=False)
+
+        page_cache.drop(self.path)
+
+        self.assertFalse(self.mock_fadvise.called)
+
+    @unittest.skipIf(page_cache._LIBC is None, 'libc mincore needed')
+    def test_resident_fraction(self):
+        with open(self.path, 'rb') as image_file:
+            image_file.read()
+
+        self.assertEqual(1.0, page_cache.resident_fraction(self.path))
+
+        empty_path = self.path + '.empty'
+        open(empty_path, 'wb').close()
+        self.assertEqual(1.0, page_cache.resident_fraction(empty_path))
+
+    @mock.patch.object(page_cache.METRICS, 'send_gauge', autospec=True)
+    def test_report(self, mock_gauge):
+        other_path = self.path + '.other'
+        with open(other_path, 'wb') as image_file:
+            image_file.write(b'x')
+        for path in (self.path, other_path, self.path + '.missing'):
+            page_cache._active.add(path)
+        fractions = {self.path: 0.5, other_path: 1.0}
+
+        def _resident_fraction(path):
+            if path not in fractions:
+                raise OSError(errno.ENOENT, 'No such file')
+            return fractions[path]
+
+        with mock.patch.object(page_cache, 'resident_fraction',
+                               side_effect=_resident_fraction):
+            with mock.patch.object(page_cache, 'warm') as mock_warm:
+                self.assertEqual(fractions, page_cache.report())
+
+        mock_warm.assert_called_once_with(self.path)
+        # A single gauge, whatever the images.
+        mock_gauge.assert_called_once_with(
+            'VirtmediaPageCache.resident_percent', 50)
+        self.assertEqual(set([self.path, other_path]), page_cache._active)
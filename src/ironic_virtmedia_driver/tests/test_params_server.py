@@ -0,0 +1,228 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import socket
+
+from six.moves import http_client
+
+from ironic.common import exception
+from ironic.common import states
+from ironic_virtmedia_driver import params_server
+from ironic_virtmedia_driver.tests import base
+from ironic_virtmedia_driver import virtmedia_exception
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+_NODE = '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+_PARAMS = b'ipa-api-url=http://192.0.2.1:6385\nboot_mac=52:54:00:12:34:56\n'
+
+
+class FakeNode(object):
+
+    def __init__(self, provision_state=states.DEPLOYWAIT):
+        self.id = 7
+        self.uuid = _NODE
+        self.provision_state = provision_state
+        self.driver_internal_info = {}
+        self.save = mock.Mock()
+
+
+class ParamsServerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ParamsServerTestCase, self).setUp()
+        self.config(virtmedia_params_server_host='127.0.0.1',
+                    virtmedia_params_server_port=0)
+        for name in ('_TABLE', '_NODE_KEYS'):
+            patcher = mock.patch.dict(getattr(params_server, name),
+                                      clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(params_server, '_SERVER', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node = FakeNode()
+        self.mock_node = self._patch_object('Node')
+        self.mock_port = self._patch_object('Port')
+
+    def _patch_object(self, name):
+        patcher = mock.patch.object(params_server.objects, name,
+                                    create=True)
+        mock_object = patcher.start()
+        self.addCleanup(patcher.stop)
+        for method in ('get_by_uuid', 'get_by_id', 'get_by_address'):
+            getattr(mock_object, method).side_effect = exception.NotFound()
+        return mock_object
+
+    def _restart(self):
+        """Publishes the parameters, in the node, before a restart."""
+        self._start()
+        params_server.publish_node(self.node, ['52:54:00:12:34:56'],
+                                   _PARAMS)
+        params_server._TABLE.clear()
+        params_server._NODE_KEYS.clear()
+        self.mock_node.get_by_uuid.side_effect = None
+        self.mock_node.get_by_uuid.return_value = self.node
+        self.mock_node.get_by_id.side_effect = None
+        self.mock_node.get_by_id.return_value = self.node
+        self.mock_port.get_by_address.side_effect = None
+        self.mock_port.get_by_address.return_value = mock.Mock(
+            node_id=self.node.id)
+
+    def _start(self):
+        server = params_server.ensure_started()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _request(self, server, path, method='GET'):
+        connection = http_client.HTTPConnection(*server.server_address,
+                                                timeout=10)
+        self.addCleanup(connection.close)
+        connection.request(method, path)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_publish_lookup_withdraw(self):
+        self._start()
+        params_server.publish(_NODE, ['52-54-00-12-34-56', None,
+                                      '5254.0012.3457'], _PARAMS)
+
+        for key in (_NODE, _NODE.upper(), '52:54:00:12:34:56',
+                    '52:54:00:12:34:57', '525400123456', ' 52-54-00-12-34-56'):
+            self.assertEqual(_PARAMS, params_server.lookup(key))
+        self.assertIsNone(params_server.lookup('52:54:00:12:34:58'))
+
+        params_server.publish(_NODE, ['52:54:00:12:34:58'], b'new')
+        self.assertIsNone(params_server.lookup('52:54:00:12:34:56'))
+        self.assertEqual(b'new', params_server.lookup('52:54:00:12:34:58'))
+
+        params_server.withdraw(_NODE)
+        self.assertIsNone(params_server.lookup(_NODE))
+        self.assertIsNone(params_server.lookup('52:54:00:12:34:58'))
+        self.assertEqual({}, params_server._TABLE)
+        # Withdrawing twice does not fail.
+        params_server.withdraw(_NODE)
+
+    def test_http(self):
+        server = self._start()
+        self.assertEqual('127.0.0.1', server.server_address[0])
+        params_server.publish(_NODE, ['52:54:00:12:34:56'], _PARAMS)
+
+        response, body = self._request(server,
+                                       '/v1/params/52-54-00-12-34-56')
+        self.assertEqual(200, response.status)
+        self.assertEqual(_PARAMS, body)
+        self.assertEqual('no-store', response.getheader('Cache-Control'))
+
+        response, body = self._request(server, '/v1/params/%s' % _NODE,
+                                       method='HEAD')
+        self.assertEqual(200, response.status)
+        self.assertEqual(str(len(_PARAMS)),
+                         response.getheader('Content-Length'))
+
+        for path in ('/v1/params/52:54:00:12:34:57', '/v1/params/',
+                     '/%s' % _NODE):
+            response, body = self._request(server, path)
+            self.assertEqual(404, response.status)
+            self.assertEqual(b'', body)
+
+        params_server.withdraw(_NODE)
+        response, _body = self._request(server, '/v1/params/%s' % _NODE)
+        self.assertEqual(404, response.status)
+
+    def test_started_once(self):
+        server = self._start()
+
+        params_server.publish(_NODE, [], _PARAMS)
+
+        self.assertIs(server, params_server.ensure_started())
+
+    def test_start_address_in_use(self):
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.config(virtmedia_params_server_port=listener.getsockname()[1])
+
+        self.assertRaises(virtmedia_exception.VirtmediaOperationError,
+                          params_server.ensure_started)
+        self.assertIsNone(params_server._SERVER)
+
+    def test_publish_node_withdraw_node(self):
+        self._start()
+        params_server.publish_node(self.node, ['52-54-00-12-34-56', None],
+                                   _PARAMS)
+
+        self.assertEqual(_PARAMS, params_server.lookup('52:54:00:12:34:56'))
+        self.assertEqual(
+            {'macs': ['52:54:00:12:34:56'],
+             'contents': _PARAMS.decode('utf-8')},
+            self.node.driver_internal_info[params_server.PARAMS_INFO])
+        self.node.save.assert_called_once_with()
+
+        params_server.withdraw_node(self.node)
+        params_server.withdraw_node(self.node)
+
+        self.assertIsNone(params_server.lookup(_NODE))
+        self.assertEqual({}, self.node.driver_internal_info)
+        self.assertEqual(2, self.node.save.call_count)
+
+    def test_lookup_after_restart_by_mac(self):
+        self._restart()
+
+        self.assertEqual(_PARAMS, params_server.lookup('52-54-00-12-34-56'))
+        self.mock_port.get_by_address.assert_called_once_with(
+            None, '52:54:00:12:34:56')
+        self.mock_node.get_by_id.assert_called_once_with(None, self.node.id)
+        # Published again for all its keys.
+        self.assertEqual(_PARAMS, params_server.lookup(_NODE))
+        self.assertFalse(self.mock_node.get_by_uuid.called)
+
+    def test_http_after_restart_by_uuid(self):
+        self._restart()
+        server = params_server.ensure_started()
+
+        response, body = self._request(server, '/v1/params/%s' % _NODE)
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(_PARAMS, body)
+        self.mock_node.get_by_uuid.assert_called_once_with(None, _NODE)
+
+    def test_lookup_after_restart_not_published(self):
+        self._restart()
+        self.node.provision_state = states.ACTIVE
+
+        self.assertIsNone(params_server.lookup(_NODE))
+
+        self.node.provision_state = states.DEPLOYWAIT
+        self.node.driver_internal_info = {}
+        self.assertIsNone(params_server.lookup('52:54:00:12:34:56'))
+
+        self.mock_node.get_by_uuid.reset_mock()
+        self.mock_port.get_by_address.reset_mock()
+        for key in ('', 'params', '52:54:00:12:34'):
+            self.assertIsNone(params_server.lookup(key))
+        self.assertFalse(self.mock_node.get_by_uuid.called)
+        self.assertFalse(self.mock_port.get_by_address.called)
+
+    def test_lookup_after_restart_unknown(self):
+        self._start()
+
+        self.assertIsNone(params_server.lookup(_NODE))
+        self.assertIsNone(params_server.lookup('52:54:00:12:34:56'))
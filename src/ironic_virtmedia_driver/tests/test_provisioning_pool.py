@@ -0,0 +1,193 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from ironic.common import exception
+
+from ironic_virtmedia_driver import provisioning_pool
+from ironic_virtmedia_driver.tests import base
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+_NODE = '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+
+
+class ParseTestCase(base.TestCase):
+
+    def test_parse_single(self):
+        servers = provisioning_pool.parse('192.0.2.1', 80)
+
+        self.assertEqual(1, len(servers))
+        self.assertEqual(('192.0.2.1', '80'), servers[0].key)
+
+    def test_parse_single_ipv6(self):
+        servers = provisioning_pool.parse('2001:db8::1', 8080)
+
+        self.assertEqual([('2001:db8::1', '8080')],
+                         [server.key for server in servers])
+
+    def test_parse_pool(self):
+        servers = provisioning_pool.parse(
+            '192.0.2.1:8080;weight=2;subnet=10.0.0.0/24;locality=rack1, '
+            '[2001:db8::1];subnet=10.0.1.0/24;subnet=10.0.2.0/24,'
+            'images.example.com', 80)
+
+        self.assertEqual([('192.0.2.1', '8080'), ('2001:db8::1', '80'),
+                          ('images.example.com', '80')],
+                         [server.key for server in servers])
+        self.assertEqual([2.0, 1.0, 1.0],
+                         [server.weight for server in servers])
+        self.assertEqual(['rack1'], servers[0].localities)
+        self.assertEqual(['10.0.1.0/24', '10.0.2.0/24'],
+                         [str(subnet) for subnet in servers[1].subnets])
+
+    def test_parse_invalid(self):
+        for value in ('192.0.2.1;weight=0', '192.0.2.1;weight=x,192.0.2.2',
+                      '192.0.2.1;subnet=10.0.0.0/99', '192.0.2.1;colour=red',
+                      '192.0.2.1;locality', '[2001:db8::1,192.0.2.2', ',',
+                      '192.0.2.1:http,192.0.2.2'):
+            self.assertRaises(exception.InvalidParameterValue,
+                              provisioning_pool.parse, value, 80)
+
+
+class SelectTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SelectTestCase, self).setUp()
+        self.config(virtmedia_provisioning_server_health_ttl=30,
+                    virtmedia_provisioning_server_failure_backoff=300)
+        for name in ('_ATTACHMENTS', '_HEALTH', '_FAILURES'):
+            patcher = mock.patch.dict(getattr(provisioning_pool, name),
+                                      clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(provisioning_pool, '_probe',
+                                    autospec=True, return_value=True)
+        self.mock_probe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _attach(self, server, count):
+        for i in range(count):
+            provisioning_pool.attached(server, 'node-%s-%d' % (server, i))
+
+    def test_select_single_not_probed(self):
+        servers = provisioning_pool.parse('192.0.2.1', 80)
+
+        self.assertIs(servers[0], provisioning_pool.select(servers, _NODE))
+        self.assertFalse(self.mock_probe.called)
+
+    def test_select_least_loaded(self):
+        servers = provisioning_pool.parse('192.0.2.1,192.0.2.2,192.0.2.3',
+                                          80)
+        self._attach(servers[0], 2)
+        self._attach(servers[1], 1)
+        self._attach(servers[2], 3)
+
+        self.assertIs(servers[1], provisioning_pool.select(servers, _NODE))
+
+    def test_select_weight(self):
+        servers = provisioning_pool.parse(
+            '192.0.2.1;weight=4,192.0.2.2', 80)
+        self._attach(servers[0], 3)
+        self._attach(servers[1], 1)
+
+        self.assertIs(servers[0], provisioning_pool.select(servers, _NODE))
+
+    def test_select_spreads_ties(self):
+        servers = provisioning_pool.parse('192.0.2.1,192.0.2.2', 80)
+
+        chosen = set(provisioning_pool.select(servers, 'node-%d' % i).key
+                     for i in range(20))
+
+        self.assertEqual(set(server.key for server in servers), chosen)
+        # The same node gets the same server.
+        self.assertIs(provisioning_pool.select(servers, _NODE),
+                      provisioning_pool.select(servers, _NODE))
+
+    def test_select_local_subnet(self):
+        servers = provisioning_pool.parse(
+            '192.0.2.1;subnet=10.0.0.0/24,192.0.2.2;subnet=10.0.1.0/24', 80)
+        self._attach(servers[1], 5)
+
+        self.assertIs(servers[1], provisioning_pool.select(
+            servers, _NODE, bmc_address='10.0.1.17'))
+        self.assertIs(servers[0], provisioning_pool.select(
+            servers, _NODE, bmc_address='bmc.example.com'))
+
+    def test_select_local_locality(self):
+        servers = provisioning_pool.parse(
+            '192.0.2.1;locality=rack1,192.0.2.2;locality=rack2', 80)
+        self._attach(servers[1], 5)
+
+        self.assertIs(servers[1], provisioning_pool.select(
+            servers, _NODE, locality='rack2'))
+
+    def test_select_unhealthy_local(self):
+        servers = provisioning_pool.parse(
+            '192.0.2.1;locality=rack1,192.0.2.2', 80)
+        self._attach(servers[1], 5)
+        self.mock_probe.side_effect = lambda server: server is servers[1]
+
+        self.assertIs(servers[1], provisioning_pool.select(
+            servers, _NODE, locality='rack1'))
+
+    def test_select_none_healthy(self):
+        servers = provisioning_pool.parse('192.0.2.1,192.0.2.2', 80)
+        self._attach(servers[0], 1)
+        self.mock_probe.return_value = False
+
+        self.assertIs(servers[1], provisioning_pool.select(servers, _NODE))
+
+    def test_select_none_healthy_local(self):
+        servers = provisioning_pool.parse(
+            '192.0.2.1,192.0.2.2;locality=rack1', 80)
+        self._attach(servers[1], 5)
+        self.mock_probe.return_value = False
+
+        self.assertIs(servers[1], provisioning_pool.select(
+            servers, _NODE, locality='rack1'))
+
+    def test_select_failed_avoided(self):
+        servers = provisioning_pool.parse('192.0.2.1,192.0.2.2', 80)
+        self._attach(servers[1], 5)
+        provisioning_pool.failed(servers[0])
+
+        self.assertIs(servers[1], provisioning_pool.select(servers, _NODE))
+
+        # Until an attach through it succeeds.
+        provisioning_pool.attached(servers[0], 'other-node')
+        self.assertIs(servers[0], provisioning_pool.select(servers, _NODE))
+
+    def test_select_health_cached(self):
+        servers = provisioning_pool.parse('192.0.2.1,192.0.2.2', 80)
+
+        provisioning_pool.select(servers, _NODE)
+        provisioning_pool.select(servers, _NODE)
+
+        self.assertEqual(2, self.mock_probe.call_count)
+
+    def test_attached_detached(self):
+        servers = provisioning_pool.parse('192.0.2.1,192.0.2.2', 80)
+
+        provisioning_pool.attached(servers[0], _NODE)
+        provisioning_pool.attached(servers[1], _NODE)
+        self.assertEqual({'192.0.2.1:80': 0, '192.0.2.2:80': 1},
+                         provisioning_pool.get_stats())
+
+        provisioning_pool.detached(_NODE)
+        self.assertEqual({'192.0.2.1:80': 0, '192.0.2.2:80': 0},
+                         provisioning_pool.get_stats())
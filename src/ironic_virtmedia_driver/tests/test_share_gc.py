@@ -0,0 +1,326 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import time
+
+from ironic.common import states
+
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver import share_gc
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver.tests import base
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+_UUID_IDLE = '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+_UUID_BUSY = '2be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+_UUID_UNNAMED = '3be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+_UUID_DELETED = '4be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+
+
+class ShareGCTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ShareGCTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_share_gc_grace=3600,
+                    virtmedia_share_quota_bytes=0)
+        self.now = time.time()
+
+    def _write(self, relative_path, size=4096, age=0, nlink=1):
+        path = os.path.join(self.root, relative_path)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as share_file:
+            share_file.write(b'x' * size)
+        os.utime(path, (self.now - age, self.now - age))
+        for i in range(1, nlink):
+            os.link(path, '%s.link%d' % (path, i))
+        return path
+
+    def _manifest(self, node_uuid, **manifest):
+        path = self._write(os.path.join(share_utils.MANIFEST_DIR,
+                                        '%s.json' % node_uuid), size=0)
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        return path
+
+    def _classify(self, nodes):
+        orphans, evictable, total_size = share_gc.classify(
+            self.root, nodes, now=self.now)
+        return ([share_file.path for share_file in orphans],
+                [share_file.path for share_file in evictable], total_size)
+
+    def test_classify_node_images(self):
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE),
+                 _UUID_BUSY: ('busy', states.DEPLOYWAIT)}
+        idle = [self._write('image-idle.img', age=10),
+                self._write('deploy-idle.iso', age=20),
+                self._write('deploy-idle.iso.digest', age=30),
+                self._write('base-idle.iso', age=40)]
+        self._write('image-busy.img')
+        self._write('deploy-busy.iso')
+        self._write('boot-%s.iso' % _UUID_BUSY)
+
+        orphans, evictable, total_size = self._classify(nodes)
+
+        self.assertEqual([], orphans)
+        # Least recently used first.
+        self.assertEqual(list(reversed(idle)), evictable)
+        self.assertEqual(7 * 4096, total_size)
+
+    def test_classify_deleted_node(self):
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE)}
+        manifest = self._manifest(_UUID_DELETED,
+                                  floppy='image-gone.img',
+                                  iso='deploy-gone.iso',
+                                  files=['base-gone.iso'])
+        deleted = [self._write('image-gone.img'),
+                   self._write('deploy-gone.iso'),
+                   self._write('deploy-gone.iso.digest'),
+                   self._write('base-gone.iso'),
+                   self._write('boot-%s.iso' % _UUID_DELETED),
+                   self._write(os.path.join(share_utils.NODES_DIR,
+                                            _UUID_DELETED,
+                                            'deploy-other.iso'))]
+
+        orphans, evictable, _total_size = self._classify(nodes)
+
+        self.assertEqual(sorted([manifest] + deleted), sorted(orphans))
+        self.assertEqual([], evictable)
+
+    def test_classify_unattributable_files_kept(self):
+        # A node without a name deploying, and no manifest.
+        nodes = {_UUID_UNNAMED: (None, states.DEPLOYING)}
+        self._write('deploy-None.iso')
+        self._write('image-None.img')
+        # Put in the share by the operator.
+        self._write('deploy-foo.iso')
+        self._write('boot-foo.iso')
+        self._write('notes.txt')
+
+        orphans, evictable, _total_size = self._classify(nodes)
+
+        self.assertEqual([], orphans)
+        self.assertEqual([], evictable)
+
+    def test_classify_deleted_unnamed_node(self):
+        # The files of a deleted node without a name are those of another
+        # node without a name, deploying.
+        nodes = {_UUID_UNNAMED: (None, states.DEPLOYING)}
+        manifest = self._manifest(_UUID_DELETED, iso='deploy-None.iso')
+        self._write('deploy-None.iso')
+
+        orphans, evictable, _total_size = self._classify(nodes)
+
+        self.assertEqual([manifest], orphans)
+        self.assertEqual([], evictable)
+
+    def test_classify_unnamed_idle_node(self):
+        nodes = {_UUID_UNNAMED: (None, states.AVAILABLE)}
+        path = self._write('deploy-None.iso')
+
+        orphans, evictable, _total_size = self._classify(nodes)
+
+        self.assertEqual([], orphans)
+        self.assertEqual([path], evictable)
+
+    def test_classify_shared_name_busy(self):
+        # Names are not unique over time, a busy node keeps the files.
+        nodes = {_UUID_IDLE: ('node-1', states.AVAILABLE),
+                 _UUID_BUSY: ('node-1', states.CLEANING)}
+        self._write('deploy-node-1.iso')
+
+        self.assertEqual(([], []), self._classify(nodes)[:2])
+
+    def test_classify_node_directories(self):
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE),
+                 _UUID_BUSY: ('busy', states.DEPLOYING)}
+        idle = self._write(os.path.join(share_utils.NODES_DIR, _UUID_IDLE,
+                                        'deploy-idle.iso'))
+        self._write(os.path.join(share_utils.NODES_DIR, _UUID_BUSY,
+                                 'deploy-busy.iso'))
+        hashed = self._write(os.path.join(
+            share_utils.NODES_DIR, share_utils.node_hash_prefix(_UUID_IDLE),
+            'image-idle.img'))
+
+        orphans, evictable, _total_size = self._classify(nodes)
+
+        self.assertEqual([], orphans)
+        self.assertEqual(sorted([idle, hashed]), sorted(evictable))
+
+    def test_classify_temporary_files(self):
+        old = [self._write('deploy-idle.iso.tmp', age=7200),
+               self._write('boot-x.tar.gz', age=7200),
+               self._write(os.path.join(image_cache.CACHE_DIR, 'abc.part'),
+                           age=7200)]
+        self._write('image-idle.img.tmp', age=60)
+        self._write(os.path.join(image_cache.CACHE_DIR, 'def.part'), age=60)
+
+        orphans, _evictable, _total_size = self._classify({})
+
+        self.assertEqual(sorted(old), sorted(orphans))
+
+    def test_classify_cache(self):
+        nodes = {_UUID_BUSY: ('busy', states.DEPLOYING)}
+        cache = image_cache.CACHE_DIR
+        unused = self._write(os.path.join(cache, 'unused.iso'))
+        self._write(os.path.join(cache, 'unused.iso.digest'))
+        # Hardlinked as the ISO of a node.
+        self._write(os.path.join(cache, 'linked.iso'), nlink=2)
+        # The base of a busy node.
+        self._write(os.path.join(cache, 'busy.iso'))
+        self._manifest(_UUID_BUSY, base=os.path.join(cache, 'busy.iso'))
+        digest = self._write(os.path.join(cache, 'gone.iso.digest'))
+
+        orphans, evictable, _total_size = self._classify(nodes)
+
+        self.assertEqual([digest], orphans)
+        self.assertEqual([unused], evictable)
+
+    def test_classify_superseded_cache_entries(self):
+        cache = image_cache.CACHE_DIR
+        current = self._write(os.path.join(cache, 'current.iso'), age=7200)
+        meta = self._write(os.path.join(cache, 'href.json'), size=0)
+        with open(meta, 'w') as meta_file:
+            json.dump({'entry': 'current.iso'}, meta_file)
+        superseded = self._write(os.path.join(cache, 'old.iso'), age=7200)
+        digest = self._write(os.path.join(cache, 'old.iso.digest'))
+        # Maybe returned by the cache just before it was superseded.
+        recent = self._write(os.path.join(cache, 'recent.iso'), age=60)
+        # Still the ISO of a node.
+        self._write(os.path.join(cache, 'linked.iso'), age=7200, nlink=2)
+
+        orphans, evictable, _total_size = self._classify({})
+
+        self.assertEqual(sorted([superseded, digest]), sorted(orphans))
+        self.assertEqual([current, recent], evictable)
+
+    def test_collect_quota(self):
+        self.config(virtmedia_share_quota_bytes=2 * 4096)
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE),
+                 _UUID_BUSY: ('busy', states.DEPLOYING)}
+        oldest = self._write('deploy-idle.iso', age=100)
+        newest = self._write('image-idle.img', age=10)
+        busy = self._write('deploy-busy.iso', age=1000)
+        orphan = self._write('boot-%s.iso' % _UUID_DELETED)
+        cached = self._write(os.path.join(image_cache.CACHE_DIR,
+                                          'cached.iso'), age=50)
+
+        stats = share_gc.collect(nodes)
+
+        self.assertEqual({'orphans': 1, 'evicted': 2, 'freed': 3 * 4096,
+                          'used': 2 * 4096}, stats)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(cached))
+        self.assertTrue(os.path.exists(newest))
+        self.assertTrue(os.path.exists(busy))
+
+    def test_collect_hardlinked_cache_entry(self):
+        self.config(virtmedia_share_quota_bytes=4096)
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE)}
+        entry = self._write(os.path.join(image_cache.CACHE_DIR,
+                                         'entry.iso'), age=100)
+        node_iso = os.path.join(self.root, 'deploy-idle.iso')
+        os.link(entry, node_iso)
+        floppy = self._write('image-idle.img', age=10)
+
+        # The entry and the node ISO use the same blocks.
+        self.assertEqual(2 * 4096, self._classify(nodes)[2])
+        stats = share_gc.collect(nodes)
+
+        # Removing the node ISO alone would free nothing.
+        self.assertEqual({'orphans': 0, 'evicted': 1, 'freed': 4096,
+                          'used': 4096}, stats)
+        self.assertTrue(os.path.exists(entry))
+        self.assertTrue(os.path.exists(node_iso))
+        self.assertFalse(os.path.exists(floppy))
+
+    def test_collect_hardlinked_node_images(self):
+        self.config(virtmedia_share_quota_bytes=4096)
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE)}
+        base_iso = self._write('base-idle.iso', age=100)
+        node_iso = os.path.join(self.root, 'deploy-idle.iso')
+        os.link(base_iso, node_iso)
+        floppy = self._write('image-idle.img', age=10)
+
+        stats = share_gc.collect(nodes)
+
+        self.assertEqual({'orphans': 0, 'evicted': 2, 'freed': 4096,
+                          'used': 4096}, stats)
+        self.assertFalse(os.path.exists(base_iso))
+        self.assertFalse(os.path.exists(node_iso))
+        self.assertTrue(os.path.exists(floppy))
+
+    def test_classify_shared_extents(self):
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE)}
+        base_iso = self._write('base-idle.iso', size=3 * 4096)
+        node_iso = self._write('deploy-idle.iso', size=3 * 4096)
+        # Reflinked clones, sharing their first two blocks.
+        with mock.patch.object(share_gc, '_shared_extents',
+                               return_value=[(1 << 20, 2 * 4096)]):
+            orphans, evictable, total_size = share_gc.classify(
+                self.root, nodes, now=self.now)
+
+        self.assertEqual([], orphans)
+        self.assertEqual(sorted([base_iso, node_iso]),
+                         sorted(share_file.path for share_file in evictable))
+        self.assertEqual([4096, 4096], [share_file.exclusive_size
+                                        for share_file in evictable])
+        self.assertEqual(4 * 4096, total_size)
+
+    def test_shared_extents_not_shared(self):
+        path = self._write('base-idle.iso', size=3 * 4096)
+
+        self.assertEqual([], share_gc._shared_extents(path))
+        self.assertEqual([], share_gc._shared_extents(path + '.missing'))
+
+    def test_collect_dry_run(self):
+        self.config(virtmedia_share_quota_bytes=1)
+        nodes = {_UUID_IDLE: ('idle', states.AVAILABLE)}
+        paths = [self._write('deploy-idle.iso'),
+                 self._write('boot-%s.iso' % _UUID_DELETED)]
+
+        stats = share_gc.collect(nodes, dry_run=True)
+
+        self.assertEqual(1, stats['orphans'])
+        self.assertEqual(1, stats['evicted'])
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+
+    def test_collect_removes_empty_node_dirs(self):
+        nodes = {_UUID_BUSY: ('busy', states.DEPLOYING)}
+        nodes_dir = os.path.join(self.root, share_utils.NODES_DIR)
+        old = self.now - 7200
+        for name in (_UUID_DELETED, _UUID_BUSY,
+                     share_utils.node_hash_prefix(_UUID_BUSY), 'recent'):
+            os.makedirs(os.path.join(nodes_dir, name))
+            if name != 'recent':
+                os.utime(os.path.join(nodes_dir, name), (old, old))
+
+        share_gc.collect(nodes)
+
+        self.assertEqual(
+            sorted([_UUID_BUSY, share_utils.node_hash_prefix(_UUID_BUSY),
+                    'recent']),
+            sorted(os.listdir(nodes_dir)))
@@ -0,0 +1,126 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+
+from ironic_virtmedia_driver import share_index
+from ironic_virtmedia_driver.tests import base
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class ShareIndexTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ShareIndexTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_share_index_rescan_interval=3600,
+                    virtmedia_share_index_entry_ttl=3600)
+        self._write('deploy.iso', b'iso')
+
+    def _write(self, filename, data=b'x'):
+        with open(os.path.join(self.root, filename), 'wb') as share_file:
+            share_file.write(data)
+
+    def _index(self):
+        index = share_index.ShareIndex(self.root)
+        self.addCleanup(index.close)
+        return index
+
+    def test_lookup(self):
+        index = self._index()
+
+        self.assertEqual(3, index.lookup('deploy.iso').size)
+        self.assertTrue(index.isfile('deploy.iso'))
+        self.assertIsNone(index.lookup('missing.iso'))
+        self.assertTrue(index.root_exists())
+
+    def test_lookup_missing_from_index(self):
+        index = self._index()
+        index.list_isos()
+        with mock.patch.object(index, '_read_events', return_value=set()):
+            self._write('new.iso')
+
+            self.assertTrue(index.isfile('new.iso'))
+            self.assertIn('new.iso', index.list_isos())
+
+    def test_inotify_updates(self):
+        index = self._index()
+        self.assertEqual(['deploy.iso'], list(index.list_isos()))
+        if index._inotify_fd is None:
+            self.skipTest('inotify is not available')
+
+        self._write('new.iso', b'new')
+        os.unlink(os.path.join(self.root, 'deploy.iso'))
+
+        self.assertEqual({'new.iso': 3},
+                         dict((name, entry.size) for name, entry
+                              in index.list_isos().items()))
+
+    @mock.patch.object(share_index, '_INOTIFY', None)
+    def test_rescan_fallback(self):
+        index = self._index()
+        self.assertEqual(['deploy.iso'], list(index.list_isos()))
+
+        self._write('new.iso')
+        # Not seen until the next rescan.
+        self.assertEqual(['deploy.iso'], list(index.list_isos()))
+        index._scanned_at -= 3600
+        self.assertEqual(['deploy.iso', 'new.iso'],
+                         sorted(index.list_isos()))
+
+        self.config(virtmedia_share_index_rescan_interval=0)
+        os.unlink(os.path.join(self.root, 'new.iso'))
+        self.assertEqual(['deploy.iso'], list(index.list_isos()))
+
+    @mock.patch.object(share_index, '_INOTIFY', None)
+    def test_lookup_checked_after_ttl(self):
+        self.config(virtmedia_share_index_entry_ttl=10)
+        index = self._index()
+        self.assertTrue(index.isfile('deploy.iso'))
+        # Removed by another host, inotify does not see it.
+        os.unlink(os.path.join(self.root, 'deploy.iso'))
+        self.assertTrue(index.isfile('deploy.iso'))
+
+        now = time.time() + 10
+        with mock.patch.object(share_index.time, 'time', return_value=now):
+            self.assertFalse(index.isfile('deploy.iso'))
+        self.assertNotIn('deploy.iso', index.list_isos())
+
+    @mock.patch.object(share_index, '_INOTIFY', None)
+    def test_lookup_checked_every_time(self):
+        self.config(virtmedia_share_index_entry_ttl=0)
+        index = self._index()
+        self.assertTrue(index.isfile('deploy.iso'))
+
+        os.unlink(os.path.join(self.root, 'deploy.iso'))
+
+        self.assertFalse(index.isfile('deploy.iso'))
+
+    def test_get_index(self):
+        self.config(virtmedia_share_index=False)
+        self.assertIsNone(share_index.get_index())
+
+        self.config(virtmedia_share_index=True)
+        index = share_index.get_index()
+        self.addCleanup(share_index._INDEX.__setitem__, 0, None)
+        self.addCleanup(index.close)
+        self.assertEqual(self.root, index.root)
+        self.assertIs(index, share_index.get_index())
@@ -0,0 +1,168 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+
+from ironic.common import states
+
+from ironic_virtmedia_driver import share_layout
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver.tests import base
+from ironic_virtmedia_driver import virtmedia
+
+_UUID_IDLE = '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+_UUID_BUSY = '2be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+
+
+class FakeNode(object):
+
+    def __init__(self, uuid, name):
+        self.uuid = uuid
+        self.name = name
+
+
+class ShareLayoutTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ShareLayoutTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_share_layout='flat',
+                    virtmedia_share_layout_compat=True)
+        self.node = FakeNode(_UUID_IDLE, 'node-1')
+
+    def _write(self, filename, data=b'x', mtime=None):
+        path = os.path.join(self.root, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as share_file:
+            share_file.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _read(self, filename):
+        with open(os.path.join(self.root, filename), 'rb') as share_file:
+            return share_file.read()
+
+    def _exists(self, filename):
+        return os.path.exists(os.path.join(self.root, filename))
+
+    def _hashed(self, node_uuid, filename):
+        return os.path.join(share_utils.NODES_DIR,
+                            share_utils.node_hash_prefix(node_uuid),
+                            filename)
+
+    def test_node_file(self):
+        self.assertEqual('deploy-node-1.iso',
+                         share_layout.node_file(self.node,
+                                                'deploy-node-1.iso'))
+        self.assertEqual(self._hashed(_UUID_IDLE, 'deploy-node-1.iso'),
+                         share_layout.node_file(self.node,
+                                                'deploy-node-1.iso',
+                                                'hashed'))
+        self.assertEqual(os.path.join('nodes', _UUID_IDLE,
+                                      'deploy-node-1.iso'),
+                         share_layout.node_file(self.node,
+                                                'deploy-node-1.iso',
+                                                'node'))
+
+    def test_migrate_flat_to_hashed(self):
+        self.config(virtmedia_share_layout='hashed')
+        self._write('image-node-1.img', b'floppy')
+        self._write('deploy-node-1.iso', b'iso')
+        self._write(os.path.join(share_utils.MANIFEST_DIR,
+                                 '%s.json' % _UUID_IDLE), b'{}')
+        self._write('deploy-node-2.iso', b'busy')
+
+        stats = share_layout.migrate(
+            {_UUID_IDLE: ('node-1', states.AVAILABLE),
+             _UUID_BUSY: ('node-2', states.DEPLOYING)})
+
+        self.assertEqual({'moved': 2, 'removed': 0, 'busy': 1}, stats)
+        self.assertEqual(b'floppy', self._read(
+            self._hashed(_UUID_IDLE, 'image-node-1.img')))
+        self.assertEqual(b'iso', self._read(
+            self._hashed(_UUID_IDLE, 'deploy-node-1.iso')))
+        self.assertFalse(self._exists('image-node-1.img'))
+        self.assertFalse(self._exists('deploy-node-1.iso'))
+        # The manifest refers to the old paths.
+        self.assertFalse(self._exists(os.path.join(
+            share_utils.MANIFEST_DIR, '%s.json' % _UUID_IDLE)))
+        # Its BMC may be reading it.
+        self.assertEqual(b'busy', self._read('deploy-node-2.iso'))
+
+    def test_migrate_keeps_current_copy(self):
+        self.config(virtmedia_share_layout='hashed')
+        current = self._hashed(_UUID_IDLE, 'deploy-node-1.iso')
+        self._write('deploy-node-1.iso', b'old', mtime=1000)
+        self._write(os.path.join('nodes', _UUID_IDLE, 'deploy-node-1.iso'),
+                    b'older', mtime=500)
+        self._write(current, b'current', mtime=100)
+
+        stats = share_layout.migrate(
+            {_UUID_IDLE: ('node-1', states.AVAILABLE)})
+
+        self.assertEqual({'moved': 0, 'removed': 2, 'busy': 0}, stats)
+        self.assertEqual(b'current', self._read(current))
+        self.assertFalse(self._exists('deploy-node-1.iso'))
+        # The emptied node directory is removed.
+        self.assertFalse(self._exists(os.path.join('nodes', _UUID_IDLE)))
+
+    def test_migrate_dry_run(self):
+        self.config(virtmedia_share_layout='hashed')
+        self._write('deploy-node-1.iso', b'iso')
+
+        stats = share_layout.migrate(
+            {_UUID_IDLE: ('node-1', states.AVAILABLE)}, dry_run=True)
+
+        self.assertEqual({'moved': 1, 'removed': 0, 'busy': 0}, stats)
+        self.assertEqual(b'iso', self._read('deploy-node-1.iso'))
+        self.assertFalse(self._exists(share_utils.NODES_DIR))
+
+    def test_stale_files(self):
+        self.config(virtmedia_share_layout='hashed')
+
+        self.assertEqual(
+            sorted(['deploy-node-1.iso',
+                    os.path.join('nodes', _UUID_IDLE, 'deploy-node-1.iso')]),
+            sorted(share_layout.stale_files(self.node, 'deploy-node-1.iso')))
+
+        self.config(virtmedia_share_layout_compat=False)
+        self.assertEqual([], share_layout.stale_files(self.node,
+                                                      'deploy-node-1.iso'))
+
+    def test_remove_node_share_file_compat(self):
+        self.config(virtmedia_share_layout='hashed')
+        current = self._hashed(_UUID_IDLE, 'deploy-node-1.iso')
+        for filename in ('deploy-node-1.iso', current, 'deploy-node-2.iso'):
+            self._write(filename)
+
+        virtmedia._remove_node_share_file(self.node, current)
+
+        self.assertFalse(self._exists(current))
+        self.assertFalse(self._exists('deploy-node-1.iso'))
+        self.assertTrue(self._exists('deploy-node-2.iso'))
+
+    def test_remove_node_share_file_no_compat(self):
+        self.config(virtmedia_share_layout='hashed',
+                    virtmedia_share_layout_compat=False)
+        current = self._hashed(_UUID_IDLE, 'deploy-node-1.iso')
+        for filename in ('deploy-node-1.iso', current):
+            self._write(filename)
+
+        virtmedia._remove_node_share_file(self.node, current)
+
+        self.assertFalse(self._exists(current))
+        self.assertTrue(self._exists('deploy-node-1.iso'))
@@ -0,0 +1,222 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import threading
+import time
+
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver.tests import base
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class AtomicPathTestCase(base.TestCase):
+
+    def setUp(self):
+        super(AtomicPathTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(virtmedia_fsync_share_files=False)
+        self.path = os.path.join(self.root, 'deploy-node-1.iso')
+        with open(self.path, 'wb') as share_file:
+            share_file.write(b'old')
+
+    def _write(self, data):
+        with share_utils.atomic_path(self.path) as tmp_path:
+            self.assertEqual(self.root, os.path.dirname(tmp_path))
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(data)
+
+    def test_published(self):
+        with open(self.path, 'rb') as reader:
+            self._write(b'new')
+            # A reader of the previous file keeps reading it.
+            self.assertEqual(b'old', reader.read())
+
+        with open(self.path, 'rb') as share_file:
+            self.assertEqual(b'new', share_file.read())
+        self.assertEqual(['deploy-node-1.iso'], os.listdir(self.root))
+
+    def test_block_failed(self):
+        with self.assertRaises(ValueError):
+            with share_utils.atomic_path(self.path) as tmp_path:
+                with open(tmp_path, 'wb') as tmp_file:
+                    tmp_file.write(b'partial')
+                raise ValueError('failed')
+
+        with open(self.path, 'rb') as share_file:
+            self.assertEqual(b'old', share_file.read())
+        self.assertEqual(['deploy-node-1.iso'], os.listdir(self.root))
+
+    def test_publish_failed(self):
+        self.config(virtmedia_fsync_share_files=True)
+        with mock.patch.object(share_utils, 'sync_file', autospec=True,
+                               side_effect=OSError(5, 'EIO')):
+            self.assertRaises(OSError, self._write, b'new')
+
+        with open(self.path, 'rb') as share_file:
+            self.assertEqual(b'old', share_file.read())
+        self.assertEqual(['deploy-node-1.iso'], os.listdir(self.root))
+
+    def test_rename_failed(self):
+        path = os.path.join(self.root, 'nodes')
+        os.makedirs(os.path.join(path, 'busy'))
+
+        with self.assertRaises(OSError):
+            with share_utils.atomic_path(path) as tmp_path:
+                with open(tmp_path, 'wb') as tmp_file:
+                    tmp_file.write(b'new')
+
+        self.assertEqual(sorted(['deploy-node-1.iso', 'nodes']),
+                         sorted(os.listdir(self.root)))
+
+    @mock.patch.object(share_utils.os, 'fsync', autospec=True)
+    def test_fsync(self, mock_fsync):
+        self.config(virtmedia_fsync_share_files=True)
+
+        self._write(b'new')
+
+        self.assertEqual(1, mock_fsync.call_count)
+
+    @mock.patch.object(share_utils.os, 'fsync', autospec=True)
+    def test_no_fsync(self, mock_fsync):
+        self._write(b'new')
+
+        self.assertFalse(mock_fsync.called)
+
+    def test_link_file(self):
+        link = os.path.join(self.root, 'base-node-1.iso')
+
+        share_utils.link_file(self.path, link)
+
+        self.assertEqual(os.stat(self.path).st_ino, os.stat(link).st_ino)
+        self.assertEqual(sorted(['deploy-node-1.iso', 'base-node-1.iso']),
+                         sorted(os.listdir(self.root)))
+
+
+class _CountingCondition(object):
+    """A condition counting the threads waiting on it."""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self.waiting = 0
+
+    def __enter__(self):
+        return self._cond.__enter__()
+
+    def __exit__(self, *args):
+        return self._cond.__exit__(*args)
+
+    def acquire(self):
+        return self._cond.acquire()
+
+    def release(self):
+        self._cond.release()
+
+    def notify_all(self):
+        self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        self.waiting += 1
+        try:
+            return self._cond.wait(timeout)
+        finally:
+            self.waiting -= 1
+
+
+class BatchedFsyncTestCase(base.TestCase):
+
+    def setUp(self):
+        super(BatchedFsyncTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.path = os.path.join(self.root, 'image-node-1.img')
+        with open(self.path, 'wb') as share_file:
+            share_file.write(b'x')
+        self.group_sync = share_utils._GroupSync()
+        self.group_sync._cond = _CountingCondition()
+        patcher = mock.patch.object(share_utils, '_GROUP_SYNC',
+                                    self.group_sync)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(share_utils, '_SYNCFS',
+                                    mock.Mock(return_value=0))
+        self.mock_syncfs = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(share_utils.os, 'fsync', autospec=True)
+    def test_batched_in_calling_thread_only(self, mock_fsync):
+        other = []
+
+        def _sync_other():
+            share_utils.sync_file(self.path)
+            other.append((mock_fsync.call_count,
+                          self.mock_syncfs.call_count))
+
+        with share_utils.batched_fsync():
+            with share_utils.batched_fsync():
+                share_utils.sync_file(self.path)
+            share_utils.sync_file(self.path)
+            thread = threading.Thread(target=_sync_other)
+            thread.start()
+            thread.join()
+        share_utils.sync_file(self.path)
+
+        self.assertEqual([(1, 2)], other)
+        self.assertEqual(2, mock_fsync.call_count)
+        self.assertEqual(2, self.mock_syncfs.call_count)
+
+    def test_group_sync_coalesces(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def _syncfs(fd):
+            if not started.is_set():
+                started.set()
+                release.wait(10)
+            return 0
+
+        self.mock_syncfs.side_effect = _syncfs
+        first = threading.Thread(target=self._batched_sync)
+        first.start()
+        self.assertTrue(started.wait(10))
+        # Arriving while the first syncfs runs, served by a single one.
+        waiting = [threading.Thread(target=self._batched_sync)
+                   for _i in range(5)]
+        for thread in waiting:
+            thread.start()
+        for _i in range(1000):
+            with self.group_sync._cond:
+                if self.group_sync._cond.waiting == 5:
+                    break
+            time.sleep(0.01)
+        release.set()
+        for thread in [first] + waiting:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(2, self.mock_syncfs.call_count)
+
+    def _batched_sync(self):
+        with share_utils.batched_fsync():
+            share_utils.sync_file(self.path)
+
+    def test_group_sync_error(self):
+        self.mock_syncfs.return_value = -1
+
+        with share_utils.batched_fsync():
+            self.assertRaises(OSError, share_utils.sync_file, self.path)
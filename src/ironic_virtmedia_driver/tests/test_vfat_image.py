@@ -0,0 +1,162 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import struct
+import time
+import unittest
+
+from ironic_virtmedia_driver import vfat_image
+
+_TIMESTAMP = time.mktime((2019, 6, 14, 12, 30, 20, 0, 0, -1))
+
+
+def _read_image(image):
+    """Reads the boot sector, root directory and files of a FAT image.
+
+    Written from the FAT specification, independently of vfat_image.
+    """
+    (jump, _oem, sector_size, sectors_per_cluster, reserved, fat_count,
+     root_entries, total_16, media, fat_sectors, _track, _heads, _hidden,
+     total_32, _drive, _reserved, signature, _serial, label,
+     fs_type) = struct.unpack_from('<3s8sHBHBHHBHHHIIBBBI11s8s', image)
+    boot = {'jump': jump, 'sector_size': sector_size,
+            'sectors_per_cluster': sectors_per_cluster,
+            'fat_count': fat_count, 'media': media,
+            'total_sectors': total_16 or total_32, 'signature': signature,
+            'label': label, 'fs_type': fs_type,
+            'boot_signature': image[510:512]}
+
+    fat_start = reserved * sector_size
+    fats = [image[fat_start + i * fat_sectors * sector_size:
+                  fat_start + (i + 1) * fat_sectors * sector_size]
+            for i in range(fat_count)]
+    boot['fats_equal'] = all(fat == fats[0] for fat in fats)
+    root_start = fat_start + fat_count * fat_sectors * sector_size
+    data_start = root_start + root_entries * 32
+    fat12 = fs_type.strip() == b'FAT12'
+
+    def next_cluster(cluster):
+        if fat12:
+            value = struct.unpack_from('<H', fats[0], cluster * 3 // 2)[0]
+            return value >> 4 if cluster & 1 else value & 0xfff
+        return struct.unpack_from('<H', fats[0], cluster * 2)[0]
+
+    boot['fat_media'] = next_cluster(0) & 0xff
+    end_of_chain = 0xff8 if fat12 else 0xfff8
+    cluster_size = sectors_per_cluster * sector_size
+
+    files = {}
+    volume_label = None
+    long_name = []
+    for offset in range(root_start, data_start, 32):
+        entry = image[offset:offset + 32]
+        if entry[0:1] == b'\0':
+            break
+        attr = bytearray(entry)[11]
+        if attr == 0x0f:
+            chars = struct.unpack_from('<5H', entry, 1)
+            chars += struct.unpack_from('<6H', entry, 14)
+            chars += struct.unpack_from('<2H', entry, 28)
+            part = b''.join(struct.pack('<H', c) for c in chars
+                            if c not in (0, 0xffff)).decode('utf-16-le')
+            long_name.insert(0, part)
+            continue
+        (short_name, _attr, _nt, _ctime_ms, _ctime, _cdate, _adate,
+         _high, mtime, mdate, cluster, size) = struct.unpack(
+             '<11sBBBHHHHHHHI', entry)
+        if attr & 0x08:
+            volume_label = short_name
+            continue
+        chunks = []
+        while cluster and cluster < end_of_chain:
+            start = data_start + (cluster - 2) * cluster_size
+            chunks.append(image[start:start + cluster_size])
+            cluster = next_cluster(cluster)
+        contents = b''.join(chunks)
+        name = u''.join(long_name)
+        if not name:
+            base, ext = short_name[:8].rstrip(), short_name[8:].rstrip()
+            name = (base + (b'.' + ext if ext else b'')).decode('ascii')
+        files[name] = {'short_name': short_name, 'contents': contents[:size],
+                       'mdate': mdate, 'mtime': mtime}
+        long_name = []
+    return boot, volume_label, files
+
+
+class CreateVfatImageTestCase(unittest.TestCase):
+
+    def test_parameters_file(self):
+        contents = b'ipa-api-url=http://192.0.2.1:6385\nboot_mac=00:11\n'
+        image = vfat_image.create_vfat_image(
+            [('parameters.txt', contents)], timestamp=_TIMESTAMP)
+
+        boot, label, files = _read_image(image)
+        self.assertEqual(b'\xeb\x3c\x90', boot['jump'])
+        self.assertEqual(b'\x55\xaa', boot['boot_signature'])
+        self.assertEqual(512, boot['sector_size'])
+        self.assertEqual(2, boot['fat_count'])
+        self.assertTrue(boot['fats_equal'])
+        self.assertEqual(0xf8, boot['media'])
+        self.assertEqual(0xf8, boot['fat_media'])
+        self.assertEqual(b'FAT12   ', boot['fs_type'])
+        self.assertEqual(0x29, boot['signature'])
+        self.assertEqual(b'ir-vfd-dev ', boot['label'])
+        self.assertEqual(b'ir-vfd-dev ', label)
+        self.assertEqual(boot['total_sectors'] * 512, len(image))
+
+        self.assertEqual(['parameters.txt'], list(files))
+        entry = files['parameters.txt']
+        self.assertEqual(contents, entry['contents'])
+        self.assertEqual(b'PARAME~1TXT', entry['short_name'])
+        self.assertEqual((2019 - 1980) << 9 | 6 << 5 | 14, entry['mdate'])
+        self.assertEqual(12 << 11 | 30 << 5 | 10, entry['mtime'])
+
+    def test_several_files(self):
+        files = [('A.TXT', b'a' * 10), ('empty', b''),
+                 ('multi-cluster-file.bin', bytes(bytearray(
+                     i % 251 for i in range(5000)))),
+                 ('B', b'b' * 512)]
+        image = vfat_image.create_vfat_image(files, label='VMEDIA',
+                                             timestamp=_TIMESTAMP)
+
+        boot, label, read = _read_image(image)
+        self.assertEqual(b'VMEDIA     ', label)
+        self.assertEqual(dict(files),
+                         dict((name, entry['contents'])
+                              for name, entry in read.items()))
+        self.assertEqual(b'A       TXT', read['A.TXT']['short_name'])
+        self.assertEqual(b'B          ', read['B']['short_name'])
+
+    def test_fat16(self):
+        contents = b'x' * (5000 * 512)
+        image = vfat_image.create_vfat_image([('big.img', contents)],
+                                             timestamp=_TIMESTAMP)
+
+        boot, _label, files = _read_image(image)
+        self.assertEqual(b'FAT16   ', boot['fs_type'])
+        self.assertEqual(boot['total_sectors'] * 512, len(image))
+        self.assertEqual(contents, files['big.img']['contents'])
+
+    def test_no_files(self):
+        image = vfat_image.create_vfat_image([], timestamp=_TIMESTAMP)
+
+        boot, label, files = _read_image(image)
+        self.assertEqual(b'ir-vfd-dev ', label)
+        self.assertEqual({}, files)
+        self.assertEqual(boot['total_sectors'] * 512, len(image))
+
+    def test_too_large(self):
+        self.assertRaises(ValueError, vfat_image.create_vfat_image,
+                          [('big.img', b'x' * (70000 * 512))])
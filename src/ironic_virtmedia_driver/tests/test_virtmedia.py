@@ -0,0 +1,454 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import functools
+import gzip
+import io
+import os
+import tarfile
+
+from ironic.common import states
+
+from ironic_virtmedia_driver.tests import base
+from ironic_virtmedia_driver import virtmedia
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+_NODE_UUID = '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+
+
+class FakeNode(object):
+
+    def __init__(self, uuid=_NODE_UUID, name='node-1',
+                 provision_state=states.DEPLOYING):
+        self.uuid = uuid
+        self.name = name
+        self.provision_state = provision_state
+        self.driver_info = {'virtmedia_deploy_iso': 'deploy.iso'}
+        self.driver_internal_info = {}
+        self.save = mock.Mock()
+
+
+class FakeTask(object):
+
+    def __init__(self, node=None):
+        self.node = node or FakeNode()
+        self.ports = []
+        self.context = None
+
+
+class RecordingBoot(virtmedia.VirtmediaBoot):
+    """Records the virtual media operations reaching the BMC."""
+
+    def __init__(self):
+        super(RecordingBoot, self).__init__()
+        self.calls = []
+
+    def _attach_virtual_cd(self, task, bootable_iso_filename):
+        self.calls.append('attach_cd')
+
+    def _detach_virtual_cd(self, task):
+        self.calls.append('detach_cd')
+
+    def _attach_virtual_fd(self, task, floppy_image_filename):
+        self.calls.append('attach_fd')
+
+    def _detach_virtual_fd(self, task):
+        self.calls.append('detach_fd')
+
+
+class VirtmediaTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VirtmediaTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_share_layout='flat',
+                    virtmedia_reconcile_media_state=False,
+                    virtmedia_reuse_node_images=False,
+                    virtmedia_share_min_free_bytes=0)
+        self.boot = RecordingBoot()
+        self.task = FakeTask()
+        for name in ('image-node-1.img', 'deploy-node-1.iso'):
+            with open(os.path.join(self.root, name), 'wb') as share_file:
+                share_file.write(b'x')
+        self.node_images = ('image-node-1.img', 'deploy-node-1.iso')
+        for target, attribute, kwargs in (
+                (virtmedia, '_prepare_deploy_images',
+                 {'return_value': self.node_images}),
+                (virtmedia.deploy_utils, 'get_single_nic_with_vif_port_id',
+                 {'return_value': '52:54:00:12:34:56'}),
+                (virtmedia.manager_utils, 'node_set_boot_device', {}),
+                (RecordingBoot, '_get_deploy_iso',
+                 {'return_value': 'deploy.iso'})):
+            patcher = mock.patch.object(target, attribute, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class MediaStateTestCase(VirtmediaTestCase):
+
+    def _prepare(self):
+        self.boot.prepare_ramdisk(self.task, {})
+
+    def test_prepare_ramdisk_not_reconciled(self):
+        self._prepare()
+        self._prepare()
+
+        self.assertEqual(['detach_cd', 'detach_fd', 'attach_fd',
+                          'attach_cd'] * 2, self.boot.calls)
+        self.assertFalse(self.task.node.save.called)
+        self.assertNotIn(virtmedia.MEDIA_STATE,
+                         self.task.node.driver_internal_info)
+
+    def test_prepare_ramdisks_not_reconciled(self):
+        results = self.boot.prepare_ramdisks([(self.task, {})])
+
+        self.assertTrue(results[self.task.node.uuid]['success'])
+        self.assertEqual(['detach_cd', 'detach_fd', 'attach_fd',
+                          'attach_cd'], self.boot.calls)
+        self.assertFalse(self.task.node.save.called)
+
+    def test_prepare_ramdisks_reconciled(self):
+        self.config(virtmedia_reconcile_media_state=True)
+        self._prepare()
+        self.boot.calls = []
+
+        results = self.boot.prepare_ramdisks([(self.task, {})])
+
+        self.assertTrue(results[self.task.node.uuid]['success'])
+        self.assertEqual([], self.boot.calls)
+        self.assertEqual(2, self.task.node.save.call_count)
+
+    def test_clean_up_ramdisk_not_reconciled(self):
+        self.boot.clean_up_ramdisk(self.task)
+        self.boot.clean_up_ramdisk(self.task)
+
+        self.assertEqual(['detach_cd', 'detach_fd'] * 2, self.boot.calls)
+        self.assertFalse(self.task.node.save.called)
+
+    def test_prepare_ramdisk_reconciled(self):
+        self.config(virtmedia_reconcile_media_state=True)
+
+        self._prepare()
+        self.assertEqual(['detach_cd', 'detach_fd', 'attach_fd',
+                          'attach_cd'], self.boot.calls)
+        self.assertEqual(1, self.task.node.save.call_count)
+
+        # Already attached.
+        self.boot.calls = []
+        self._prepare()
+        self.assertEqual([], self.boot.calls)
+        self.assertEqual(2, self.task.node.save.call_count)
+
+        self.boot.calls = []
+        self.boot.clean_up_ramdisk(self.task)
+        self.assertEqual(['detach_cd', 'detach_fd'], self.boot.calls)
+        self.assertEqual(3, self.task.node.save.call_count)
+
+        # Known to be detached.
+        self.boot.calls = []
+        self._prepare()
+        self.assertEqual(['attach_fd', 'attach_cd'], self.boot.calls)
+
+    def test_prepare_ramdisk_reconciled_image_changed(self):
+        self.config(virtmedia_reconcile_media_state=True)
+        self._prepare()
+        os.unlink(os.path.join(self.root, 'deploy-node-1.iso'))
+        with open(os.path.join(self.root, 'deploy-node-1.iso'),
+                  'wb') as share_file:
+            share_file.write(b'rebuilt')
+        self.boot.calls = []
+
+        self._prepare()
+
+        self.assertEqual(['detach_cd', 'attach_cd'], self.boot.calls)
+
+    def test_reconciled_state_of_another_process(self):
+        self.config(virtmedia_reconcile_media_state=True)
+        self._prepare()
+        state = self.task.node.driver_internal_info[virtmedia.MEDIA_STATE]
+        state['owner'] = 'another-conductor'
+        self.boot.calls = []
+
+        self._prepare()
+
+        self.assertEqual(['detach_cd', 'detach_fd', 'attach_fd',
+                          'attach_cd'], self.boot.calls)
+
+    def test_reconciled_failed_operation(self):
+        self.config(virtmedia_reconcile_media_state=True)
+        self._prepare()
+        self.boot.calls = []
+        with mock.patch.object(RecordingBoot, '_detach_virtual_cd',
+                               side_effect=RuntimeError('BMC error')):
+            self.assertRaises(RuntimeError, self.boot.clean_up_ramdisk,
+                              self.task)
+        # Saved, failed or not.
+        self.assertEqual(2, self.task.node.save.call_count)
+
+        self._prepare()
+
+        # The cd is in an unknown state, the fd still holds its image.
+        self.assertEqual(['detach_cd', 'attach_cd'], self.boot.calls)
+
+
+class PrepareWhileDetachingTestCase(VirtmediaTestCase):
+
+    def test_detached_once(self):
+        self.boot.prepare_ramdisk(self.task, {})
+
+        self.assertEqual(['detach_cd', 'detach_fd', 'attach_fd',
+                          'attach_cd'], self.boot.calls)
+        virtmedia._prepare_deploy_images.assert_called_once_with(
+            self.task, 'deploy.iso', mock.ANY)
+
+    def test_detached_once_http_delivery(self):
+        virtmedia._prepare_deploy_images.return_value = (
+            None, 'deploy-node-1.iso')
+
+        self.boot.prepare_ramdisk(self.task, {})
+
+        self.assertEqual(['detach_cd', 'detach_fd', 'attach_cd'],
+                         self.boot.calls)
+
+    def test_prepare_error(self):
+        virtmedia._prepare_deploy_images.side_effect = RuntimeError('share')
+
+        with mock.patch.object(RecordingBoot, '_detach_virtual_fd',
+                               side_effect=RuntimeError('BMC')):
+            with self.assertRaises(RuntimeError) as raised:
+                self.boot.prepare_ramdisk(self.task, {})
+
+        self.assertEqual('share', str(raised.exception))
+        self.assertNotIn('attach_cd', self.boot.calls)
+        self.assertNotIn('attach_fd', self.boot.calls)
+
+    def test_detach_error(self):
+        with mock.patch.object(RecordingBoot, '_detach_virtual_fd',
+                               side_effect=RuntimeError('BMC')):
+            with self.assertRaises(RuntimeError) as raised:
+                self.boot.prepare_ramdisk(self.task, {})
+
+        self.assertEqual('BMC', str(raised.exception))
+        self.assertTrue(virtmedia._prepare_deploy_images.called)
+        self.assertEqual(['detach_cd'], self.boot.calls)
+
+
+class BulkTestCase(VirtmediaTestCase):
+
+    def setUp(self):
+        super(BulkTestCase, self).setUp()
+        self.tasks = [FakeTask(FakeNode(uuid='node-uuid-%d' % index,
+                                        name='node-%d' % index))
+                      for index in range(1, 4)]
+
+    def _fail_for(self, name, error):
+        def _side_effect(task, *args):
+            if task.node.name == name:
+                raise error
+            return self.node_images
+        return _side_effect
+
+    def test_prepare_ramdisks_errors(self):
+        share_error = RuntimeError('share')
+        bmc_error = RuntimeError('BMC')
+        virtmedia._prepare_deploy_images.side_effect = self._fail_for(
+            'node-2', share_error)
+        skipped = FakeTask(FakeNode(uuid='node-uuid-4', name='node-4',
+                                    provision_state=states.ACTIVE))
+
+        with mock.patch.object(RecordingBoot, '_attach_virtual_cd',
+                               side_effect=self._fail_for('node-3',
+                                                          bmc_error)):
+            results = self.boot.prepare_ramdisks(
+                [(task, {}) for task in self.tasks + [skipped]])
+
+        self.assertEqual(['node-uuid-1', 'node-uuid-2', 'node-uuid-3'],
+                         sorted(results))
+        self.assertTrue(results['node-uuid-1']['success'])
+        self.assertIsNone(results['node-uuid-1']['error'])
+        self.assertEqual(['bmc', 'share', 'total'],
+                         sorted(results['node-uuid-1']['timings']))
+        self.assertFalse(results['node-uuid-2']['success'])
+        self.assertIs(share_error, results['node-uuid-2']['error'])
+        self.assertFalse(results['node-uuid-3']['success'])
+        self.assertIs(bmc_error, results['node-uuid-3']['error'])
+        virtmedia.manager_utils.node_set_boot_device.assert_called_once_with(
+            self.tasks[0], mock.ANY)
+
+    def test_clean_up_ramdisks_errors(self):
+        bmc_error = RuntimeError('BMC')
+
+        with mock.patch.object(RecordingBoot, '_detach_virtual_fd',
+                               side_effect=self._fail_for('node-2',
+                                                          bmc_error)):
+            results = self.boot.clean_up_ramdisks(self.tasks)
+
+        self.assertEqual([True, False, True],
+                         [results['node-uuid-%d' % index]['success']
+                          for index in range(1, 4)])
+        self.assertIs(bmc_error, results['node-uuid-2']['error'])
+
+
+class ShareTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ShareTestCase, self).setUp()
+        self.root = self.make_tempdir()
+        self.config(remote_image_share_root=self.root,
+                    virtmedia_share_layout='flat',
+                    virtmedia_cd_params_format='append')
+        self.task = FakeTask()
+        self.base_data = b'\x01' * (3 * 2048 + 100)
+        self._write('base.iso', self.base_data)
+        self._write('image-node-1.img', b'\x02' * 1440)
+
+    def _write(self, filename, data):
+        with open(os.path.join(self.root, filename), 'wb') as share_file:
+            share_file.write(data)
+
+    def _read(self, filename):
+        with open(os.path.join(self.root, filename), 'rb') as share_file:
+            return share_file.read()
+
+
+class NodeIsoTestCase(ShareTestCase):
+
+    def test_base_iso_unchanged(self):
+        base_path = os.path.join(self.root, 'base.iso')
+        base_stat = os.stat(base_path)
+
+        node_iso = virtmedia._prepare_node_iso(
+            self.task, 'base.iso', 'image-node-1.img')
+
+        self.assertEqual('deploy-node-1.iso', node_iso)
+        self.assertEqual(self.base_data, self._read('base.iso'))
+        self.assertEqual(base_stat.st_ino, os.stat(base_path).st_ino)
+        self.assertEqual(1, os.stat(base_path).st_nlink)
+        node_data = self._read(node_iso)
+        self.assertEqual(self.base_data, node_data[:len(self.base_data)])
+        self.assertGreater(len(node_data), len(self.base_data))
+        self.assertEqual(['base.iso', 'deploy-node-1.iso',
+                          'image-node-1.img'], sorted(os.listdir(self.root)))
+
+    def test_base_iso_linked_without_floppy(self):
+        node_iso = virtmedia._prepare_node_iso(self.task, 'base.iso')
+
+        self.assertEqual(self.base_data, self._read(node_iso))
+        self.assertEqual(os.stat(os.path.join(self.root, 'base.iso')).st_ino,
+                         os.stat(os.path.join(self.root, node_iso)).st_ino)
+
+    def _append_floppy(self, floppy_data):
+        self._write('image-node-1.img', floppy_data)
+        node_iso = virtmedia._prepare_node_iso(
+            self.task, 'base.iso', 'image-node-1.img')
+        node_data = self._read(node_iso)
+        # Appended at the end of the ISO, as dd oflag=append did.
+        self.assertEqual(self.base_data, node_data[:len(self.base_data)])
+        payload = node_data[len(self.base_data):]
+        self.assertEqual(0, len(payload) % (64 * 1024))
+        return payload
+
+    def _assert_floppy_in(self, payload, floppy_data):
+        tar = tarfile.open(fileobj=io.BytesIO(payload), mode='r:*')
+        try:
+            self.assertEqual(['image-node-1.img'], tar.getnames())
+            self.assertEqual(floppy_data,
+                             tar.extractfile('image-node-1.img').read())
+        finally:
+            tar.close()
+
+    def test_append_floppy_gzip(self):
+        floppy_data = b'\0' * 1440 * 1024
+        payload = self._append_floppy(floppy_data)
+
+        self.assertEqual(b'\x1f\x8b', payload[:2])
+        self.assertEqual(64 * 1024, len(payload))
+        self._assert_floppy_in(payload, floppy_data)
+
+    def test_append_floppy_plain(self):
+        # A floppy whose tar archive, with its pax mtime header, fills 5
+        # blocks exactly: stored compression does not save any.
+        floppy_data = b'\x03' * (5 * 64 * 1024 - 5 * 512)
+        with mock.patch.object(virtmedia.gzip, 'GzipFile',
+                               functools.partial(gzip.GzipFile,
+                                                 compresslevel=0)):
+            payload = self._append_floppy(floppy_data)
+
+        self.assertNotEqual(b'\x1f\x8b', payload[:2])
+        self.assertEqual(5 * 64 * 1024, len(payload))
+        self._assert_floppy_in(payload, floppy_data)
+
+
+class NodeImagesTestCase(ShareTestCase):
+
+    def setUp(self):
+        super(NodeImagesTestCase, self).setUp()
+        self.config(virtmedia_reuse_node_images=True)
+        self.params = {'BOOTIF': '52:54:00:12:34:56', 'ipa-debug': '1'}
+        patcher = mock.patch.object(virtmedia, '_prepare_node_iso',
+                                    wraps=virtmedia._prepare_node_iso)
+        self.mock_prepare_node_iso = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _prepare(self, params=None):
+        return virtmedia._prepare_node_images(self.task, 'base.iso',
+                                              params or self.params)
+
+    def test_reused(self):
+        node_images = self._prepare()
+        self._prepare()
+        self.assertEqual(1, self.mock_prepare_node_iso.call_count)
+
+        self.assertEqual(node_images, self._prepare(dict(self.params)))
+        self.assertEqual(1, self.mock_prepare_node_iso.call_count)
+
+    def test_not_reused_when_disabled(self):
+        self.config(virtmedia_reuse_node_images=False)
+        self._prepare()
+        self._prepare()
+
+        self.assertEqual(2, self.mock_prepare_node_iso.call_count)
+
+    def test_params_changed(self):
+        self._prepare()
+        self._prepare(dict(self.params, BOOTIF='52:54:00:12:34:57'))
+
+        self.assertEqual(2, self.mock_prepare_node_iso.call_count)
+        self._prepare(dict(self.params, BOOTIF='52:54:00:12:34:57'))
+        self.assertEqual(2, self.mock_prepare_node_iso.call_count)
+
+    def test_base_iso_changed(self):
+        self._prepare()
+        self.base_data = b'\x04' * (4 * 2048)
+        self._write('base.iso', self.base_data)
+        _floppy, node_iso = self._prepare()
+
+        self.assertEqual(2, self.mock_prepare_node_iso.call_count)
+        self.assertEqual(self.base_data,
+                         self._read(node_iso)[:len(self.base_data)])
+
+    def test_node_image_changed(self):
+        _floppy, node_iso = self._prepare()
+        self._write(node_iso, b'\x05')
+        self._prepare()
+
+        self.assertEqual(2, self.mock_prepare_node_iso.call_count)
+        self.assertEqual(self.base_data,
+                         self._read(node_iso)[:len(self.base_data)])
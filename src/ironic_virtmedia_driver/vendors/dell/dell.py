@@ -18,6 +18,7 @@ from ironic.common.i18n import _
 from ironic.conductor import utils as manager_utils
 from ironic.drivers.modules import ipmitool
 from ironic_virtmedia_driver.vendors.ironic_virtmedia_hw import IronicVirtMediaHW
+from ironic_virtmedia_driver.vendors.ironic_virtmedia_hw import timed_phase
 from ironic_virtmedia_driver import virtmedia_exception
 
 from redfish import redfish_client, AuthMethod
@@ -29,6 +30,7 @@ class DELL(IronicVirtMediaHW):
         self.remote_share = '/bootimages/'
         self.idrac_location = '/redfish/v1/Managers/iDRAC.Embedded.1/'
 
+    @timed_phase('login')
     def _init_connection(self, driver_info):
         """Get connection info and init rest_object"""
         host = 'https://' + driver_info['address']
@@ -61,6 +63,7 @@ class DELL(IronicVirtMediaHW):
             except Exception:
                 raise virtmedia_exception.VirtmediaOperationError("Response status is not 200, %s"% response)
 
+    @timed_phase('check_idrac_version')
     def _check_supported_idrac_version(self, connection):
         response = connection.get('%s/VirtualMedia/CD'%self.idrac_location)
         self._check_success(response)
@@ -94,6 +97,7 @@ class DELL(IronicVirtMediaHW):
         resp = connection.post(mount_location, body=payload)
         self._check_success(resp)
 
+    @timed_phase('unmount_all')
     def _unmount_all(self, connection):
         medias = self._get_virtual_media_devices(connection)
         for media in medias:
@@ -110,12 +114,14 @@ class DELL(IronicVirtMediaHW):
                 return media["@odata.id"]
         return None
 
+    @timed_phase('mount_virtual_cd')
     def _mount_virtual_cd(self, connection, image_location):
         self._unmount_all(connection)
         self.log.debug("Mount")
         media_uri = self._find_first_media(connection, "DVD")
         self._mount_virtual_device(connection, media_uri, image_location)
 
+    @timed_phase('attach_virtual_cd')
     def attach_virtual_cd(self, image_filename, driver_info, task):
         connection = None
         try:
@@ -132,6 +138,7 @@ class DELL(IronicVirtMediaHW):
                 connection.logout()
             raise
 
+    @timed_phase('detach_virtual_cd')
     def detach_virtual_cd(self, driver_info, task):
         connection = None
         try:
@@ -146,6 +153,7 @@ class DELL(IronicVirtMediaHW):
                 connection.logout()
             raise
 
+    @timed_phase('set_boot_device')
     def set_boot_device(self, task):
         try:
             #BMC boot flag valid bit clearing 1f -> all bit set
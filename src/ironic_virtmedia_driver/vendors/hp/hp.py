@@ -18,6 +18,7 @@ import json
 from ironic.common.i18n import _
 
 from ironic_virtmedia_driver.vendors.ironic_virtmedia_hw import IronicVirtMediaHW
+from ironic_virtmedia_driver.vendors.ironic_virtmedia_hw import timed_phase
 from ironic_virtmedia_driver import virtmedia_exception
 
 import redfish.ris.tpdefs
@@ -30,6 +31,7 @@ class HP(IronicVirtMediaHW):
         self.remote_share = '/bootimages/'
         self.typepath = None
 
+    @timed_phase('login')
     def _init_connection(self, driver_info):
         """Get connection info and init rest_object"""
         host = 'https://' + driver_info['address']
@@ -126,6 +128,7 @@ class HP(IronicVirtMediaHW):
         rsp = connection.get(rsp.dict["VirtualMedia"]["@odata.id"])
         return rsp.dict['Members']
 
+    @timed_phase('mount_virtual_cd')
     def _mount_virtual_cd(self, connection, image_location):
         instances = self._get_instances(connection)
         for instance in instances:
@@ -150,6 +153,7 @@ class HP(IronicVirtMediaHW):
                     raise virtmedia_exception.VirtmediaOperationError(
                         operation=operation, error=error)
 
+    @timed_phase('attach_virtual_cd')
     def attach_virtual_cd(self, image_filename, driver_info, task):
         connection = self._init_connection(driver_info)
         image_location = 'http://' + driver_info['provisioning_server'] + ':' + driver_info['provisioning_server_http_port'] + self.remote_share + image_filename
@@ -157,6 +161,7 @@ class HP(IronicVirtMediaHW):
         connection.logout()
         return True
 
+    @timed_phase('detach_virtual_cd')
     def detach_virtual_cd(self, driver_info, task):
         connection = self._init_connection(driver_info)
         instances = self._get_instances(connection)
@@ -13,9 +13,55 @@
 # limitations under the License.
 #
 
+import functools
+
+from ironic_lib import metrics_utils
+
+from ironic_virtmedia_driver import profiling
+
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
+
+def timed_phase(phase):
+    """Times a method of IronicVirtMediaHW as the given phase."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.timer(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class IronicVirtMediaHW(object):
     def __init__(self, log):
         self.log = log
+        # e.g. vendors/nokia/rm18.py:RM18 -> nokia, rm18
+        self.vendor = type(self).__module__.split('.')[-2]
+        self.product_family = type(self).__name__.lower()
+        profiling.instrument(self, ('attach_virtual_cd', 'detach_virtual_cd',
+                                    'set_boot_device'))
+
+    def _metric_name(self, phase):
+        return '%s.%s.%s' % (self.vendor, self.product_family, phase)
+
+    def timer(self, phase):
+        """Returns a metrics timer for a phase of this hardware type.
+
+        The metric name is tagged with the vendor and the product family,
+        e.g. nokia.rm18.wait_for_mount_count.
+
+        :param phase: the name of the phase.
+        """
+        return METRICS.timer(self._metric_name(phase))
+
+    def count(self, event, value=1):
+        """Sends a metrics counter for an event of this hardware type.
+
+        :param event: the name of the event.
+        :param value: the value to add to the counter.
+        """
+        METRICS.send_counter(self._metric_name(event), value)
 
     def attach_virtual_cd(self, image_filename, driver_info, task):
         """Attaches the given image as virtual media on the node.
@@ -20,6 +20,7 @@ from ironic.conductor import utils as manager_utils
 from ironic.common import exception
 from ironic.common import boot_devices
 
+from ..ironic_virtmedia_hw import timed_phase
 from .nokia_hw import NokiaIronicVirtMediaHW
 
 class HW17(NokiaIronicVirtMediaHW):
@@ -39,7 +40,11 @@ class HW17(NokiaIronicVirtMediaHW):
         else:
             return 'dismounted'
 
+    @timed_phase('attach_virtual_cd')
     def attach_virtual_cd(self, image_filename, driver_info, task):
+        share_path, image_name = self.split_share_path(image_filename)
+        if not self.check_share_path(share_path):
+            return False
 
         # Stop virtual device and Clear NFS configuration
         ipmitool.send_raw(task, '0x3c 0x0')
@@ -47,9 +52,9 @@ class HW17(NokiaIronicVirtMediaHW):
         # NFS server IP
         ipmitool.send_raw(task, '0x3c 0x01 0x00 %s 0x00' %(self.hex_convert(driver_info['provisioning_server'])))
         # Set NFS Mount Root path
-        ipmitool.send_raw(task, '0x3c 0x01 0x01 %s 0x00' %(self.hex_convert(self.remote_share)))
+        ipmitool.send_raw(task, '0x3c 0x01 0x01 %s 0x00' %(self.hex_convert(share_path)))
         # Set Image Name
-        ipmitool.send_raw(task, '0x3c 0x01 0x02 %s 0x00' %(self.hex_convert(image_filename)))
+        ipmitool.send_raw(task, '0x3c 0x01 0x02 %s 0x00' %(self.hex_convert(image_name)))
         # Start NFS Service
         ipmitool.send_raw(task, '0x3c 0x02 0x01')
 
@@ -57,6 +62,7 @@ class HW17(NokiaIronicVirtMediaHW):
 
         return self.check_and_wait_for_cd_mounting(image_filename, task, driver_info)
 
+    @timed_phase('detach_virtual_cd')
     def detach_virtual_cd(self, driver_info, task):
         """Detaches virtual cdrom on the node.
 
@@ -66,5 +72,6 @@ class HW17(NokiaIronicVirtMediaHW):
         self.log.debug("detach_virtual_cd")
         ipmitool.send_raw(task, '0x3c 0x00')
 
+    @timed_phase('set_boot_device')
     def set_boot_device(self, task):
         manager_utils.node_set_boot_device(task, boot_devices.FLOPPY, persistent=True)
@@ -13,6 +13,7 @@
 # limitations under the License.
 #
 
+import os
 import time
 
 from ironic.drivers.modules import ipmitool
@@ -21,12 +22,42 @@ from oslo_concurrency import processutils
 from ironic.common import exception
 
 from ..ironic_virtmedia_hw import IronicVirtMediaHW
+from ..ironic_virtmedia_hw import timed_phase
+
+# The BMCs take NFS paths of up to this many characters.
+MAX_SHARE_PATH = 64
 
 class NokiaIronicVirtMediaHW(IronicVirtMediaHW):
     def __init__(self, log):
         super(NokiaIronicVirtMediaHW, self).__init__(log)
         self.remote_share = '/remote_image_share_root/'
 
+    def split_share_path(self, image_filename):
+        """Splits a share file name into the NFS path and the image name.
+
+        With the share layouts that put the files of a node in a directory,
+        the BMC mounts that directory of the share.
+
+        :param image_filename: the file name, relative to the share.
+        :returns: a tuple of the NFS path and the image name.
+        """
+        directory, image_name = os.path.split(image_filename)
+        if not directory:
+            return self.remote_share, image_name
+        return '%s%s/' % (self.remote_share, directory), image_name
+
+    def check_share_path(self, share_path):
+        """Whether the BMC can take an NFS path, logs why not.
+
+        The node directories of the "node" virtmedia_share_layout make the
+        paths too long with the default remote_share.
+        """
+        if len(share_path) > MAX_SHARE_PATH:
+            self.log.error('Virtual media path "%s" is longer than %d '
+                           'characters' % (share_path, MAX_SHARE_PATH))
+            return False
+        return True
+
     def attach_virtual_cd(self, image_filename, driver_info, task):
         """ see ironic_virtmedia_hw.py"""
         raise NotImplementedError
@@ -51,12 +82,13 @@ class NokiaIronicVirtMediaHW(IronicVirtMediaHW):
     @staticmethod
     def hex_convert(string_value, padding=False, length=0):
         hex_value = '0x'
-        hex_value += ' 0x'.join(x.encode('hex') for x in string_value)
+        hex_value += ' 0x'.join('%02x' % ord(x) for x in string_value)
         if padding and (len(string_value)<length):
             hex_value += ' 0x'
             hex_value += ' 0x'.join('00' for _ in range(len(string_value), length)) 
         return hex_value
 
+    @timed_phase('bmc_reset')
     def _issue_bmc_reset(self, driver_info, task):
         """ Issues a bmc reset and waits till the bcm is ready for servicing
         """
@@ -94,6 +126,7 @@ class NokiaIronicVirtMediaHW(IronicVirtMediaHW):
             raise exception.IPMIFailure(cmd='bmc reset')
 
 
+    @timed_phase('wait_for_cd_mounting')
     def _wait_for_cd_mounting(self, driver_info, task):
         sleep_count = 10
         while self.get_disk_attachment_status(task) == 'mounting' and sleep_count:
@@ -107,6 +140,7 @@ class NokiaIronicVirtMediaHW(IronicVirtMediaHW):
         self.log.warning("NFS mount timed out!. Trying BMC reset!")
         self._issue_bmc_reset(driver_info, task)
 
+    @timed_phase('check_cd_mounting')
     def check_and_wait_for_cd_mounting(self, image_filename, task, driver_info):
         mount_status = self.get_disk_attachment_status(task)
         if mount_status == 'mounting':
@@ -19,12 +19,14 @@ from ironic.conductor import utils as manager_utils
 from ironic.common import boot_devices
 from ironic.common import exception
 
+from ..ironic_virtmedia_hw import timed_phase
 from .rm18 import RM18
 
 class OE19(RM18):
     def __init__(self, log):
         super(OE19, self).__init__(log)
 
+    @timed_phase('set_boot_device')
     def set_boot_device(self, task):
         manager_utils.node_set_boot_device(task, boot_devices.FLOPPY, persistent=True)
 
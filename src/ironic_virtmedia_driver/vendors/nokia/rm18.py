@@ -20,6 +20,7 @@ from ironic.common import boot_devices
 from ironic.common import exception
 from ironic.drivers.modules import ipmitool
 
+from ..ironic_virtmedia_hw import timed_phase
 from .nokia_hw import NokiaIronicVirtMediaHW
 
 class RM18(NokiaIronicVirtMediaHW):
@@ -63,6 +64,7 @@ class RM18(NokiaIronicVirtMediaHW):
             self.log.debug('Exception when getting number of enabled %s devices. error: %s' % (devicetype, str(err)))
 
 
+    @timed_phase('set_virtual_media_device_count')
     def _set_virtual_media_device_count(self, task, devicetype, devicecount):
         # Chapter 46.2 page 181
         if not 0 <= devicecount <= 4:
@@ -127,6 +129,7 @@ class RM18(NokiaIronicVirtMediaHW):
         except Exception as err:
             self.log.warning('Exception when restarting virtual media service: %s' % str(err))
 
+    @timed_phase('restart_ris')
     def _restart_ris(self, task):
         try:
             self.log.debug('Restart RIS')
@@ -137,6 +140,7 @@ class RM18(NokiaIronicVirtMediaHW):
             return False
         return True
 
+    @timed_phase('restart_ris_cd')
     def _restart_ris_cd(self, task):
         try:
             self.log.debug('Restart RIS CD media')
@@ -147,6 +151,7 @@ class RM18(NokiaIronicVirtMediaHW):
             return False
         return True
 
+    @timed_phase('enable_virtual_media')
     def _enable_virtual_media(self, task):
         # Speed up things if it service is already running
         if self._check_virtual_media_started(task):
@@ -186,9 +191,10 @@ class RM18(NokiaIronicVirtMediaHW):
             self.log.warning('Exception when setting virtual media service type NFS: %s' % str(err))
             raise err
 
-    def _set_nfs_root_path(self, driver_info, task):
+    def _set_nfs_root_path(self, driver_info, task, share_path=None):
+        share_path = share_path or self.remote_share
         try:
-            self.log.debug('Virtual media path to "%s"' % self.remote_share)
+            self.log.debug('Virtual media path to "%s"' % share_path)
             # set progress bit (hmm. seems to return error if it is already set.. So should check..)
             # Welp there is no way checking this. As workaround clearing it first ( does not seem to
             # return error even if alreay cleared).
@@ -200,7 +206,7 @@ class RM18(NokiaIronicVirtMediaHW):
             cmd = '0x32 0x9f 0x01 0x01 0x00 0x01'
             ipmitool.send_raw(task, cmd)
             time.sleep(2)
-            cmd = '0x32 0x9f 0x01 0x01 0x01 %s' % (self.hex_convert(self.remote_share, True, 64))
+            cmd = '0x32 0x9f 0x01 0x01 0x01 %s' % (self.hex_convert(share_path, True, 64))
             ipmitool.send_raw(task, cmd)
             time.sleep(2)
             # clear progress bit
@@ -210,19 +216,24 @@ class RM18(NokiaIronicVirtMediaHW):
             self.log.warning('Exception when setting virtual media path: %s' % str(err))
             return False
 
-    def _set_setup_nfs(self, driver_info, task):
+    @timed_phase('setup_nfs')
+    def _set_setup_nfs(self, driver_info, task, share_path=None):
+        share_path = share_path or self.remote_share
+        if not self.check_share_path(share_path):
+            return False
         try:
             # Set share type NFS
             self._set_share_type(task)
             # NFS server IP
             self._set_nfs_server_ip(driver_info, task)
             # Set NFS Mount Root path
-            self._set_nfs_root_path(driver_info, task)
+            self._set_nfs_root_path(driver_info, task, share_path)
             return True
 
         except Exception:
             return False
 
+    @timed_phase('toggle_virtual_device')
     def _toggle_virtual_device(self, enabled, task):
         # Enable "Mount CD/DVD" in GUI (p144) should cause vmedia restart withing 2 seconds.
         # Seems "Mount CD/DVD" need to be enabled (or toggled) after config. refresh/vmedia restart
@@ -276,6 +287,7 @@ class RM18(NokiaIronicVirtMediaHW):
             self.log.debug('Exception when trying to get the image count: %s' % str(err))
         return count
 
+    @timed_phase('set_image_name')
     def _set_image_name(self, image_filename, task):
         try:
             #cmd = '0x32 0xd7 0x01 0x01 0x01 0x01 %s' % (self.hex_convert(image_filename))
@@ -287,6 +299,7 @@ class RM18(NokiaIronicVirtMediaHW):
             return False
         return True
 
+    @timed_phase('stop_remote_redirection')
     def _stop_remote_redirection(self, task):
         try:
             # Get num of enabled devices
@@ -301,6 +314,7 @@ class RM18(NokiaIronicVirtMediaHW):
             self.log.debug('_stop_remote_redirection: Ignoring exception when stopping redirection CD/DVD drive index %d error: %s' % (driveindex, str(err)))
             pass
 
+    @timed_phase('clear_ris_configuration')
     def _clear_ris_configuration(self, task):
         # Clear RIS configuration
         try:
@@ -312,6 +326,7 @@ class RM18(NokiaIronicVirtMediaHW):
             return False
         return True
 
+    @timed_phase('wait_for_mount_count')
     def _wait_for_mount_count(self, task):
         # Poll until we got some images from server
         _max_tries = 12
@@ -325,7 +340,9 @@ class RM18(NokiaIronicVirtMediaHW):
             _try = _try + 1
         return True
 
+    @timed_phase('attach_virtual_cd')
     def attach_virtual_cd(self, image_filename, driver_info, task):
+        share_path, image_name = self.split_share_path(image_filename)
 
         #Enable virtual media
         if not self._enable_virtual_media(task):
@@ -343,7 +360,7 @@ class RM18(NokiaIronicVirtMediaHW):
             return False
 
         #Setup nfs
-        if not self._set_setup_nfs(driver_info, task):
+        if not self._set_setup_nfs(driver_info, task, share_path):
             self.log.error("Failed to setup nfs")
             return False
 
@@ -358,12 +375,13 @@ class RM18(NokiaIronicVirtMediaHW):
             return False
 
         # Set Image Name
-        if not self._set_image_name(image_filename, task):
+        if not self._set_image_name(image_name, task):
             self.log.error("Failed to set image name")
             return False
 
         return self.check_and_wait_for_cd_mounting(image_filename, task, driver_info)
 
+    @timed_phase('detach_virtual_cd')
     def detach_virtual_cd(self, driver_info, task):
         """Detaches virtual cdrom on the node.
 
@@ -400,6 +418,7 @@ class RM18(NokiaIronicVirtMediaHW):
 
         return True
 
+    @timed_phase('set_boot_device')
     def set_boot_device(self, task):
         manager_utils.node_set_boot_device(task, boot_devices.FLOPPY, persistent=True)
 #        try:
@@ -0,0 +1,184 @@
+# Copyright 2019 Nokia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-memory FAT12/FAT16 image writer.
+
+Builds small single-directory vfat images, like the one ironic creates
+with mkfs.vfat and a loop mount in images.create_vfat_image, without any
+subprocess, mount or temporary file. The image is sized to its content.
+"""
+
+import struct
+import time
+
+SECTOR_SIZE = 512
+
+DEFAULT_LABEL = 'ir-vfd-dev'
+
+_MEDIA_DESCRIPTOR = 0xf8
+_FAT12_MAX_CLUSTERS = 4084
+_FAT16_MAX_CLUSTERS = 65524
+_DIR_ENTRY_SIZE = 32
+_LFN_CHARS = 13
+
+_ATTR_ARCHIVE = 0x20
+_ATTR_VOLUME_ID = 0x08
+_ATTR_LFN = 0x0f
+
+_SHORT_NAME_CHARS = frozenset(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%\'-_@~`!(){}^#&')
+
+
+def _dos_datetime(timestamp):
+    tm = time.localtime(timestamp)
+    dos_date = ((max(tm.tm_year, 1980) - 1980) << 9 |
+                tm.tm_mon << 5 | tm.tm_mday)
+    dos_time = tm.tm_hour << 11 | tm.tm_min << 5 | tm.tm_sec // 2
+    return dos_date, dos_time
+
+
+def _short_name(name, index):
+    """Returns the 11 byte 8.3 name and whether a long name is needed."""
+    base, _sep, ext = name.rpartition('.')
+    if not base:
+        base, ext = ext, ''
+    upper_base = ''.join(c for c in base.upper() if c in _SHORT_NAME_CHARS)
+    upper_ext = ''.join(c for c in ext.upper() if c in _SHORT_NAME_CHARS)
+    needs_lfn = (upper_base != base or upper_ext != ext or
+                 len(base) > 8 or len(ext) > 3)
+    if needs_lfn:
+        tail = '~%d' % index
+        upper_base = upper_base[:8 - len(tail)] + tail
+    short = upper_base.ljust(8)[:8] + upper_ext.ljust(3)[:3]
+    return short.encode('ascii'), needs_lfn
+
+
+def _lfn_checksum(short_name):
+    checksum = 0
+    for byte in bytearray(short_name):
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xff
+    return checksum
+
+
+def _lfn_entries(name, short_name):
+    checksum = _lfn_checksum(short_name)
+    chars = [ord(c) for c in name] + [0]
+    if len(chars) % _LFN_CHARS:
+        chars += [0xffff] * (_LFN_CHARS - len(chars) % _LFN_CHARS)
+    count = len(chars) // _LFN_CHARS
+    entries = []
+    for seq in range(count, 0, -1):
+        part = chars[(seq - 1) * _LFN_CHARS:seq * _LFN_CHARS]
+        order = seq | 0x40 if seq == count else seq
+        entries.append(struct.pack('<B5HBBB6HH2H', order, *(
+            part[0:5] + [_ATTR_LFN, 0, checksum] + part[5:11] + [0] +
+            part[11:13])))
+    return entries
+
+
+def _dir_entry(short_name, attr, cluster, size, dos_date, dos_time):
+    return struct.pack('<11sBBBHHHHHHHI', short_name, attr, 0, 0,
+                       dos_time, dos_date, dos_date, 0,
+                       dos_time, dos_date, cluster, size)
+
+
+def _layout(file_clusters, root_entries):
+    """Computes the FAT type and size of the file system."""
+    root_sectors = -(-root_entries * _DIR_ENTRY_SIZE // SECTOR_SIZE)
+    clusters = max(file_clusters, 1)
+    for fat_bits in (12, 16):
+        max_clusters = (_FAT12_MAX_CLUSTERS if fat_bits == 12
+                        else _FAT16_MAX_CLUSTERS)
+        if clusters > max_clusters:
+            continue
+        fat_bytes = -(-(clusters + 2) * fat_bits // 8)
+        fat_sectors = -(-fat_bytes // SECTOR_SIZE)
+        return fat_bits, fat_sectors, root_sectors, clusters
+    raise ValueError('Content too large for a FAT16 image')
+
+
+def _pack_fat(fat_bits, chain):
+    if fat_bits == 16:
+        return struct.pack('<%dH' % len(chain), *chain)
+    fat = bytearray()
+    for i in range(0, len(chain), 2):
+        low = chain[i]
+        high = chain[i + 1] if i + 1 < len(chain) else 0
+        fat += bytearray((low & 0xff, (low >> 8) | ((high & 0x0f) << 4),
+                          high >> 4))
+    return bytes(fat)
+
+
+def create_vfat_image(files, label=DEFAULT_LABEL, timestamp=None):
+    """Creates a vfat image holding the given files in its root directory.
+
+    :param files: a list of (file name, contents) tuples, contents being
+        bytes.
+    :param label: the volume label, at most 11 characters.
+    :param timestamp: the modification time of the files, defaults to now.
+    :returns: the image as bytes.
+    :raises: ValueError, if the content does not fit in a FAT16 image.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    dos_date, dos_time = _dos_datetime(timestamp)
+
+    entries = [_dir_entry(label.encode('ascii').ljust(11)[:11],
+                          _ATTR_VOLUME_ID, 0, 0, dos_date, dos_time)]
+    file_clusters = 0
+    placed = []
+    for index, (name, contents) in enumerate(files, 1):
+        clusters = -(-len(contents) // SECTOR_SIZE)
+        short_name, needs_lfn = _short_name(name, index)
+        if needs_lfn:
+            entries.extend(_lfn_entries(name, short_name))
+        first_cluster = file_clusters + 2 if clusters else 0
+        entries.append(_dir_entry(short_name, _ATTR_ARCHIVE, first_cluster,
+                                  len(contents), dos_date, dos_time))
+        placed.append((contents, clusters))
+        file_clusters += clusters
+
+    root_entries = -(-len(entries) // 16) * 16
+    fat_bits, fat_sectors, root_sectors, clusters = _layout(
+        file_clusters, root_entries)
+    total_sectors = 1 + 2 * fat_sectors + root_sectors + clusters
+
+    end_of_chain = 0xfff if fat_bits == 12 else 0xffff
+    chain = [end_of_chain & ~0xff | _MEDIA_DESCRIPTOR, end_of_chain]
+    for _contents, file_cluster_count in placed:
+        first = len(chain)
+        chain.extend(range(first + 1, first + file_cluster_count))
+        if file_cluster_count:
+            chain.append(end_of_chain)
+    fat = _pack_fat(fat_bits, chain).ljust(fat_sectors * SECTOR_SIZE,
+                                           b'\0')
+
+    boot_sector = struct.pack(
+        '<3s8sHBHBHHBHHHIIBBBI11s8s',
+        b'\xeb\x3c\x90', b'mkfs.fat', SECTOR_SIZE, 1, 1, 2, root_entries,
+        total_sectors if total_sectors < 0x10000 else 0,
+        _MEDIA_DESCRIPTOR, fat_sectors, 32, 64, 0,
+        total_sectors if total_sectors >= 0x10000 else 0,
+        0, 0, 0x29, int(timestamp) & 0xffffffff,
+        label.encode('ascii').ljust(11)[:11],
+        ('FAT%d' % fat_bits).encode('ascii').ljust(8))
+    boot_sector = boot_sector.ljust(SECTOR_SIZE - 2, b'\0') + b'\x55\xaa'
+
+    root = b''.join(entries).ljust(root_sectors * SECTOR_SIZE, b'\0')
+    data = b''.join(contents.ljust(file_cluster_count * SECTOR_SIZE, b'\0')
+                    for contents, file_cluster_count in placed)
+    data = data.ljust(clusters * SECTOR_SIZE, b'\0')
+
+    return b''.join((boot_sector, fat, fat, root, data))
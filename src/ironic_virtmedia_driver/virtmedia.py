@@ -13,27 +13,47 @@
 # limitations under the License.
 #
 
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
+import json
 import os
-import shutil
-import tempfile
 import tarfile
+import threading
+import time
 
+import futurist
+from futurist import periodics
+from futurist import waiters
 from ironic_lib import metrics_utils
 from ironic_lib import utils as ironic_utils
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import importutils
+from oslo_utils import uuidutils
 
 from ironic.common import boot_devices
 from ironic.common import exception
 from ironic.common.glance_service import service_utils
 from ironic.common.i18n import _, _translators
-from ironic.common import images
 from ironic.common import states
 from ironic.common import utils
 from ironic.conductor import utils as manager_utils
 from ironic_virtmedia_driver.conf import CONF
 from ironic.drivers import base
 from ironic.drivers.modules import deploy_utils
+from ironic_virtmedia_driver import image_cache
+from ironic_virtmedia_driver import iso9660
+from ironic_virtmedia_driver import page_cache
+from ironic_virtmedia_driver import params_server
+from ironic_virtmedia_driver import profiling
+from ironic_virtmedia_driver import share_gc
+from ironic_virtmedia_driver import share_index
+from ironic_virtmedia_driver import share_layout
+from ironic_virtmedia_driver import share_utils
+from ironic_virtmedia_driver import vfat_image
 from ironic_virtmedia_driver import virtmedia_exception
 
 LOG = logging.getLogger(__name__)
@@ -47,6 +67,21 @@ REQUIRED_PROPERTIES = {
 
 COMMON_PROPERTIES = REQUIRED_PROPERTIES
 
+# Boot interface calls profiled when virtmedia_profiling_enabled is set.
+PROFILED_METHODS = ('validate', 'prepare_ramdisk', 'prepare_ramdisks',
+                    'clean_up_ramdisk', 'clean_up_ramdisks',
+                    'prepare_instance', 'clean_up_instance')
+
+_APPEND_BLOCK_SIZE = 64 * 1024
+
+# driver_internal_info key of the desired and observed state of the virtual
+# media devices of a node.
+MEDIA_STATE = 'virtmedia_media_state'
+
+# Identifies the media state recorded by this process, the state recorded
+# by another one, or before a restart, is not trusted.
+_MEDIA_STATE_OWNER = uuidutils.generate_uuid()
+
 
 def _parse_config_option():
     """Parse config file options.
@@ -56,7 +91,9 @@ def _parse_config_option():
     :raises: InvalidParameterValue, if config option has invalid value.
     """
     error_msgs = []
-    if not os.path.isdir(CONF.remote_image_share_root):
+    index = share_index.get_index()
+    if not (index.root_exists() if index
+            else os.path.isdir(CONF.remote_image_share_root)):
         error_msgs.append(
             _("Value '%s' for remote_image_share_root isn't a directory "
               "or doesn't exist.") %
@@ -93,7 +130,9 @@ def _parse_driver_info(node):
             deploy_info['virtmedia_deploy_iso']):
         deploy_iso = os.path.join(CONF.remote_image_share_root,
                                   deploy_info['virtmedia_deploy_iso'])
-        if not os.path.isfile(deploy_iso):
+        index = share_index.get_index()
+        if not (index.isfile(deploy_info['virtmedia_deploy_iso']) if index
+                else os.path.isfile(deploy_iso)):
             msg = (_("Deploy ISO file, %(deploy_iso)s, "
                      "not found for node: %(node)s.") %
                    {'deploy_iso': deploy_iso, 'node': node.uuid})
@@ -124,74 +163,442 @@ def _parse_deploy_info(node):
 def _get_deploy_iso_name(node):
     """Returns the deploy ISO file name for a given node.
 
+    The name is relative to the share root and, depending on
+    virtmedia_share_layout, may include a per-node directory.
+
+    :param node: the node for which ISO file name is to be provided.
+    """
+    return share_layout.node_file(node, "deploy-%s.iso" % node.name)
+
+def _get_base_iso_name(node):
+    """Returns the file name a node's deploy ISO is downloaded to.
+
+    Used for the deploy ISOs that are not in the image cache. The per-node
+    ISO is built from it, so it is kept, with its digest, to be reused.
+
     :param node: the node for which ISO file name is to be provided.
     """
-    return "deploy-%s.iso" % node.name
+    return share_layout.node_file(node, "base-%s.iso" % node.name)
 
 def _get_boot_iso_name(node):
     """Returns the boot ISO file name for a given node.
 
     :param node: the node for which ISO file name is to be provided.
     """
-    return "boot-%s.iso" % node.uuid
+    return share_layout.node_file(node, "boot-%s.iso" % node.uuid)
 
 def _get_floppy_image_name(node):
     """Returns the floppy image name for a given node.
 
     :param node: the node for which image name is to be provided.
     """
-    return "image-%s.img" % node.name
+    return share_layout.node_file(node, "image-%s.img" % node.name)
+
+
+def _get_params_file_contents(params):
+    """Returns the parameters file passed to the ramdisk, as bytes.
+
+    :param params: a dictionary containing 'parameter name'->'value'
+        mapping.
+    """
+    # Same parameters file as images.create_vfat_image() creates.
+    params_list = ['%(key)s=%(val)s' % {'key': k, 'val': v}
+                   for k, v in params.items()]
+    return '\n'.join(params_list).encode('utf-8')
 
 
+@METRICS.timer('VirtualMediaBoot.prepare_floppy_image')
 def _prepare_floppy_image(task, params):
     """Prepares the floppy image for passing the parameters.
 
-    This method prepares a temporary vfat filesystem image, which
-    contains the parameters to be passed to the ramdisk.
-    Then it uploads the file NFS or CIFS server.
+    This method builds a vfat filesystem image in memory, which
+    contains the parameters to be passed to the ramdisk, and writes
+    it to the NFS or CIFS share in one go under a temporary name
+    that is then atomically renamed.
 
     :param task: a TaskManager instance containing the node to act on.
     :param params: a dictionary containing 'parameter name'->'value' mapping
         to be passed to the deploy ramdisk via the floppy image.
     :returns: floppy image filename
     :raises: ImageCreationFailed, if it failed while creating the floppy image.
-    :raises: VirtmediaOperationError, if copying floppy image file failed.
+    :raises: VirtmediaOperationError, if writing floppy image file failed.
     """
     floppy_filename = _get_floppy_image_name(task.node)
     floppy_fullpathname = os.path.join(
         CONF.remote_image_share_root, floppy_filename)
 
-    with tempfile.NamedTemporaryFile() as vfat_image_tmpfile_obj:
-        images.create_vfat_image(vfat_image_tmpfile_obj.name,
-                                 parameters=params)
-        try:
-            shutil.copyfile(vfat_image_tmpfile_obj.name,
-                            floppy_fullpathname)
-        except IOError as e:
-            operation = _("Copying floppy image file")
-            raise virtmedia_exception.VirtmediaOperationError(
-                operation=operation, error=e)
+    try:
+        image_data = vfat_image.create_vfat_image(
+            [('parameters.txt', _get_params_file_contents(params))])
+    except ValueError as e:
+        raise exception.ImageCreationFailed(image_type='vfat', error=e)
+
+    try:
+        share_layout.ensure_node_dir(task.node)
+        with share_utils.atomic_path(floppy_fullpathname) as tmp_path:
+            with open(tmp_path, 'wb') as floppy_file:
+                floppy_file.write(image_data)
+    except (IOError, OSError) as e:
+        operation = _("Writing floppy image file")
+        raise virtmedia_exception.VirtmediaOperationError(
+            operation=operation, error=e)
 
     return floppy_filename
 
+def _build_floppy_payload(floppy_image_full_path):
+    """Builds the tar payload appended to the CD, padded to 64K blocks.
+
+    The payload is the same tar archive `tar.add()` used to write to
+    disk. It is gzip compressed unless that does not save a single 64K
+    block, the ramdisk detects the compression when extracting it.
+
+    :param floppy_image_full_path: full path of the floppy image.
+    :returns: the payload as bytes.
+    """
+    tar_buf = io.BytesIO()
+    tar = tarfile.open(fileobj=tar_buf, mode='w')
+    try:
+        tarinfo = tar.gettarinfo(
+            floppy_image_full_path,
+            arcname=os.path.basename(floppy_image_full_path))
+        with open(floppy_image_full_path, 'rb') as floppy_file:
+            tar.addfile(tarinfo, floppy_file)
+    finally:
+        tar.close()
+    payload = tar_buf.getvalue()
+
+    gz_buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=gz_buf) as gz_file:
+        gz_file.write(payload)
+    gz_payload = gz_buf.getvalue()
+
+    def _blocks(data):
+        return -(-len(data) // _APPEND_BLOCK_SIZE)
+
+    if _blocks(gz_payload) <= _blocks(payload):
+        payload = gz_payload
+
+    # Same zero padding as dd conv=sync produced.
+    return payload.ljust(_blocks(payload) * _APPEND_BLOCK_SIZE, b'\0')
+
 def _append_floppy_to_cd(bootable_iso_filename, floppy_image_filename):
     """ Quanta HW cannot attach 2 Virtual media at the moment.
         Preparing CD which has floppy content at the end of it as
         64K block tar file.
+
+        The payload is built in memory and written with a single write
+        at the end of the ISO, as `dd oflag=append` did.
+    """
+    boot_iso_full_path = os.path.join(CONF.remote_image_share_root,
+                                      bootable_iso_filename)
+    floppy_image_full_path = os.path.join(CONF.remote_image_share_root,
+                                          floppy_image_filename)
+
+    payload = _build_floppy_payload(floppy_image_full_path)
+
+    try:
+        fd = os.open(boot_iso_full_path, os.O_WRONLY)
+        try:
+            offset = os.fstat(fd).st_size
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, payload, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, payload)
+            if written != len(payload):
+                raise IOError(_("Short write, %(written)d of %(size)d "
+                                "bytes") % {'written': written,
+                                            'size': len(payload)})
+        finally:
+            os.close(fd)
+        page_cache.drop(boot_iso_full_path, offset)
+    except (IOError, OSError) as e:
+        operation = _("Appending floppy image to CD")
+        raise virtmedia_exception.VirtmediaOperationError(
+            operation=operation, error=e)
+
+def _add_params_to_cd(bootable_iso_filename, floppy_image_filename,
+                      params):
+    """Adds the parameters to the CD as files of a /virtmedia directory.
+
+    The ISO9660 file system of the CD is remastered in place: only the
+    files, a new root directory and new path tables are written after the
+    end of the ISO, the original files keep their extents.
+
+    :param bootable_iso_filename: the ISO file name in the share file
+        system, modified in place.
+    :param floppy_image_filename: the floppy image, also added as
+        /virtmedia/floppy.img if virtmedia_cd_params_include_floppy is set.
+    :param params: a dictionary containing 'parameter name'->'value'
+        mapping, added as /virtmedia/params.
+    :raises: ImageCreationFailed, if the ISO is not an ISO9660 image.
+    :raises: VirtmediaOperationError, if writing the ISO failed.
     """
-    boot_iso_full_path = CONF.remote_image_share_root + bootable_iso_filename
-    floppy_image_full_path = CONF.remote_image_share_root + floppy_image_filename
-    tar_file_path = CONF.remote_image_share_root + floppy_image_filename + '.tar.gz' 
+    boot_iso_full_path = os.path.join(CONF.remote_image_share_root,
+                                      bootable_iso_filename)
+    floppy_image_full_path = os.path.join(CONF.remote_image_share_root,
+                                          floppy_image_filename)
+    try:
+        files = [('params', _get_params_file_contents(params))]
+        if CONF.virtmedia_cd_params_include_floppy:
+            with open(floppy_image_full_path, 'rb') as floppy_file:
+                files.append(('floppy.img', floppy_file.read()))
+        offset, written = iso9660.add_files(boot_iso_full_path, 'virtmedia',
+                                            files)
+        page_cache.drop(boot_iso_full_path, offset)
+    except iso9660.ISO9660Error as e:
+        raise exception.ImageCreationFailed(image_type='iso', error=e)
+    except (IOError, OSError) as e:
+        operation = _("Adding parameters to CD")
+        raise virtmedia_exception.VirtmediaOperationError(
+            operation=operation, error=e)
+    LOG.debug("Added the parameters to %(iso)s writing %(written)d bytes",
+              {'iso': bootable_iso_filename, 'written': written})
+
+@METRICS.timer('VirtualMediaBoot.prepare_node_iso')
+def _prepare_node_iso(task, base_iso_filename, floppy_image_filename=None,
+                      params=None):
+    """Prepares the per-node deploy ISO from a shared base ISO.
+
+    The base ISO is never modified. The per-node ISO is a copy-on-write
+    clone of it with the floppy image appended, or with the parameters
+    added to its file system depending on virtmedia_cd_params_format, so
+    preparing it costs about the size of the floppy image rather than the
+    size of the ISO, or a plain hardlink when there is nothing to add. It
+    is built under a temporary name and atomically renamed once complete.
 
-    # Prepare a temporary Tar file
-    tar = tarfile.open(tar_file_path, "w:gz")
-    tar.add(floppy_image_full_path, arcname=os.path.basename(floppy_image_full_path))
-    tar.close()
+    :param task: a TaskManager instance containing the node to act on.
+    :param base_iso_filename: the ISO file name in the share file system.
+    :param floppy_image_filename: the floppy image to append. Optional.
+    :param params: the parameters of the floppy image, required when it
+        is given and virtmedia_cd_params_format is 'iso9660'.
+    :returns: the per-node ISO file name.
+    """
+    node_iso_filename = _get_deploy_iso_name(task.node)
+    base_iso_fullpathname = os.path.join(
+        CONF.remote_image_share_root, base_iso_filename)
+    node_iso_fullpathname = os.path.join(
+        CONF.remote_image_share_root, node_iso_filename)
+    share_layout.ensure_node_dir(task.node)
+
+    if not floppy_image_filename:
+        if base_iso_filename != node_iso_filename:
+            share_utils.link_file(base_iso_fullpathname,
+                                  node_iso_fullpathname)
+        return node_iso_filename
+
+    with share_utils.atomic_path(node_iso_fullpathname) as tmp_path:
+        method = share_utils.clone_file(base_iso_fullpathname, tmp_path)
+        LOG.debug("Cloned %(base)s to %(iso)s using %(method)s",
+                  {'base': base_iso_filename, 'iso': node_iso_filename,
+                   'method': method})
+        tmp_filename = os.path.relpath(tmp_path,
+                                       CONF.remote_image_share_root)
+        if CONF.virtmedia_cd_params_format == 'iso9660':
+            _add_params_to_cd(tmp_filename, floppy_image_filename, params)
+        else:
+            _append_floppy_to_cd(tmp_filename, floppy_image_filename)
+
+    return node_iso_filename
+
+def _get_manifest_path(node):
+    """Returns the full path of the image manifest of a given node.
+
+    :param node: the node for which the manifest path is to be provided.
+    """
+    return os.path.join(CONF.remote_image_share_root,
+                        share_utils.MANIFEST_DIR,
+                        '%s.json' % node.uuid)
+
+def _get_params_hash(parameters):
+    """Returns a stable hash of the ramdisk parameters."""
+    serialized = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def _get_file_identity(share_filename):
+    """Returns what identifies the current contents of a share file.
+
+    :param share_filename: a file name in the share file system.
+    :returns: a list of inode, size and mtime, None if the file is missing.
+    """
+    try:
+        stat = os.stat(os.path.join(CONF.remote_image_share_root,
+                                    share_filename))
+    except OSError:
+        return None
+    return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+def _load_manifest(node):
+    try:
+        with open(_get_manifest_path(node)) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _save_manifest(node, manifest):
+    manifest_path = _get_manifest_path(node)
+    manifest_dir = os.path.dirname(manifest_path)
+    if not os.path.isdir(manifest_dir):
+        try:
+            os.makedirs(manifest_dir)
+        except OSError:
+            if not os.path.isdir(manifest_dir):
+                raise
+    with share_utils.atomic_path(manifest_path) as tmp_path:
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+def _remove_manifest(node):
+    ironic_utils.unlink_without_raise(_get_manifest_path(node))
+
+def _get_media_fingerprint(share_filename):
+    """Returns what identifies an image attached as virtual media.
+
+    :param share_filename: a file name in the share file system, or None
+        for no media.
+    """
+    if not share_filename:
+        return None
+    return {'image': share_filename,
+            'id': _get_file_identity(share_filename)}
+
+def _get_media_state(node, device):
+    """Returns the known state of a virtual media device of a node.
+
+    :param node: the node of interest.
+    :param device: 'cd' or 'fd'.
+    :returns: a tuple of whether the state is known and the fingerprint
+        of the attached image, None when nothing is attached. The state
+        is unknown when it was never recorded, when it was recorded by
+        another conductor or before a restart, or when the last operation
+        on the device did not complete.
+    """
+    media_state = node.driver_internal_info.get(MEDIA_STATE) or {}
+    if media_state.get('owner') != _MEDIA_STATE_OWNER:
+        return False, None
+    record = media_state.get(device)
+    if not record or record.get('desired') != record.get('observed'):
+        return False, None
+    return True, record['observed']
+
+def _record_media_state(node, device, **state):
+    """Records the desired or observed state of a virtual media device.
+
+    The state is only recorded in the node object, _saving_media_state
+    saves it.
+
+    :param node: the node of interest.
+    :param device: 'cd' or 'fd'.
+    :param state: 'desired', set before asking the BMC to change the
+        device, and/or 'observed', set once the BMC did.
+    """
+    driver_internal_info = node.driver_internal_info
+    media_state = driver_internal_info.get(MEDIA_STATE) or {}
+    if media_state.get('owner') != _MEDIA_STATE_OWNER:
+        media_state = {'owner': _MEDIA_STATE_OWNER}
+    media_state.setdefault(device, {}).update(state)
+    driver_internal_info[MEDIA_STATE] = media_state
+    node.driver_internal_info = driver_internal_info
+
+@contextlib.contextmanager
+def _saving_media_state(task):
+    """Saves the media state recorded in the block, once, at its end.
+
+    The state is saved even if the block fails, the devices it left in an
+    unknown state are then detached first the next time. Nothing is saved
+    when virtmedia_reconcile_media_state is not set, as nothing is
+    recorded.
+
+    :param task: a TaskManager instance containing the node to act on.
+    """
+    try:
+        yield
+    finally:
+        if CONF.virtmedia_reconcile_media_state:
+            task.node.save()
 
-    # Using dd append Tar to iso and remove Tar file
-    ironic_utils.dd(tar_file_path, boot_iso_full_path, 'bs=64k', 'conv=notrunc,sync', 'oflag=append')
+@METRICS.timer('VirtualMediaBoot.prepare_node_images')
+def _prepare_node_images(task, base_iso_filename, parameters=None):
+    """Prepares the floppy image and the per-node ISO of a node.
 
-    os.remove(tar_file_path)
+    When the parameters and the base ISO are the same as the last time
+    the images were built for the node, and the manifest recorded then
+    still matches the files in the share, the existing images are reused.
+
+    :param task: a TaskManager instance containing the node to act on.
+    :param base_iso_filename: the ISO file name in the share file system.
+    :param parameters: the parameters to pass in a virtual floppy image
+        in a dictionary.  This is optional.
+    :returns: a tuple of the floppy image file name (None when there are
+        no parameters) and the per-node ISO file name.
+    """
+    node = task.node
+    page_cache.warm(os.path.join(CONF.remote_image_share_root,
+                                 base_iso_filename))
+    if not parameters:
+        return None, _prepare_node_iso(task, base_iso_filename)
+
+    wanted = {'params': _get_params_hash(parameters),
+              'cd_params_format': CONF.virtmedia_cd_params_format,
+              'share_layout': CONF.virtmedia_share_layout,
+              'base': base_iso_filename,
+              'base_id': _get_file_identity(base_iso_filename)}
+    manifest = _load_manifest(node)
+    if (CONF.virtmedia_reuse_node_images and manifest and
+            all(manifest.get(key) == value
+                for key, value in wanted.items()) and
+            all(_get_file_identity(filename) == identity
+                for filename, identity in manifest['files'].items())):
+        LOG.debug("Reusing the virtual media images of node %s",
+                  node.uuid)
+        METRICS.send_counter('VirtualMediaBoot.node_images_reused', 1)
+        return manifest['floppy'], manifest['iso']
+
+    METRICS.send_counter('VirtualMediaBoot.node_images_built', 1)
+
+    _remove_manifest(node)
+    floppy_image_filename = _prepare_floppy_image(task, parameters)
+    node_iso_filename = _prepare_node_iso(task, base_iso_filename,
+                                          floppy_image_filename, parameters)
+    page_cache.drop(os.path.join(CONF.remote_image_share_root,
+                                 floppy_image_filename))
+    # Saved even when the images are not reused, as the share garbage
+    # collection keeps the base ISO of the busy nodes by their manifest.
+    wanted.update(
+        floppy=floppy_image_filename, iso=node_iso_filename,
+        files={filename: _get_file_identity(filename)
+               for filename in (floppy_image_filename,
+                                node_iso_filename)})
+    _save_manifest(node, wanted)
+    return floppy_image_filename, node_iso_filename
+
+def _prepare_deploy_images(task, deploy_iso_filename, ramdisk_params):
+    """Prepares the images of a node to boot the deploy ramdisk from.
+
+    With the "http" virtmedia_params_delivery, the parameters are published
+    on the params_server instead of being put in a floppy image, and the
+    per-node ISO is a hardlink to the deploy ISO, which all the nodes then
+    boot unmodified.
+
+    :param task: a TaskManager instance containing the node to act on.
+    :param deploy_iso_filename: the deploy ISO file name in the share file
+        system.
+    :param ramdisk_params: the options to be passed to the deploy ramdisk.
+    :returns: a tuple of the floppy image file name, or None, and the
+        per-node ISO file name.
+    """
+    if CONF.virtmedia_params_delivery != 'http':
+        return _prepare_node_images(task, deploy_iso_filename,
+                                    ramdisk_params)
+
+    macs = [port.address for port in task.ports]
+    macs.append(ramdisk_params.get('BOOTIF'))
+    params_server.publish_node(task.node, macs,
+                               _get_params_file_contents(ramdisk_params))
+    page_cache.warm(os.path.join(CONF.remote_image_share_root,
+                                 deploy_iso_filename))
+    _remove_manifest(task.node)
+    return None, _prepare_node_iso(task, deploy_iso_filename)
 
 def _remove_share_file(share_filename):
     """Remove given file from the share file system.
@@ -203,6 +610,65 @@ def _remove_share_file(share_filename):
     LOG.debug(_translators.log_info("_remove_share_file: Unlinking %s"), share_fullpathname)
     ironic_utils.unlink_without_raise(share_fullpathname)
 
+def _remove_node_share_file(node, share_filename):
+    """Remove a per-node file from the share file system.
+
+    With virtmedia_share_layout_compat, the file is also removed from
+    where the other share layouts put it.
+
+    :param node: the node the file belongs to.
+    :param share_filename: the file name, as returned for the node.
+    """
+    _remove_share_file(share_filename)
+    for stale_filename in share_layout.stale_files(
+            node, os.path.basename(share_filename)):
+        _remove_share_file(stale_filename)
+
+def _is_deploying_or_cleaning(task):
+    # NOTE(TheJulia): If this method is being called by something
+    # aside from deployment and clean, such as conductor takeover, we
+    # should treat this as a no-op and move on otherwise we would modify
+    # the state of the node due to virtual media operations.
+    return task.node.provision_state in (states.DEPLOYING, states.CLEANING)
+
+def _add_network_params(task, ramdisk_params):
+    """Adds the deploy NIC and network config to the ramdisk parameters."""
+    deploy_nic_mac = deploy_utils.get_single_nic_with_vif_port_id(task)
+    ramdisk_params['BOOTIF'] = deploy_nic_mac
+    os_net_config = task.node.driver_info.get('os_net_config')
+    if os_net_config:
+        ramdisk_params['os_net_config'] = os_net_config
+
+def _new_result(results, task):
+    result = {'success': True, 'error': None, 'timings': {},
+              'started': time.time()}
+    results[task.node.uuid] = result
+    return result
+
+def _record_error(task, result, error):
+    LOG.error("Bulk virtual media operation failed for node %(node)s: "
+              "%(error)s", {'node': task.node.uuid, 'error': error})
+    result['success'] = False
+    result['error'] = error
+    result['timings']['total'] = time.time() - result.pop('started')
+
+def _run_stage(stage, task, result, *args):
+    """Runs the last stage of a bulk operation and records its outcome."""
+    try:
+        stage(*args)
+    except Exception as e:
+        _record_error(task, result, e)
+    else:
+        result['timings']['total'] = time.time() - result.pop('started')
+
+@contextlib.contextmanager
+def _timed(result, stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        result['timings'][stage] = time.time() - start
+
 class VirtmediaBoot(base.BootInterface):
     """Implementation of a boot interface using Virtual Media."""
 
@@ -212,6 +678,7 @@ class VirtmediaBoot(base.BootInterface):
         :raises: InvalidParameterValue, if config option has invalid value.
         """
         super(VirtmediaBoot, self).__init__()
+        profiling.instrument(self, PROFILED_METHODS)
 
     def get_properties(self):
         return COMMON_PROPERTIES
@@ -253,25 +720,90 @@ class VirtmediaBoot(base.BootInterface):
         :raises: InvalidParameterValue if the validation of the
                  PowerInterface or ManagementInterface fails.
         :raises: VirtmediaOperationError, if some operation fails.
+        :raises: VirtmediaShareFull, if the share is running out of space.
         """
 
-        # NOTE(TheJulia): If this method is being called by something
-        # aside from deployment and clean, such as conductor takeover, we
-        # should treat this as a no-op and move on otherwise we would modify
-        # the state of the node due to virtual media operations.
-
-        if (task.node.provision_state != states.DEPLOYING and
-                task.node.provision_state != states.CLEANING):
+        if not _is_deploying_or_cleaning(task):
             return
 
-        deploy_nic_mac = deploy_utils.get_single_nic_with_vif_port_id(task)
-        ramdisk_params['BOOTIF'] = deploy_nic_mac
-        os_net_config = task.node.driver_info.get('os_net_config')
-        if os_net_config:
-            ramdisk_params['os_net_config'] = os_net_config
-
+        share_gc.check_free_space()
+        _add_network_params(task, ramdisk_params)
         self._setup_deploy_iso(task, ramdisk_params)
 
+    @METRICS.timer('VirtualMediaBoot.prepare_ramdisks')
+    def prepare_ramdisks(self, tasks_and_params):
+        """Prepares the deploy ramdisk of many nodes at once.
+
+        The share side work (fetching the deploy ISO, building the floppy
+        image and the per-node ISO) and the BMC side work (detaching,
+        attaching and setting the boot device) of each node run in two
+        separate bounded worker pools. A node moves to the BMC pool as soon
+        as its images are ready, so the images of the next nodes are built
+        while the BMCs of the previous ones are being talked to. The fsyncs
+        of the images built concurrently are batched.
+
+        :param tasks_and_params: a list of (task, ramdisk_params) tuples,
+            the tasks holding an exclusive lock on their node.
+        :returns: a dictionary mapping the UUIDs of the nodes being
+            deployed or cleaned to a dictionary with 'success', 'error'
+            (the exception raised, or None) and 'timings' (seconds spent
+            in the 'share' and 'bmc' stages and in 'total'). Other nodes
+            are skipped, as prepare_ramdisk does.
+        :raises: VirtmediaShareFull, if the share is running out of space.
+        """
+        share_gc.check_free_space()
+        results = {}
+        share_pool = futurist.ThreadPoolExecutor(
+            max_workers=CONF.virtmedia_bulk_share_workers)
+        bmc_pool = futurist.ThreadPoolExecutor(
+            max_workers=CONF.virtmedia_bulk_bmc_workers)
+        bmc_futures = []
+        bmc_futures_lock = threading.Lock()
+
+        def _share_stage(task, ramdisk_params, result):
+            with _timed(result, 'share'), share_utils.batched_fsync():
+                _add_network_params(task, ramdisk_params)
+                deploy_iso_file = self._get_deploy_iso(task)
+                return _prepare_deploy_images(task, deploy_iso_file,
+                                              ramdisk_params)
+
+        def _bmc_stage(task, node_images, result):
+            with _timed(result, 'bmc'), _saving_media_state(task):
+                self._attach_node_images(task, *node_images)
+                self._set_deploy_boot_device(task)
+
+        def _share_done(task, result, future):
+            error = future.exception()
+            if error is not None:
+                _record_error(task, result, error)
+                return
+            with bmc_futures_lock:
+                bmc_futures.append(bmc_pool.submit(
+                    _run_stage, _bmc_stage, task, result, task,
+                    future.result(), result))
+
+        try:
+            for task, ramdisk_params in tasks_and_params:
+                if not _is_deploying_or_cleaning(task):
+                    continue
+                result = _new_result(results, task)
+                future = share_pool.submit(_share_stage, task,
+                                           ramdisk_params, result)
+                future.add_done_callback(
+                    functools.partial(_share_done, task, result))
+
+            # Done callbacks run in the share workers, so once these are
+            # shut down every node has been handed over to the BMC pool.
+            share_pool.shutdown()
+            with bmc_futures_lock:
+                pending = list(bmc_futures)
+            waiters.wait_for_all(pending)
+        finally:
+            share_pool.shutdown()
+            bmc_pool.shutdown()
+
+        return results
+
     @METRICS.timer('VirtualMediaBoot.clean_up_ramdisk')
     def clean_up_ramdisk(self, task):
         """Cleans up the boot of ironic ramdisk.
@@ -285,6 +817,35 @@ class VirtmediaBoot(base.BootInterface):
         """
         self._cleanup_vmedia_boot(task)
 
+    @METRICS.timer('VirtualMediaBoot.clean_up_ramdisks')
+    def clean_up_ramdisks(self, tasks):
+        """Cleans up the boot of ironic ramdisk of many nodes at once.
+
+        :param tasks: a list of tasks holding an exclusive lock on their
+            node.
+        :returns: a dictionary mapping node UUIDs to results, as returned
+            by prepare_ramdisks.
+        """
+        results = {}
+        bmc_pool = futurist.ThreadPoolExecutor(
+            max_workers=CONF.virtmedia_bulk_bmc_workers)
+
+        def _cleanup_stage(task, result):
+            with _timed(result, 'bmc'):
+                self._cleanup_vmedia_boot(task)
+
+        try:
+            futures = []
+            for task in tasks:
+                result = _new_result(results, task)
+                futures.append(bmc_pool.submit(
+                    _run_stage, _cleanup_stage, task, result, task, result))
+            waiters.wait_for_all(futures)
+        finally:
+            bmc_pool.shutdown()
+
+        return results
+
     @METRICS.timer('VirtualMediaBoot.prepare_instance')
     def prepare_instance(self, task):
         """Prepares the boot of instance.
@@ -318,13 +879,34 @@ class VirtmediaBoot(base.BootInterface):
         :returns: None
         :raises: VirtmediaOperationError if operation failed.
         """
-        _remove_share_file(_get_boot_iso_name(task.node))
+        _remove_node_share_file(task.node, _get_boot_iso_name(task.node))
         driver_internal_info = task.node.driver_internal_info
         driver_internal_info.pop('root_uuid_or_disk_id', None)
         task.node.driver_internal_info = driver_internal_info
         task.node.save()
         self._cleanup_vmedia_boot(task)
 
+    @periodics.periodic(spacing=CONF.virtmedia_share_gc_interval,
+                        enabled=CONF.virtmedia_share_gc_interval > 0)
+    def _collect_share_garbage(self, manager, context):
+        """Removes orphans and enforces the quota of the share."""
+        share_gc.collect(share_gc.get_nodes(context))
+
+    @periodics.periodic(
+        spacing=CONF.virtmedia_page_cache_report_interval,
+        enabled=(CONF.virtmedia_page_cache_warm and
+                 CONF.virtmedia_page_cache_report_interval > 0))
+    def _report_page_cache(self, manager, context):
+        """Keeps the deploy ISOs in use warm and reports their residency."""
+        page_cache.report()
+
+    @periodics.periodic(
+        spacing=60, run_immediately=True,
+        enabled=CONF.virtmedia_params_delivery == 'http')
+    def _start_params_server(self, manager, context):
+        """Serves the parameters published before a conductor restart."""
+        params_server.ensure_started()
+
     def _configure_vmedia_boot(self, task, root_uuid_or_disk_id):
         """Configure vmedia boot for the node."""
         return
@@ -349,55 +931,215 @@ class VirtmediaBoot(base.BootInterface):
         :raises: InvalidParameterValue if the validation of the
             PowerInterface or ManagementInterface fails.
         """
-        d_info = task.node.driver_info
+        def _prepare_images():
+            deploy_iso_file = self._get_deploy_iso(task)
+            return _prepare_deploy_images(task, deploy_iso_file,
+                                          ramdisk_options)
 
-        deploy_iso_href = d_info['virtmedia_deploy_iso']
-        if service_utils.is_image_href_ordinary_file_name(deploy_iso_href):
-            deploy_iso_file = deploy_iso_href
-        else:
-            deploy_iso_file = _get_deploy_iso_name(task.node)
-            deploy_iso_fullpathname = os.path.join(
-                CONF.remote_image_share_root, deploy_iso_file)
-            images.fetch(task.context, deploy_iso_href, deploy_iso_fullpathname)
+        LOG.info(_translators.log_info("Setting up node %s to boot from virtual media"),
+                 task.node.uuid)
+        with _saving_media_state(task):
+            node_images, detached = self._prepare_images_while_detaching(
+                task, _prepare_images)
+            with METRICS.timer('VirtualMediaBoot.attach_virtual_media'):
+                self._attach_node_images(task, *node_images,
+                                         detached=detached)
+        with METRICS.timer('VirtualMediaBoot.set_deploy_boot_device'):
+            self._set_deploy_boot_device(task)
+
+    @METRICS.timer('VirtualMediaBoot.get_deploy_iso')
+    def _get_deploy_iso(self, task):
+        """Makes the deploy ISO of the node available in the share.
 
-        self._setup_vmedia_for_boot(task, deploy_iso_file, ramdisk_options)
-        self._set_deploy_boot_device(task)
+        :param task: a TaskManager instance containing the node to act on.
+        :returns: the deploy ISO file name in the share file system.
+        :raises: ImageRefValidationFailed if no image service can handle specified
+           href.
+        """
+        deploy_iso_href = task.node.driver_info['virtmedia_deploy_iso']
+        if service_utils.is_image_href_ordinary_file_name(deploy_iso_href):
+            return deploy_iso_href
+
+        if image_cache.is_cacheable(deploy_iso_href):
+            cached_iso = image_cache.fetch(task.context, deploy_iso_href)
+            return os.path.relpath(cached_iso, CONF.remote_image_share_root)
+
+        deploy_iso_file = _get_base_iso_name(task.node)
+        deploy_iso_fullpathname = os.path.join(
+            CONF.remote_image_share_root, deploy_iso_file)
+        expected = image_cache.get_expected_checksum(task.context,
+                                                     deploy_iso_href)
+        if image_cache.matches_checksum(deploy_iso_fullpathname, expected):
+            LOG.debug("Deploy ISO %(file)s of node %(node)s already has the "
+                      "checksum of %(href)s, not fetching it again",
+                      {'file': deploy_iso_file, 'node': task.node.uuid,
+                       'href': deploy_iso_href})
+            return deploy_iso_file
+
+        image_cache.remove_digest(deploy_iso_fullpathname)
+        share_layout.ensure_node_dir(task.node)
+        with share_utils.atomic_path(deploy_iso_fullpathname) as tmp_path:
+            digests = image_cache.download(task.context, deploy_iso_href,
+                                           tmp_path, expected)
+        image_cache.save_digest(deploy_iso_fullpathname, digests)
+        return deploy_iso_file
+
+    def _prepare_images_while_detaching(self, task, prepare_images):
+        """Prepares the images of a node while its stale media are detached.
+
+        The share side preparation runs in the calling thread while the
+        BMC detaches, in another thread, the media not known to be
+        detached or to still hold a current image. Both are done when this
+        returns.
 
-    def _setup_vmedia_for_boot(self, task, bootable_iso_filename, parameters=None):
-        """Sets up the node to boot from the boot ISO image.
+        :param task: a TaskManager instance containing the node to act on.
+        :param prepare_images: a callable returning the floppy image and
+            per-node ISO file names.
+        :returns: a tuple of what prepare_images returned and of the set of
+            devices left detached, for _attach_node_images.
+        :raises: whatever prepare_images raised, otherwise whatever
+            detaching raised.
+        """
+        executor = futurist.ThreadPoolExecutor(max_workers=1)
+        try:
+            detach = executor.submit(self._detach_stale_media, task)
+            try:
+                with METRICS.timer('VirtualMediaBoot.prepare_share_images'):
+                    node_images = prepare_images()
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    waiters.wait_for_all([detach])
+                    if detach.exception() is not None:
+                        LOG.warning("Detaching the virtual media of node "
+                                    "%(node)s failed too: %(err)s",
+                                    {'node': task.node.uuid,
+                                     'err': detach.exception()})
+            detached = detach.result()
+        finally:
+            # The detach is over by now, do not wait for the idle worker.
+            executor.shutdown(wait=False)
+        return node_images, detached
+
+    @METRICS.timer('VirtualMediaBoot.detach_stale_media')
+    def _detach_stale_media(self, task):
+        """Detaches the media that would have to be detached anyway.
+
+        That is every device whose state is unknown or whose attached image
+        changed in the share since it was attached. A device holding a
+        current image is left alone, _attach_node_images decides once the
+        images are prepared.
 
-        This method attaches a boot_iso on the node and passes
-        the required parameters to it via a virtual floppy image.
+        :param task: a TaskManager instance containing the node to act on.
+        :returns: the set of devices left detached.
+        :raises: VirtmediaOperationError if ejecting virtual media failed.
+        """
+        detached = set()
+        for device in ('cd', 'fd'):
+            if CONF.virtmedia_reconcile_media_state:
+                known, attached = _get_media_state(task.node, device)
+                if (known and attached is not None and attached ==
+                        _get_media_fingerprint(attached['image'])):
+                    continue
+            if self._reconcile_media(task, device, None):
+                detached.add(device)
+        return detached
+
+    def _attach_node_images(self, task, floppy_image_filename,
+                            node_iso_filename, detached=()):
+        """Attaches the prepared per-node images to the node.
+
+        Whatever else is attached is detached first, in the order the BMCs
+        expect: cd detached, fd detached and attached, cd attached.
 
         :param task: a TaskManager instance containing the node to act on.
-        :param bootable_iso_filename: a bootable ISO image to attach to.
-            The iso file should be present in NFS/CIFS server.
-        :param parameters: the parameters to pass in a virtual floppy image
-            in a dictionary.  This is optional.
-        :raises: ImageCreationFailed, if it failed while creating a floppy image.
+        :param floppy_image_filename: the floppy image file name, or None.
+        :param node_iso_filename: the per-node ISO file name.
+        :param detached: the devices known to be detached already.
         :raises: VirtmediaOperationError, if attaching a virtual media failed.
         """
-        LOG.info(_translators.log_info("Setting up node %s to boot from virtual media"),
-                 task.node.uuid)
+        cd_detached = self._reconcile_media(
+            task, 'cd', node_iso_filename, attach=False,
+            detached='cd' in detached)
+        self._reconcile_media(task, 'fd', floppy_image_filename,
+                              detached='fd' in detached)
+        self._reconcile_media(task, 'cd', node_iso_filename,
+                              detached=cd_detached)
 
-        self._detach_virtual_cd(task)
-        self._detach_virtual_fd(task)
+    def _detach_node_images(self, task):
+        """Detaches the virtual cdrom and floppy of the node.
 
-        floppy_image_filename = None
-        if parameters:
-            floppy_image_filename = _prepare_floppy_image(task, parameters)
-            self._attach_virtual_fd(task, floppy_image_filename)
+        :param task: a TaskManager instance containing the node to act on.
+        :raises: VirtmediaOperationError if ejecting virtual media failed.
+        """
+        with _saving_media_state(task):
+            self._reconcile_media(task, 'cd', None)
+            self._reconcile_media(task, 'fd', None)
 
-        if floppy_image_filename:
-            _append_floppy_to_cd(bootable_iso_filename, floppy_image_filename)
+    def _reconcile_media(self, task, device, share_filename, attach=True,
+                         detached=False):
+        """Brings a virtual media device of the node to the wanted state.
 
-        self._attach_virtual_cd(task, bootable_iso_filename)
+        With virtmedia_reconcile_media_state, the BMC round-trips are
+        skipped when the recorded state of the device shows nothing is
+        attached and nothing is wanted, or the wanted image, unchanged
+        since, is already attached. When the state is unknown, or not
+        recorded, the device is detached first, as it always was.
+
+        :param task: a TaskManager instance containing the node to act on.
+        :param device: 'cd' or 'fd'.
+        :param share_filename: the image to attach, None for no media.
+        :param attach: when False, only detach the device if it does not
+            hold the wanted image.
+        :param detached: whether the device is known to be detached
+            already, in this operation.
+        :returns: whether the device is left detached.
+        :raises: VirtmediaOperationError if a virtual media operation failed.
+        """
+        node = task.node
+        record = CONF.virtmedia_reconcile_media_state
+        wanted = _get_media_fingerprint(share_filename)
+        if detached:
+            known, attached = True, None
+        elif record:
+            known, attached = _get_media_state(node, device)
+        else:
+            known, attached = False, None
+
+        if known and attached == wanted:
+            if not detached:
+                LOG.debug("Virtual %(device)s of node %(node)s already in "
+                          "the wanted state, skipping",
+                          {'device': device, 'node': node.uuid})
+                METRICS.send_counter('VirtualMediaBoot.media_ops_skipped',
+                                     1)
+            return wanted is None
+
+        if not known or attached is not None:
+            detach = (self._detach_virtual_cd if device == 'cd'
+                      else self._detach_virtual_fd)
+            if record:
+                _record_media_state(node, device, desired=None)
+            detach(task)
+            if record:
+                _record_media_state(node, device, observed=None)
+
+        if wanted is None or not attach:
+            return True
+        attach_media = (self._attach_virtual_cd if device == 'cd'
+                        else self._attach_virtual_fd)
+        if record:
+            _record_media_state(node, device, desired=wanted)
+        attach_media(task, share_filename)
+        if record:
+            _record_media_state(node, device, observed=wanted)
+        return False
 
     def _cleanup_vmedia_boot(self, task):
         """Cleans a node after a virtual media boot.
 
         This method cleans up a node after a virtual media boot.
-        It deletes floppy and cdrom images if they exist in NFS/CIFS server.
+        It deletes floppy and cdrom images if they exist in NFS/CIFS server,
+        unless they are kept for reuse by the next deploy or clean.
         It also ejects both the virtual media cdrom and the virtual media floppy.
 
         :param task: a TaskManager instance containing the node to act on.
@@ -406,11 +1148,21 @@ class VirtmediaBoot(base.BootInterface):
         LOG.debug("Cleaning up node %s after virtual media boot", task.node.uuid)
 
         node = task.node
-        self._detach_virtual_cd(task)
-        self._detach_virtual_fd(task)
+        self._detach_node_images(task)
+        params_server.withdraw_node(node)
+
+        if CONF.virtmedia_reuse_node_images:
+            return
 
-        _remove_share_file(_get_floppy_image_name(node))
-        _remove_share_file(_get_deploy_iso_name(node))
+        _remove_manifest(node)
+        _remove_node_share_file(node, _get_floppy_image_name(node))
+        _remove_node_share_file(node, _get_deploy_iso_name(node))
+        _remove_node_share_file(node, _get_deploy_iso_name(node) +
+                                image_cache.DIGEST_SUFFIX)
+        _remove_node_share_file(node, _get_base_iso_name(node))
+        _remove_node_share_file(node, _get_base_iso_name(node) +
+                                image_cache.DIGEST_SUFFIX)
+        share_layout.remove_empty_node_dir(node.uuid)
 
     def _attach_virtual_cd(self, task, bootable_iso_filename):
         """Attaches the given url as virtual media on the node.
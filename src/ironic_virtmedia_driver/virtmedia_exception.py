@@ -18,3 +18,11 @@ from ironic.common.i18n import _
 
 class VirtmediaOperationError(exception.IronicException):
     _msg_fmt = _('Virtmedia %(operation)s failed. Reason: %(error)s')
+
+class VirtmediaShareFull(exception.IronicException):
+    _msg_fmt = _('Not enough free space in %(path)s for virtual media '
+                 'images: %(free)d bytes free, at least %(required)d '
+                 'required')
+
+class ImageChecksumMismatch(exception.IronicException):
+    _msg_fmt = _('Image %(image_href)s failed verification: %(reason)s')
@@ -22,18 +22,28 @@ from ironic.common.i18n import _
 from ironic.drivers.modules import ipmitool
 from ironic.common import exception
 from ironic.conductor import utils as manager_utils
+from ironic_virtmedia_driver import provisioning_pool
 from ironic_virtmedia_driver import virtmedia
 
 LOG = logging.getLogger(__name__)
 
 REQUIRED_PROPERTIES = {
-    'provisioning_server': 'Provisioning server IP hosting deployment ISO and metadata Floppy images. Required.',
+    'provisioning_server': 'Provisioning server IP hosting deployment ISO and metadata Floppy images, or a comma separated pool of HOST[:PORT][;weight=W][;subnet=CIDR][;locality=NAME] entries. Required.',
     'provisioning_server_http_port': 'Provisioning server port where the images can be obtained with http requests. Required.',
     'vendor': 'Vendor for the installed hardware. Required.',
     'product_family': 'Product family for the hardware. Required.'
 }
 
+OPTIONAL_PROPERTIES = {
+    'provisioning_locality': 'Locality of the node, the provisioning servers of the pool tagged with it are preferred. Optional.',
+}
+
 COMMON_PROPERTIES = REQUIRED_PROPERTIES.copy()
+COMMON_PROPERTIES.update(OPTIONAL_PROPERTIES)
+
+# The provisioning server of the pool the media of the node were last
+# attached through, in driver_internal_info.
+PROVISIONING_SERVER = 'virtmedia_provisioning_server'
 
 def _parse_driver_info(node):
     """Gets the information needed for accessing the node.
@@ -51,18 +61,58 @@ def _parse_driver_info(node):
             "virtmedia_ipmi driver requires the following parameters to be set in "
             "node's driver_info: %s.") % missing_info)
 
-    provisioning_server = info.get('provisioning_server')
-    provisioning_server_http_port = info.get('provisioning_server_http_port')
+    provisioning_servers = provisioning_pool.parse(
+        info.get('provisioning_server'),
+        info.get('provisioning_server_http_port'))
+    # The server the media were attached through, while it is in the pool.
+    provisioning_server = provisioning_servers[0]
+    recorded = (node.driver_internal_info or {}).get(PROVISIONING_SERVER)
+    for server in provisioning_servers:
+        if recorded == {'host': server.host, 'port': server.port}:
+            provisioning_server = server
     vendor = info.get('vendor')
     product_family = info.get('product_family')
     ipmi_params = ipmitool._parse_driver_info(node)
     res = {
-        'provisioning_server': provisioning_server,
-        'provisioning_server_http_port': provisioning_server_http_port,
+        'provisioning_server': provisioning_server.host,
+        'provisioning_server_http_port': provisioning_server.port,
+        'provisioning_servers': provisioning_servers,
+        'provisioning_locality': info.get('provisioning_locality'),
         'vendor': vendor,
         'product_family': product_family,
     }
-    return dict(ipmi_params.items() + res.items())
+    params = dict(ipmi_params)
+    params.update(res)
+    return params
+
+def _select_provisioning_server(task, driver_info):
+    """Chooses the provisioning server of the pool to attach through.
+
+    The choice is recorded in driver_internal_info, so that the following
+    operations on the media of the node use the same server, and set in
+    driver_info.
+
+    :param task: a TaskManager instance containing the node to act on.
+    :param driver_info: the driver_info returned by _parse_driver_info.
+    :returns: the chosen ProvisioningServer.
+    """
+    node = task.node
+    servers = driver_info['provisioning_servers']
+    server = provisioning_pool.select(servers, node.uuid,
+                                      driver_info.get('address'),
+                                      driver_info.get('provisioning_locality'))
+    driver_info['provisioning_server'] = server.host
+    driver_info['provisioning_server_http_port'] = server.port
+    if len(servers) > 1:
+        LOG.debug("Attaching the virtual media of node %(node)s through "
+                  "provisioning server %(server)s",
+                  {'node': node.uuid, 'server': server})
+        driver_internal_info = node.driver_internal_info
+        driver_internal_info[PROVISIONING_SERVER] = {'host': server.host,
+                                                     'port': server.port}
+        node.driver_internal_info = driver_internal_info
+        node.save()
+    return server
 
 def _get_hw_library(driver_info):
     try:
@@ -115,17 +165,24 @@ class VirtualMediaAndIpmiBoot(virtmedia.VirtmediaBoot):
         """
         retry_count = 2
         driver_info = _parse_driver_info(task.node)
+        server = _select_provisioning_server(task, driver_info)
 
         hw = _get_hw_library(driver_info)
 
-        while not hw.attach_virtual_cd(image_filename, driver_info, task) and retry_count:
-            retry_count -= 1
-            time.sleep(1)
-            LOG.debug("Virtual media attachment failed. Retrying again")
+        with hw.timer('attach_virtual_cd_with_retries'):
+            while (not hw.attach_virtual_cd(image_filename, driver_info, task)
+                   and retry_count):
+                retry_count -= 1
+                hw.count('attach_retries')
+                time.sleep(1)
+                LOG.debug("Virtual media attachment failed. Retrying again")
 
         if not retry_count:
+            hw.count('attach_failures')
+            provisioning_pool.failed(server)
             LOG.exception("Failed to attach Virtual media. Max retries exceeded")
             raise exception.InstanceDeployFailure(reason='NFS mount failed!')
+        provisioning_pool.attached(server, task.node.uuid)
 
     def _detach_virtual_cd(self, task):
         """Detaches virtual cdrom on the node.
@@ -136,6 +193,7 @@ class VirtualMediaAndIpmiBoot(virtmedia.VirtmediaBoot):
         driver_info = _parse_driver_info(task.node)
         hw = _get_hw_library(driver_info)
         hw.detach_virtual_cd(driver_info, task)
+        provisioning_pool.detached(task.node.uuid)
 
     def _set_deploy_boot_device(self, task):
         """Set the boot device for deployment"""
@@ -15,6 +15,7 @@
 
 import os
 
+from ironic_lib import metrics_utils
 from oslo_concurrency import processutils
 from oslo_log import log as logging
 from oslo_utils import strutils
@@ -32,6 +33,8 @@ from ironic_virtmedia_driver import virtmedia
 
 LOG = logging.getLogger(__name__)
 
+METRICS = metrics_utils.get_metrics_logger(__name__)
+
 REQUIRED_PROPERTIES = {
     'ssh_address': _("IP address of the node to ssh into from where the VMs can be managed. "
                      "Required."),
@@ -145,6 +148,7 @@ def _parse_driver_info(node):
             "ssh_virtmedia Driver requires ssh_key_contents to be set."))
     return res
 
+@METRICS.timer('VirtualMediaAndSSHBoot.ssh_connect')
 def _get_ssh_connection(connection):
     """Returns an SSH client connected to a node.
 
@@ -183,6 +187,7 @@ def _get_ssh_connection(connection):
 
     return ssh
 
+@METRICS.timer('VirtualMediaAndSSHBoot.get_disk_attachment_status')
 def _get_disk_attachment_status(driver_info, node_name, ssh_obj, target_disk='hda'):
     cmd_to_exec = "%s %s" % (driver_info['cmd_set']['base_cmd'],
                              driver_info['cmd_set']['get_disk_list'])
@@ -194,6 +199,7 @@ def _get_disk_attachment_status(driver_info, node_name, ssh_obj, target_disk='hd
     else:
         return False
 
+@METRICS.timer('VirtualMediaAndSSHBoot.sftp_connect')
 def _get_sftp_connection(connection):
     try:
         key_contents = connection.get('key_contents')
@@ -218,11 +224,14 @@ def _get_sftp_connection(connection):
                   {'err': e})
         raise exception.CommunicationError(e)
 
+@METRICS.timer('VirtualMediaAndSSHBoot.copy_media')
 def _copy_media_to_virt_server(sftp_obj, media_file):
     LOG.debug("Copying file: %s to target" %(media_file))
     sftp = paramiko.SFTPClient.from_transport(sftp_obj)
     try:
-        sftp.put('/remote_image_share_root/%s' %media_file, '/var/lib/libvirt/images/%s' %media_file)
+        # The file may be in a node directory of the share, see
+        # virtmedia_share_layout; the target directory is flat.
+        sftp.put('/remote_image_share_root/%s' %media_file, '/var/lib/libvirt/images/%s' %os.path.basename(media_file))
     except Exception as e:
         LOG.error(_translators.log_error("Cannot copy %(media_file)s to target. Reason: %(err)s."),
                   {'media_file': media_file, 'err': e})
@@ -236,6 +245,7 @@ class VirtualMediaAndSSHBoot(virtmedia.VirtmediaBoot):
         """
         super(VirtualMediaAndSSHBoot, self).__init__()
 
+    @METRICS.timer('VirtualMediaAndSSHBoot.attach_virtual_cd')
     def _attach_virtual_cd(self, task, image_filename):
         driver_info = _parse_driver_info(task.node)
         ssh_obj = _get_ssh_connection(driver_info)
@@ -249,13 +259,14 @@ class VirtualMediaAndSSHBoot(virtmedia.VirtmediaBoot):
         cmd_to_exec = "%s %s" % (driver_info['cmd_set']['base_cmd'],
                                  driver_info['cmd_set']['attach_disk_device'])
         cmd_to_exec = cmd_to_exec.replace('{_NodeName_}', node_name)
-        cmd_to_exec = cmd_to_exec.replace('{_ImageName_}', image_filename)
+        cmd_to_exec = cmd_to_exec.replace('{_ImageName_}', os.path.basename(image_filename))
         cmd_to_exec = cmd_to_exec.replace('{_TargetDev_}', 'hda')
         cmd_to_exec = cmd_to_exec.replace('{_DevType_}', 'cdrom')
         LOG.debug("Ironic node-name: %s, virsh domain name: %s, image_filename: %s" %(task.node.name, node_name, image_filename))
 
         _ssh_execute(ssh_obj, cmd_to_exec)
 
+    @METRICS.timer('VirtualMediaAndSSHBoot.detach_virtual_cd')
     def _detach_virtual_cd(self, task):
         driver_info = _parse_driver_info(task.node)
         ssh_obj = _get_ssh_connection(driver_info)
@@ -31,6 +31,11 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     entry_points={
+        'console_scripts': [
+            'virtmedia-share-gc = ironic_virtmedia_driver.share_gc:main',
+            'virtmedia-image-server = ironic_virtmedia_driver.image_server:main',
+            'virtmedia-share-migrate = ironic_virtmedia_driver.share_layout:main',
+        ],
         'ironic.hardware.types': [
             'ipmi_virtmedia = ironic_virtmedia_driver.ipmi_virtmedia:IPMIVirtmediaHardware',
             'ssh_virtmedia = ironic_virtmedia_driver.ssh_virtmedia:SSHVirtmediaHardware'